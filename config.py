@@ -16,16 +16,64 @@ class Config(object):
     APP_NAME = getenv('APP_NAME')
     SECRET_KEY = getenv('SECRET_KEY')
 
-    BCRYPT_LOG_ROUNDS = 13
+    # Password hashing cost, hashes of other cost are upgraded on the next login
+    BCRYPT_LOG_ROUNDS = int(getenv('BCRYPT_LOG_ROUNDS', 13))
+    # Hashing runs on this many threads, with at most BCRYPT_MAX_QUEUE jobs waiting for them
+    BCRYPT_WORKERS = int(getenv('BCRYPT_WORKERS', 2))
+    BCRYPT_MAX_QUEUE = int(getenv('BCRYPT_MAX_QUEUE', 32))
     DEBUG_TB_ENABLED = False
     DEBUG_TB_INTERCEPT_REDIRECTS = False
 
+    # Catalog
+    CATALOG_KEYSET_PAGINATION = False
+    TAXONOMY_CACHE_TTL = 300
+
+    # Pagination totals: 'exact', 'cached' or 'approximate' (PostgreSQL planner estimate)
+    PAGINATION_COUNT_MODE = 'cached'
+    PAGINATION_COUNT_CACHE_TTL = 60
+    # Counts of distinct filter sets kept per table
+    PAGINATION_COUNT_CACHE_SIZE = 1024
+
+    # Rendered catalog pages cache for anonymous users
+    PAGE_CACHE_ENABLED = True
+    PAGE_CACHE_SIZE = 512
+    PAGE_CACHE_TTL = 60
+    # Hits and misses of the cache are logged once per this number of lookups
+    PAGE_CACHE_STATS_INTERVAL = 1000
+
+    # Cart items store: 'cookie' (signed session) or 'database' (cart_items table per user)
+    CART_STORE = 'cookie'
+
+    # Cart reservations expire unless the cart is used, expired ones are released by a sweeper
+    # thread of the app every SWEEP_INTERVAL seconds, unless it is disabled and the
+    # release_expired_reservations command is run instead
+    CART_RESERVATION_TTL = 30 * 60
+    CART_SWEEPER_WORKER = True
+    CART_SWEEP_INTERVAL = 60
+    CART_SWEEP_BATCH_SIZE = 500
+
+    # Maximal number of distinct products added to the cart with one request
+    CART_MAX_BULK_ITEMS = 100
+
+    # Logged in users cache, entries of other processes may be stale for up to the time to live
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 30
+
     # mail settings
     MAIL_SERVER = 'smtp.gmail.com'
     MAIL_PORT = 465
     MAIL_USE_TLS = False
     MAIL_USE_SSL = True
 
+    # Emails are put into the outbox table and delivered by a sender thread of the app,
+    # unless it is disabled and the send_outbox command is run instead
+    MAIL_OUTBOX_WORKER = True
+    MAIL_OUTBOX_POLL_INTERVAL = 10
+    MAIL_OUTBOX_BATCH_SIZE = 50
+    # Failed messages are retried after RETRY_DELAY seconds, doubled after every attempt
+    MAIL_OUTBOX_RETRY_DELAY = 30
+    MAIL_OUTBOX_MAX_ATTEMPTS = 6
+
     # gmail authentication
     MAIL_USERNAME = getenv('MAIL_USERNAME')
     MAIL_PASSWORD = getenv('MAIL_PASSWORD')
@@ -72,5 +120,10 @@ class TestingConfig(Config):
     DEBUG = False
     TESTING = True
 
+    PAGE_CACHE_ENABLED = False
+    BCRYPT_LOG_ROUNDS = 4
+    MAIL_OUTBOX_WORKER = False
+    CART_SWEEPER_WORKER = False
+
     # Database uri
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(Config.BASE_DIR, 'test.db')
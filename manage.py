@@ -1,10 +1,22 @@
 """Module with shell for running app commands"""
 
+import statistics
+import time
+
 from app import app
+import click
 from flask.cli import FlaskGroup
+from flask_login import login_user
 
-from shop.db import db
+from shop.carts.models import CartReservationModel, get_reservation_metrics
+from shop.carts.session_handler import SessionCart
+from shop.db import add_missing_columns, db, unit_of_work
+from shop.email import deliver_outbox
+from shop.orders.models import OrderModel, OrderProductModel
+from shop.products.models import ProductModel
+from shop.products.search import rebuild_index
 from shop.seed_db import clear_all, seed_admin, seed_brands, seed_categories, seed_orders, seed_products, seed_users
+from shop.users.models import UserModel
 
 cli = FlaskGroup(app)
 
@@ -27,6 +39,81 @@ def seed_db():
     seed_admin()
 
 
+@cli.command("build_search_index")
+def build_search_index():
+    rebuild_index(ProductModel.query.yield_per(1000))
+
+
+@cli.command("backfill_order_totals")
+def backfill_order_totals():
+    """
+    Migrate a database created before the order lines kept their prices and the orders their totals:
+    add the columns, fill the line prices from the current products and the totals from the lines
+    """
+    with unit_of_work():
+        columns = add_missing_columns(OrderProductModel) + add_missing_columns(OrderModel)
+        lines = OrderProductModel.backfill_prices()
+        orders = OrderModel.backfill_totals()
+    click.echo(f'added_columns={",".join(columns) or "-"} filled_lines={lines} filled_orders={orders}')
+
+
+@cli.command("release_expired_reservations")
+@click.option('--interval', type=int, default=0, help='Repeat every INTERVAL seconds instead of running once')
+def release_expired_reservations(interval):
+    while True:
+        CartReservationModel.release_expired(batch_size=app.config['CART_SWEEP_BATCH_SIZE'])
+        click.echo(' '.join(f'{name}={value}' for name, value in get_reservation_metrics().items()))
+        if not interval:
+            break
+        time.sleep(interval)
+
+
+@cli.command("send_outbox")
+@click.option('--interval', type=int, default=0, help='Repeat every INTERVAL seconds instead of running once')
+def send_outbox(interval):
+    batch_size = app.config['MAIL_OUTBOX_BATCH_SIZE']
+    while True:
+        sent = 0
+        while True:
+            taken = deliver_outbox(batch_size)
+            sent += taken
+            if taken < batch_size:
+                break
+        click.echo(f'processed={sent}')
+        if not interval:
+            break
+        time.sleep(interval)
+
+
+@cli.command("benchmark_checkout")
+@click.option('--sizes', default='1,5,10,30', help='Comma separated cart sizes')
+@click.option('--repeat', type=int, default=5)
+def benchmark_checkout(sizes, repeat):
+    """Print checkout latency per cart size, placed orders are removed afterwards"""
+    sizes = [int(size) for size in sizes.split(',')]
+    user = UserModel.query.filter_by(is_superuser=False).first()
+    products = ProductModel.query.filter(ProductModel.available > 0).limit(max(sizes)).all()
+
+    for size in sizes:
+        timings = []
+        for _ in range(repeat):
+            with app.test_request_context():
+                login_user(user)
+                SessionCart.init_cart()
+                for product in products[:size]:
+                    SessionCart.add_product(product.id, 1)
+
+                start = time.perf_counter()
+                order = SessionCart.make_order()
+                timings.append(time.perf_counter() - start)
+
+                for order_product in order.products.all():
+                    ProductModel.release(order_product.product_id, order_product.amount)
+                order.delete()
+        median, slowest = statistics.median(timings) * 1000, max(timings) * 1000
+        click.echo(f'{size:>4} items: median {median:.1f} ms, max {slowest:.1f} ms')
+
+
 @cli.command("clear_db")
 def clear_db():
     clear_all()
@@ -15,18 +15,32 @@ def create_app(config_name: str):
     app.config.from_object(config_module)
     Bootstrap(app)
 
-    from shop.email import init_mail
+    from shop.email import init_mail, start_outbox_sender
     init_mail(app)
 
-    from shop.products.models import CategoryModel, BrandModel, ProductModel
-    from shop.users.models import UserModel
+    from shop.bcrypt import bcrypt, hashing_pool
+    bcrypt.init_app(app)
+    hashing_pool.init_app(app)
+
+    from shop.products.models import CategoryModel, BrandModel, ProductModel, catalog_page_cache
+    catalog_page_cache.configure(maxsize=app.config['PAGE_CACHE_SIZE'], ttl=app.config['PAGE_CACHE_TTL'])
+    from shop.users.models import UserModel, user_cache
+    user_cache.configure(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
     login_manager = LoginManager(app)
     login_manager.login_view = 'users_blueprint.login'
     login_manager.login_message_category = 'info'
 
     @login_manager.user_loader
     def load_user(user_id):
-        return UserModel.query.get(int(user_id))
+        return UserModel.get_cached(int(user_id))
+
+    @app.after_request
+    def flush_cart(response):
+        SessionCart.flush()
+        return response
+
+    from shop.core.models import clear_request_lookups
+    app.teardown_request(clear_request_lookups)
 
     @app.context_processor
     def cart_summary_processor():
@@ -49,4 +63,8 @@ def create_app(config_name: str):
         app.register_blueprint(orders_blueprint)
         app.register_blueprint(errors_blueprint)
 
+    start_outbox_sender(app)
+    from shop.carts.models import start_reservation_sweeper
+    start_reservation_sweeper(app)
+
     return app
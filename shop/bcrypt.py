@@ -1,5 +1,65 @@
-"""Module with Bcrypt initialization"""
+"""Module with Bcrypt initialization and password hashing on a bounded worker pool"""
 
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from typing import Callable
+
+from flask import current_app
 from flask_bcrypt import Bcrypt
 
 bcrypt = Bcrypt()
+
+
+class HashingPoolBusy(Exception):
+    """Raised when too many password hashing jobs are already running or waiting"""
+
+
+class HashingPool:
+    """
+    Runs bcrypt on a fixed number of worker threads, so a burst of logins can not take
+    more CPU than the workers give it. Jobs beyond the queue limit are rejected at once
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._slots = None
+
+    def init_app(self, app) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+        workers = app.config['BCRYPT_WORKERS']
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(workers + app.config['BCRYPT_MAX_QUEUE'])
+
+    def run(self, function: Callable, *args):
+        if self._executor is None:
+            return function(*args)
+
+        if not self._slots.acquire(blocking=False):
+            raise HashingPoolBusy()
+        try:
+            future = self._executor.submit(function, *args)
+        except RuntimeError:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+
+hashing_pool = HashingPool()
+
+
+def generate_password_hash(password: str) -> str:
+    rounds = current_app.config['BCRYPT_LOG_ROUNDS']
+    return hashing_pool.run(bcrypt.generate_password_hash, password, rounds).decode('utf-8')
+
+
+def check_password_hash(password_hash: str, password: str) -> bool:
+    return hashing_pool.run(bcrypt.check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash: str) -> bool:
+    """Check if the hash was made with other cost than the configured one"""
+    rounds = int(password_hash.split('$')[2])
+    return rounds != current_app.config['BCRYPT_LOG_ROUNDS']
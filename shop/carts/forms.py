@@ -1,6 +1,5 @@
 """Module with forms for carts blueprint"""
 
-from flask import session
 from flask_wtf import FlaskForm
 from wtforms.fields import IntegerField, SubmitField
 from wtforms.validators import DataRequired, InputRequired, NumberRange
@@ -51,7 +50,7 @@ class UpdateProductAmountForm(FlaskForm):
             return False
 
         product = ProductModel.get(id=self.product_id.data)
-        max_amount = product.available + session[SessionCart.CART_NAME].get(str(product.id), 0)
+        max_amount = product.available + SessionCart.get_cart().get(str(product.id), 0)
         if max_amount < self.new_amount.data:
             self.new_amount.errors.append('Not enough product to add.')
             return False
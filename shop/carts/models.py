@@ -0,0 +1,306 @@
+"""Models for carts blueprint"""
+
+from collections import Counter
+from datetime import datetime, timedelta
+from functools import partial
+import logging
+import threading
+from typing import Dict, List, Optional
+
+from sqlalchemy import bindparam, case, func, select, UniqueConstraint
+from sqlalchemy.exc import IntegrityError
+
+from shop.core.models import BaseModelMixin
+from shop.db import after_commit, commit, db, upsert
+from shop.orders.models import OrderModel, OrderProductModel
+from shop.products.models import ProductModel
+
+logger = logging.getLogger(__name__)
+
+# Units released by the sweeper in this process
+reservation_metrics = Counter()
+
+
+class CartItemModel(BaseModelMixin):
+    """Amount of a product in the cart of a user, used by the database cart store"""
+
+    __tablename__ = 'cart_items'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+    product_id = db.Column(
+        db.Integer,
+        db.ForeignKey('products.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+    amount = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.CheckConstraint('0 < amount', name='positive_cart_item_amount_constraint'),
+    )
+
+    @classmethod
+    def get_items(cls, user_id: int) -> Dict[str, int]:
+        rows = db.session.query(cls.product_id, cls.amount).filter_by(user_id=user_id).all()
+        return {str(product_id): amount for product_id, amount in rows}
+
+    @classmethod
+    def write(cls, user_id: int, items: Dict[str, int], stored: Dict[str, int], retry: bool = True) -> None:
+        """
+        Write the difference between the cart items and the stored ones with one statement per kind of change.
+        Items of products deleted meanwhile are dropped from the cart and the rest is written again
+        """
+        removed = [int(product_id) for product_id in stored if product_id not in items]
+        changed = [
+            {'user': user_id, 'product': int(product_id), 'new_amount': amount}
+            for product_id, amount in items.items() if product_id in stored and stored[product_id] != amount
+        ]
+        added = [
+            {'user_id': user_id, 'product_id': int(product_id), 'amount': amount}
+            for product_id, amount in items.items() if product_id not in stored
+        ]
+
+        try:
+            if removed:
+                cls.query.filter(cls.user_id == user_id, cls.product_id.in_(removed)).delete(synchronize_session=False)
+            if changed:
+                db.session.execute(
+                    cls.__table__.update().where(
+                        cls.user_id == bindparam('user'),
+                        cls.product_id == bindparam('product'),
+                    ).values(amount=bindparam('new_amount')),
+                    changed,
+                )
+            if added:
+                # Items added concurrently by another session of the user are overwritten
+                db.session.execute(
+                    upsert(cls.__table__, ['user_id', 'product_id'], lambda excluded: {'amount': excluded.amount}),
+                    added,
+                )
+            db.session.commit()
+        except IntegrityError as err:
+            db.session.rollback()
+            missing = cls._drop_missing_products(items)
+            if not retry or not missing:
+                raise err
+            cls.write(user_id, items, cls.get_items(user_id), retry=False)
+
+    @staticmethod
+    def _drop_missing_products(items: Dict[str, int]) -> List[str]:
+        """Remove the items of products which no longer exist from the cart, return their ids"""
+        existing = {
+            str(product_id) for product_id, in db.session.query(ProductModel.id).filter(
+                ProductModel.id.in_([int(product_id) for product_id in items]),
+            )
+        }
+        missing = [product_id for product_id in items if product_id not in existing]
+        for product_id in missing:
+            items.pop(product_id)
+        return missing
+
+
+class CartReservationModel(BaseModelMixin):
+    """Amount of a product held by a cart until the hold expires"""
+
+    __tablename__ = 'cart_reservations'
+
+    id = db.Column(db.Integer, primary_key=True)
+    cart_id = db.Column(db.String(32), nullable=False)
+    product_id = db.Column(
+        db.Integer,
+        db.ForeignKey('products.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+    amount = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    __table_args__ = (
+        UniqueConstraint('cart_id', 'product_id', name='unique_cart_product_reservation'),
+        db.CheckConstraint('0 < amount', name='positive_reservation_amount_constraint'),
+    )
+
+    @classmethod
+    def hold(cls, cart_id: str, product_id: int, amount: int, ttl: int) -> None:
+        """Add the amount to the cart hold of the product and extend the hold"""
+        try:
+            cls.hold_all(cart_id, {product_id: amount}, ttl)
+            commit()
+        except IntegrityError as err:
+            db.session.rollback()
+            raise err
+
+    @classmethod
+    def hold_all(cls, cart_id: str, amounts: Dict[int, int], ttl: int) -> None:
+        """
+        Add the amounts to the cart holds of the products in the current transaction, without committing.
+        Holds created concurrently are incremented by the same statement, so it never fails on them.
+        Rows are written in the order of product ids, like the products are reserved
+        """
+        expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+        statement = upsert(
+            cls.__table__,
+            ['cart_id', 'product_id'],
+            lambda excluded: {'amount': cls.__table__.c.amount + excluded.amount, 'expires_at': excluded.expires_at},
+        )
+        db.session.execute(statement, [
+            {'cart_id': cart_id, 'product_id': product_id, 'amount': amount, 'expires_at': expires_at}
+            for product_id, amount in sorted(amounts.items())
+        ])
+
+    @classmethod
+    def drop(cls, cart_id: str, product_id: int, amount: int) -> int:
+        """Remove up to the amount from the cart hold of the product, return the removed amount"""
+        reservation = cls.query.filter_by(cart_id=cart_id, product_id=product_id).with_for_update().first()
+        if reservation is None:
+            commit()
+            return 0
+
+        dropped = min(amount, reservation.amount)
+        if dropped == reservation.amount:
+            db.session.delete(reservation)
+        else:
+            reservation.amount -= dropped
+        commit()
+        return dropped
+
+    @classmethod
+    def release_cart(cls, cart_id: str) -> int:
+        """Return the stock of all holds of the cart to the products in one transaction, return released units"""
+        rows = db.session.query(cls.id, cls.product_id, cls.amount).filter_by(
+            cart_id=cart_id,
+        ).order_by(cls.product_id).with_for_update().all()
+        released = cls._release(rows)
+        db.session.commit()
+        return released
+
+    @classmethod
+    def touch(cls, cart_id: str, ttl: int) -> None:
+        now = datetime.utcnow()
+        cls.query.filter(cls.cart_id == cart_id, cls.expires_at > now).update(
+            {cls.expires_at: now + timedelta(seconds=ttl)},
+            synchronize_session=False,
+        )
+        commit()
+
+    @classmethod
+    def get_held(cls, cart_id: str) -> Dict[int, int]:
+        """Return amounts held by the unexpired holds of the cart per product"""
+        return dict(db.session.query(cls.product_id, cls.amount).filter(
+            cls.cart_id == cart_id,
+            cls.expires_at > datetime.utcnow(),
+        ).all())
+
+    @classmethod
+    def _release(cls, rows) -> int:
+        """Return the stock of the (id, product_id, amount) holds with one UPDATE of the products and delete them"""
+        if not rows:
+            return 0
+
+        ids = [row.id for row in rows]
+        held_amount = select(func.sum(cls.amount)).where(
+            cls.id.in_(ids),
+            cls.product_id == ProductModel.id,
+        ).scalar_subquery()
+
+        ProductModel.query.filter(ProductModel.id.in_({row.product_id for row in rows})).update(
+            {ProductModel.reserved: case(
+                (ProductModel.reserved >= held_amount, ProductModel.reserved - held_amount),
+                else_=0,
+            )},
+            synchronize_session=False,
+        )
+        cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+
+        released = Counter()
+        for row in rows:
+            released[row.product_id] -= row.amount
+        ProductModel.track_stock(released)
+        return sum(row.amount for row in rows)
+
+    @classmethod
+    def release_expired(cls, batch_size: int = 500, cart_id: Optional[str] = None) -> int:
+        """
+        Return the stock of expired holds to the products and delete the holds, one batch
+        per transaction or all in the unit of work. Return the number of released units
+        """
+        now = datetime.utcnow()
+        released = 0
+
+        while True:
+            query = db.session.query(cls.id, cls.product_id, cls.amount).filter(cls.expires_at <= now)
+            if cart_id is not None:
+                query = query.filter(cls.cart_id == cart_id)
+            rows = query.order_by(cls.expires_at).limit(batch_size).with_for_update(skip_locked=True).all()
+            if not rows:
+                commit()
+                break
+
+            released += cls._release(rows)
+            commit()
+            if len(rows) < batch_size:
+                break
+
+        after_commit(partial(reservation_metrics.update, reclaimed_units=released))
+        return released
+
+
+def get_reservation_metrics() -> Dict[str, int]:
+    """
+    Units held by carts, expired holds waiting for the sweeper, units reclaimed by this process
+    and leaked units: product reservations which are neither held by a cart nor by an open order
+    """
+    now = datetime.utcnow()
+    held, expired = db.session.query(
+        func.coalesce(func.sum(case((CartReservationModel.expires_at > now, CartReservationModel.amount))), 0),
+        func.coalesce(func.sum(case((CartReservationModel.expires_at <= now, CartReservationModel.amount))), 0),
+    ).one()
+    reserved = db.session.query(func.coalesce(func.sum(ProductModel.reserved), 0)).scalar()
+    ordered = db.session.query(func.coalesce(func.sum(OrderProductModel.amount), 0)).join(
+        OrderModel, OrderModel.id == OrderProductModel.order_id,
+    ).filter(OrderModel.is_completed.is_(False)).scalar()
+
+    return {
+        'held_units': held,
+        'expired_units': expired,
+        'reclaimed_units': reservation_metrics['reclaimed_units'],
+        'leaked_units': max(reserved - held - expired - ordered, 0),
+    }
+
+
+class ReservationSweeper:
+    """
+    Background thread releasing the expired holds every CART_SWEEP_INTERVAL seconds. Sweepers
+    of several processes skip the holds locked by each other, so every process may run one
+    """
+
+    def __init__(self):
+        self._thread = None
+
+    def init_app(self, app) -> None:
+        if not app.config['CART_SWEEPER_WORKER'] or self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, args=(app,), name='cart-sweeper', daemon=True)
+        self._thread.start()
+
+    def _run(self, app) -> None:
+        stop = threading.Event()
+        while not stop.wait(timeout=app.config['CART_SWEEP_INTERVAL']):
+            with app.app_context():
+                try:
+                    CartReservationModel.release_expired(batch_size=app.config['CART_SWEEP_BATCH_SIZE'])
+                except Exception:
+                    logger.exception('Releasing expired cart reservations failed')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+
+reservation_sweeper = ReservationSweeper()
+
+
+def start_reservation_sweeper(app):
+    reservation_sweeper.init_app(app)
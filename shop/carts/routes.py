@@ -2,9 +2,11 @@
 
 from flask import Blueprint
 
-from shop.carts.views import cart
+from shop.carts.views import add_items, cart
 
 carts_blueprint = Blueprint('carts_blueprint', __name__)
 
 carts_blueprint.add_url_rule('/cart',
                              view_func=cart, methods=['GET', 'POST'])
+carts_blueprint.add_url_rule('/cart/items',
+                             view_func=add_items, methods=['POST'])
@@ -1,68 +1,120 @@
-"""Module with a class for working with a cart stored in a session"""
+"""Module with a class for working with a cart of the current session"""
 
-from flask import session
+import hashlib
+import json
+from typing import Dict, List
+
+from flask import current_app, session
 from flask_login import current_user
+from sqlalchemy.exc import SQLAlchemyError
 
-from shop.orders.models import OrderModel
+from shop.carts.models import CartReservationModel
+from shop.carts.stores import CART_STORES, CookieCartStore
+from shop.db import after_commit, db, unit_of_work
+from shop.orders.models import OrderModel, OrderProductModel
 from shop.products.models import ProductModel
 
 
 class SessionCart:
-    """Class for working with cart stored in a session"""
+    """Class for working with cart of the current session kept by the configured cart store"""
+
+    CART_NAME = CookieCartStore.CART_NAME
+    SUMMARY_NAME = 'cart_summary'
+
+    @classmethod
+    def get_store(cls):
+        return CART_STORES[current_app.config['CART_STORE']]
 
-    CART_NAME = 'cart'
+    @classmethod
+    def get_cart(cls) -> Dict[str, int]:
+        return cls.get_store().get_items()
 
     @classmethod
     def init_cart(cls):
-        session[cls.CART_NAME] = dict()
+        cls.get_store().init()
+        session.pop(cls.SUMMARY_NAME, None)
+
+    @classmethod
+    def get_cart_id(cls) -> str:
+        return cls.get_store().get_cart_id()
+
+    @classmethod
+    def flush(cls):
+        cls.get_store().flush()
+
+    @classmethod
+    def close_cart(cls):
+        """Release the cart when the session ends unless the store keeps it for the next one"""
+        if not cls.get_store().persistent:
+            cls.clear_cart()
 
     @classmethod
     def is_empty(cls):
-        return session[cls.CART_NAME] == dict()
+        return cls.get_cart() == dict()
 
     @classmethod
     def add_product(cls, product_id: int, amount: int = 1):
-        product = ProductModel.get(id=product_id)
-        product_id = str(product_id)
-
+        """Reserve and hold the amount of the product in one transaction and add it to the cart"""
         if amount <= 0:
             raise ValueError('The amount to add cannot be negative')
-        if amount > product.available:
+        if cls.add_products({int(product_id): amount}):
             raise ValueError('Not enough product to add')
 
-        if product_id in session[cls.CART_NAME]:
-            session[cls.CART_NAME][product_id] += amount
-        else:
-            session[cls.CART_NAME][product_id] = amount
+    @classmethod
+    def add_products(cls, amounts: Dict[int, int]) -> List[int]:
+        """
+        Reserve and add all the amounts of the products in one transaction. Nothing is added
+        if some of the products lack stock, ids of such products are returned then
+        """
+        if any(amount <= 0 for amount in amounts.values()):
+            raise ValueError('The amount to add cannot be negative')
 
-        product.reserved += amount
-        product.save()
-        session.modified = True
+        try:
+            failed = ProductModel.reserve_all(amounts)
+            if failed:
+                db.session.rollback()
+                return failed
+            CartReservationModel.hold_all(cls.get_cart_id(), amounts, current_app.config['CART_RESERVATION_TTL'])
+            db.session.commit()
+        except SQLAlchemyError as err:
+            db.session.rollback()
+            raise err
+
+        cart = cls.get_cart()
+        for product_id, amount in amounts.items():
+            cart[str(product_id)] = cart.get(str(product_id), 0) + amount
+        cls.get_store().mark_modified()
+        cls.refresh_summary()
+        return []
 
     @classmethod
     def remove_product(cls, product_id: int, amount: int = 1):
-        product = ProductModel.get(id=product_id)
         product_id = str(product_id)
 
         if amount <= 0:
             raise ValueError('The amount to remove cannot be negative')
-        if product_id not in session[cls.CART_NAME]:
+        if product_id not in cls.get_cart():
             raise ValueError('Product not in cart')
 
-        if session[cls.CART_NAME][product_id] < amount:
+        if cls.get_cart()[product_id] < amount:
             raise ValueError('Not enough product in cart to remove')
-        elif session[cls.CART_NAME][product_id] == amount:
-            session[cls.CART_NAME].pop(product_id)
-        else:
-            session[cls.CART_NAME][product_id] -= amount
 
-        product.reserved -= amount
-        product.save()
-        session.modified = True
+        # The hold is dropped and its stock released in one transaction, so a failure cannot leak the stock
+        with unit_of_work():
+            released = CartReservationModel.drop(cls.get_cart_id(), int(product_id), amount)
+            if released:
+                ProductModel.release(int(product_id), released)
+
+        if cls.get_cart()[product_id] == amount:
+            cls.get_cart().pop(product_id)
+        else:
+            cls.get_cart()[product_id] -= amount
+        cls.get_store().mark_modified()
+        cls.refresh_summary()
 
     @classmethod
     def update_product_amount(cls, product_id: int, amount: int):
-        amount_change = amount - session[cls.CART_NAME].get(str(product_id), 0)
+        amount_change = amount - cls.get_cart().get(str(product_id), 0)
 
         if amount_change < 0:
             amount_change = -amount_change
@@ -70,52 +122,126 @@ class SessionCart:
         elif amount_change > 0:
             cls.add_product(product_id, amount_change)
 
+    @classmethod
+    def _get_cart_digest(cls) -> str:
+        """Short digest of the cart items, telling whether the cart changed since the summary was built"""
+        items = json.dumps(sorted(cls.get_cart().items()))
+        return hashlib.blake2b(items.encode(), digest_size=8).hexdigest()
+
+    @classmethod
+    def _set_summary(cls, items: int, total: float) -> Dict:
+        """Keep the items count and the total with the cart digest, so the summary stays small with any cart"""
+        summary = {'items': items, 'total': round(total, 2), 'digest': cls._get_cart_digest()}
+        session[cls.SUMMARY_NAME] = summary
+        return summary
+
+    @classmethod
+    def refresh_summary(cls) -> Dict:
+        """Build the summary from the cart and the current prices with one query"""
+        cart = cls.get_cart()
+        prices = dict(db.session.query(ProductModel.id, ProductModel.discount_price).filter(
+            ProductModel.id.in_([int(product_id) for product_id in cart]),
+        ))
+        return cls._set_summary(
+            sum(cart.values()),
+            sum(prices.get(int(product_id), 0) * amount for product_id, amount in cart.items()),
+        )
+
+    @classmethod
+    def get_summary(cls) -> Dict:
+        """
+        Items count and total sum of the cart, kept in the session so reading them costs no queries.
+        The summary is built again when the cart was changed elsewhere, e.g. on another device
+        """
+        summary = session.get(cls.SUMMARY_NAME)
+        if summary is None or summary.get('digest') != cls._get_cart_digest():
+            return cls.refresh_summary()
+        return summary
+
     @classmethod
     def get_items_count(cls):
-        if cls.CART_NAME not in session:
+        if not cls.get_store().exists():
             return 0
-
-        amounts_sum = sum(session[cls.CART_NAME].values())
-        return amounts_sum
+        return cls.get_summary()['items']
 
     @classmethod
     def get_total_sum(cls):
-        if cls.CART_NAME not in session:
+        if not cls.get_store().exists():
             return 0
-
-        items = cls.get_items()
-        total_sum = sum(pr.discount_price * amount for pr, amount in items)
-        return round(total_sum, 2)
+        return cls.get_summary()['total']
 
     @classmethod
     def get_products(cls):
-        ids = session[cls.CART_NAME].keys()
+        ids = cls.get_cart().keys()
         products = ProductModel.query.filter(ProductModel.id.in_(ids))
         return products
 
     @classmethod
     def get_items(cls):
         products = cls.get_products()
-        items = [(pr, session[cls.CART_NAME][str(pr.id)]) for pr in products.all()]
+        items = [(pr, cls.get_cart()[str(pr.id)]) for pr in products.all()]
         return items
 
     @classmethod
     def clear_cart(cls):
-        for product, amount in cls.get_items():
-            product.reserved -= amount
-            product.save()
-            session[cls.CART_NAME].pop(str(product.id))
+        CartReservationModel.release_cart(cls.get_cart_id())
 
-        session.modified = True
+        cls.get_cart().clear()
+        cls.get_store().mark_modified()
+        cls._set_summary(0, 0)
 
     @classmethod
-    def make_order(cls):
-        if not session[cls.CART_NAME]:
-            raise Exception('Unable to place an order from an empty cart')
-
-        order = OrderModel.create(user=current_user)
-        for product, amount in cls.get_items():
-            order.add_product(product, amount=amount)
-            session[cls.CART_NAME].pop(str(product.id))
+    def revalidate(cls) -> List[int]:
+        """
+        Hold again the products whose holds expired and extend the other holds in one transaction.
+        Products which can no longer be held are reduced to the held amount, their ids are returned
+        """
+        cart_id = cls.get_cart_id()
+        ttl = current_app.config['CART_RESERVATION_TTL']
+
+        changed = []
+        with unit_of_work():
+            CartReservationModel.release_expired(cart_id=cart_id)
+            CartReservationModel.touch(cart_id, ttl)
+            held = CartReservationModel.get_held(cart_id)
+
+            for product_id, amount in list(cls.get_cart().items()):
+                held_amount = held.get(int(product_id), 0)
+                missing = amount - held_amount
+                if missing <= 0:
+                    continue
+
+                if ProductModel.reserve(int(product_id), missing):
+                    CartReservationModel.hold(cart_id, int(product_id), missing, ttl)
+                    continue
+
+                if held_amount:
+                    cls.get_cart()[product_id] = held_amount
+                else:
+                    cls.get_cart().pop(product_id)
+                changed.append(int(product_id))
+
+        cls.get_store().mark_modified()
+        cls.refresh_summary()
+        return changed
 
-        session.modified = True
+    @classmethod
+    def make_order(cls) -> OrderModel:
+        """Revalidate the cart and place the order from it in a single transaction"""
+        with unit_of_work():
+            cls.revalidate()
+            if not cls.get_cart():
+                raise Exception('Unable to place an order from an empty cart')
+
+            items = cls.get_items()
+            order = OrderModel.add_with_products(current_user, items)
+            # Reserved stock is now held by the order until it is completed
+            CartReservationModel.query.filter_by(cart_id=cls.get_cart_id()).delete(synchronize_session=False)
+            after_commit(OrderModel.on_change)
+            after_commit(OrderProductModel.on_change)
+
+        for product, _ in items:
+            cls.get_cart().pop(str(product.id))
+        cls.get_store().mark_modified()
+        cls._set_summary(0, 0)
+        return order
@@ -0,0 +1,83 @@
+"""Module with storage backends of the cart items"""
+
+import secrets
+from typing import Dict
+
+from flask import g, session
+from flask_login import current_user
+
+from shop.carts.models import CartItemModel
+
+
+class CookieCartStore:
+    """Cart items kept in the signed cookie session"""
+
+    CART_NAME = 'cart'
+    CART_ID_NAME = 'cart_id'
+
+    # Cart does not outlive the session, so it is cleared on logout
+    persistent = False
+
+    def init(self) -> None:
+        session[self.CART_NAME] = dict()
+        session[self.CART_ID_NAME] = secrets.token_hex(16)
+
+    def exists(self) -> bool:
+        return self.CART_NAME in session
+
+    def get_cart_id(self) -> str:
+        if self.CART_ID_NAME not in session:
+            session[self.CART_ID_NAME] = secrets.token_hex(16)
+        return session[self.CART_ID_NAME]
+
+    def get_items(self) -> Dict[str, int]:
+        return session[self.CART_NAME]
+
+    def mark_modified(self) -> None:
+        session.modified = True
+
+    def flush(self) -> None:
+        pass
+
+
+class DatabaseCartStore:
+    """
+    Cart items kept in the cart_items table per user, so the cart is shared by the user devices.
+    Items are loaded once per request and the changes are written together when the request ends
+    """
+
+    persistent = True
+
+    def init(self) -> None:
+        pass
+
+    def exists(self) -> bool:
+        return current_user.is_authenticated
+
+    def get_cart_id(self) -> str:
+        return f'user-{current_user.id}'
+
+    def _get_state(self):
+        carts = g.setdefault('_db_carts', {})
+        if current_user.id not in carts:
+            items = CartItemModel.get_items(current_user.id)
+            carts[current_user.id] = (items, dict(items))
+        return carts[current_user.id]
+
+    def get_items(self) -> Dict[str, int]:
+        items, _ = self._get_state()
+        return items
+
+    def mark_modified(self) -> None:
+        pass
+
+    def flush(self) -> None:
+        for user_id, (items, stored) in g.pop('_db_carts', {}).items():
+            if items != stored:
+                CartItemModel.write(user_id, items, stored)
+
+
+CART_STORES = {
+    'cookie': CookieCartStore(),
+    'database': DatabaseCartStore(),
+}
@@ -1,6 +1,9 @@
 """Module with carts blueprint and its routes"""
 
-from flask import abort, render_template
+from collections import Counter
+from typing import Optional
+
+from flask import abort, current_app, flash, jsonify, render_template, request
 from flask_login import current_user, login_required
 
 from shop.carts.forms import ClearCartForm, PlaceOrderForm, UpdateProductAmountForm
@@ -16,6 +19,9 @@ def cart():
     if current_user.is_superuser:
         return abort(403)
 
+    if SessionCart.revalidate():
+        flash('Some products in your cart are no longer available, their amount was reduced', 'warning')
+
     if clear_cart_form.validate_on_submit() and clear_cart_form.submit.data:
         SessionCart.clear_cart()
 
@@ -37,3 +43,42 @@ def cart():
         'place_order_form': place_order_form,
     }
     return render_template('carts/cart.html', **context)
+
+
+def _parse_items(payload) -> Optional[Counter]:
+    """Return amounts per product id from a list of {product_id, amount} items or None if it is invalid"""
+    if not isinstance(payload, dict) or not isinstance(payload.get('items'), list) or not payload['items']:
+        return None
+
+    amounts = Counter()
+    for item in payload['items']:
+        if not isinstance(item, dict):
+            return None
+        product_id, amount = item.get('product_id'), item.get('amount', 1)
+        if type(product_id) is not int or type(amount) is not int or amount <= 0:
+            return None
+        amounts[product_id] += amount
+
+    if len(amounts) > current_app.config['CART_MAX_BULK_ITEMS']:
+        return None
+    return amounts
+
+
+@login_required
+def add_items():
+    if current_user.is_superuser:
+        return abort(403)
+
+    # JSON content type can not be sent cross-site without a CORS preflight
+    if not request.is_json:
+        return jsonify(error='Expected a JSON body'), 415
+
+    amounts = _parse_items(request.get_json(silent=True))
+    if amounts is None:
+        return jsonify(error='Expected a list of items with integer product_id and positive amount'), 400
+
+    failed = SessionCart.add_products(dict(amounts))
+    if failed:
+        return jsonify(error='Not enough product to add', product_ids=failed), 409
+    summary = SessionCart.get_summary()
+    return jsonify(items=summary['items'], total=summary['total'])
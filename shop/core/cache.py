@@ -0,0 +1,102 @@
+"""Module with process-local caches"""
+
+from collections import OrderedDict
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional
+
+_caches = []
+
+
+class VersionedCache:
+    """
+    Process-local key-value cache with a version stamp which is bumped on every invalidation,
+    an optional time to live for the entries and an optional size, the oldest entries go first
+    """
+
+    def __init__(self, ttl: Optional[float] = None, maxsize: Optional[int] = None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.version = 0
+        self._lock = threading.Lock()
+        self._entries = {}
+        _caches.append(self)
+
+    def get_or_set(self, key: Hashable, factory: Callable[[], Any], ttl: Optional[float] = None) -> Any:
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            entry = self._entries.get(key)
+            version = self.version
+        if entry is not None and (ttl is None or time.monotonic() - entry[1] < ttl):
+            return entry[0]
+
+        value = factory()
+        with self._lock:
+            if version == self.version:
+                self._entries[key] = (value, time.monotonic())
+                while self.maxsize is not None and len(self._entries) > self.maxsize:
+                    del self._entries[next(iter(self._entries))]
+        return value
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.version += 1
+
+
+class LRUCache:
+    """Process-local cache bounded by the number of entries and their time to live, with hit/miss counters"""
+
+    def __init__(self, maxsize: int = 256, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        _caches.append(self)
+
+    def configure(self, maxsize: int, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._entries.clear()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] >= self.ttl:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+def clear_caches() -> None:
+    for cache in _caches:
+        cache.invalidate()
@@ -0,0 +1,97 @@
+"""Module with conditional GET (ETag / Last-Modified) and anonymous page caching support for views"""
+
+from datetime import datetime, timezone
+from functools import wraps
+import logging
+from typing import Callable, Optional, Tuple
+
+from flask import current_app, g, make_response, request, session
+from flask_login import current_user
+
+from shop.core.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+def _as_utc(moment: datetime) -> datetime:
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.replace(microsecond=0)
+
+
+def _is_not_modified(etag: str, last_modified: datetime) -> bool:
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None:
+        return last_modified <= _as_utc(request.if_modified_since)
+    return False
+
+
+def _normalized_args() -> tuple:
+    return tuple(sorted((arg, tuple(sorted(request.args.getlist(arg)))) for arg in request.args))
+
+
+def _log_cache_stats(page_cache: LRUCache) -> None:
+    stats = page_cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    if lookups % current_app.config['PAGE_CACHE_STATS_INTERVAL'] == 0:
+        logger.info(
+            'Page cache: hits=%d misses=%d hit_ratio=%.2f size=%d/%d',
+            stats['hits'], stats['misses'], stats['hits'] / lookups, stats['size'], page_cache.maxsize,
+        )
+
+
+def _cached_page_response(page_cache: LRUCache, etag: str, function, args, kwargs):
+    key = (request.path, _normalized_args(), etag)
+    body = page_cache.get(key)
+    _log_cache_stats(page_cache)
+    if body is not None:
+        response = current_app.response_class(body, mimetype='text/html')
+        response.headers['X-Page-Cache'] = 'HIT'
+        return response
+
+    response = make_response(function(*args, **kwargs))
+    # A page with a CSRF token of the session rendering it is not served to other sessions
+    csrf_token = g.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+    has_csrf_token = csrf_token is not None and csrf_token.encode() in response.get_data()
+    if response.status_code == 200 and not session.get('_flashes') and not has_csrf_token:
+        page_cache.set(key, response.get_data())
+    response.headers['X-Page-Cache'] = 'MISS'
+    return response
+
+
+def conditional_get(get_stamp: Callable[..., Optional[Tuple[str, datetime]]], page_cache: Optional[LRUCache] = None):
+    """
+    Answer anonymous GET requests with 304 Not Modified while the (etag, last modified)
+    stamp returned by `get_stamp` for the view arguments matches the client's cached copy.
+    Otherwise the page is served from `page_cache` if given, keyed by the path, query
+    arguments and the stamp, so the view itself runs only when the page has to be rendered again
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or current_user.is_authenticated or session.get('_flashes'):
+                return function(*args, **kwargs)
+
+            stamp = get_stamp(*args, **kwargs)
+            if stamp is None:
+                return function(*args, **kwargs)
+
+            etag, last_modified = stamp[0], _as_utc(stamp[1])
+            if _is_not_modified(etag, last_modified):
+                response = current_app.response_class(status=304)
+            elif page_cache is not None and current_app.config['PAGE_CACHE_ENABLED']:
+                response = _cached_page_response(page_cache, etag, function, args, kwargs)
+            else:
+                response = make_response(function(*args, **kwargs))
+
+            if response.status_code not in (200, 304):
+                return response
+
+            response.set_etag(etag)
+            response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
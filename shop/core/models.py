@@ -1,14 +1,32 @@
 """Module with base database model mixin"""
 
+from datetime import datetime
+from functools import partial
 import os
-from typing import List, Optional
+import random
+from typing import Hashable, List, Optional, Sequence, Tuple
 
-from flask import current_app
+from flask import current_app, g, has_app_context, has_request_context
 from flask_sqlalchemy import BaseQuery, Pagination
-from sqlalchemy import func
+from sqlalchemy import event, func
 from sqlalchemy.exc import IntegrityError
 
-from shop.db import db
+from shop.core.pagination import (
+    cached_count,
+    decode_cursor,
+    estimate_count,
+    invalidate_counts,
+    KeysetPagination
+)
+from shop.core.utils import file_remover
+from shop.db import after_commit, before_commit, commit, db, upsert
+
+# Attribute of flask.g with rows looked up by BaseModelMixin.get during the request
+REQUEST_LOOKUPS = '_model_lookups'
+
+# Random ids probed per wanted row and probing rounds before sample() falls back to sorting by random()
+SAMPLE_OVERSAMPLING = 2
+SAMPLE_ROUNDS = 3
 
 
 class BaseModelMixin(db.Model):
@@ -21,13 +39,24 @@ class BaseModelMixin(db.Model):
     def get_all(cls) -> List:
         return cls.query.all()
 
+    @classmethod
+    def on_write(cls) -> None:
+        """Hook called in the transaction changing the model rows, right before it is committed"""
+
+    @classmethod
+    def on_change(cls) -> None:
+        """Hook called after changes of the model rows were committed"""
+        invalidate_counts(cls.__tablename__)
+
     def save(self) -> None:
         try:
             db.session.add(self)
-            db.session.commit()
+            before_commit(self.on_write)
+            commit()
         except IntegrityError as err:
             db.session.rollback()
             raise err
+        after_commit(self.on_change)
 
     @classmethod
     def create(cls, **kwargs):
@@ -38,33 +67,97 @@ class BaseModelMixin(db.Model):
     def delete(self) -> None:
         try:
             db.session.delete(self)
-            db.session.commit()
+            before_commit(self.on_write)
+            commit()
         except IntegrityError as err:
             db.session.rollback()
             raise err
+        after_commit(self.on_change)
+
+    @classmethod
+    def delete_all(cls) -> int:
+        return cls.bulk_delete()
 
     @classmethod
-    def delete_all(cls):
-        for instance in cls.get_all():
-            instance.delete()
+    def bulk_delete(cls, *criteria) -> int:
+        """
+        Delete the rows matching the criteria with one DELETE and return their number.
+        Dependent rows are removed by the database cascades
+        """
+        try:
+            deleted = cls.query.filter(*criteria).delete(synchronize_session='fetch')
+            before_commit(cls.on_write)
+            commit()
+        except IntegrityError as err:
+            db.session.rollback()
+            raise err
+        after_commit(cls.on_change)
+        return deleted
 
     @classmethod
     def update(cls, _id, **kwargs) -> None:
         try:
             cls.query.filter_by(id=_id).update(kwargs)
-            db.session.commit()
+            before_commit(cls.on_write)
+            commit()
         except IntegrityError as err:
             db.session.rollback()
             raise err
+        after_commit(cls.on_change)
 
     @classmethod
     def get(cls, **kwargs):
+        """Return the first row with the field values, each lookup is queried once per request"""
+        lookups = _request_lookups()
+        key = _lookup_key(cls, kwargs)
+
+        if lookups is not None and key in lookups:
+            instance = lookups[key]
+            if instance is None or instance in db.session:
+                return instance
+
         instance = cls.query.filter_by(**kwargs).first()
+        if lookups is not None and key is not None:
+            lookups[key] = instance
         return instance
 
+    @classmethod
+    def exists(cls, **kwargs) -> bool:
+        """Check if a row with the field values exists with SELECT EXISTS, without loading it"""
+        return exist_all([(cls, kwargs)])[0]
+
     @classmethod
     def get_random(cls):
-        return cls.query.order_by(func.random()).first()
+        rows = cls.sample(1)
+        return rows[0] if rows else None
+
+    @classmethod
+    def sample(cls, k: int = 1, query: Optional[BaseQuery] = None) -> List:
+        """
+        Return up to k distinct random rows of the query. Random ids between the smallest and the largest
+        one are looked up by primary key, so the cost does not grow with the table. Queries matching
+        few of the ids fall back to ORDER BY random() for the missing rows
+        """
+        query = (cls.query if query is None else query).order_by(None)
+        low, high = query.with_entities(func.min(cls.id), func.max(cls.id)).one()
+        if low is None or k < 1:
+            return []
+
+        ids = range(low, high + 1)
+        found = {}
+        for _ in range(SAMPLE_ROUNDS):
+            wanted = k - len(found)
+            if wanted <= 0:
+                break
+            candidates = random.sample(ids, min(len(ids), wanted * SAMPLE_OVERSAMPLING))
+            for row in query.filter(cls.id.in_(candidates)):
+                found.setdefault(row.id, row)
+
+        rows = random.sample(list(found.values()), min(k, len(found)))
+        if len(rows) < k:
+            rows += query.filter(cls.id.notin_(list(found))).order_by(func.random()).limit(k - len(rows)).all()
+            random.shuffle(rows)
+        return rows
 
     @classmethod
     def get_or_create(cls, **kwargs):
@@ -79,15 +172,155 @@ class BaseModelMixin(db.Model):
         return cls.query.filter_by(**kwargs)
 
     @classmethod
-    def get_pagination(cls, page: int = 1, query: Optional[BaseQuery] = None, paginate_by: int = None) -> Pagination:
+    def get_pagination(cls, page: int = 1, query: Optional[BaseQuery] = None, paginate_by: int = None,
+                       count_mode: Optional[str] = None) -> Pagination:
+        """
+        Return a page of rows. The total is counted according to `count_mode`
+        ('exact', 'cached' or 'approximate', `PAGINATION_COUNT_MODE` setting by default)
+        """
+        if query is None:
+            query = cls.query
+        per_page = paginate_by or cls.PAGINATE_BY
+        count_mode = count_mode or current_app.config['PAGINATION_COUNT_MODE']
+
+        if count_mode == 'exact':
+            return query.paginate(page, per_page, False)
+
+        page = max(page, 1)
+        items = query.limit(per_page).offset((page - 1) * per_page).all()
+
+        total = estimate_count(query) if count_mode == 'approximate' else None
+        if total is None:
+            total = cached_count(
+                cls.__tablename__, query,
+                ttl=current_app.config['PAGINATION_COUNT_CACHE_TTL'],
+                maxsize=current_app.config['PAGINATION_COUNT_CACHE_SIZE'],
+            )
+        return Pagination(query, page, per_page, total, items)
+
+    @classmethod
+    def get_keyset_pagination(cls, cursor: Optional[str] = None, query: Optional[BaseQuery] = None,
+                              paginate_by: int = None, fields: Optional[Sequence[str]] = None,
+                              descending: bool = False) -> Optional[KeysetPagination]:
+        """Return a page of rows ordered by `fields` (`KEYSET_BY` by default) or None if the cursor is invalid"""
         if query is None:
             query = cls.query
-        return query.paginate(page, paginate_by or cls.PAGINATE_BY, False)
+        columns = [getattr(cls, field) for field in fields or cls.KEYSET_BY]
+
+        values, direction = None, 'next'
+        if cursor:
+            decoded = decode_cursor(cursor, columns)
+            if decoded is None:
+                return None
+            values, direction = decoded
+
+        return KeysetPagination(query, columns, paginate_by or cls.PAGINATE_BY, values, direction, descending)
 
     def as_dict(self):
         return {col.name: getattr(self, col.name) for col in self.__table__.columns}
 
 
+def _request_lookups() -> Optional[dict]:
+    return g.setdefault(REQUEST_LOOKUPS, {}) if has_request_context() else None
+
+
+def _lookup_key(model, kwargs: dict) -> Optional[Hashable]:
+    key = (model, tuple(sorted(kwargs.items())))
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def exist_all(lookups: Sequence[Tuple[type, dict]]) -> List[bool]:
+    """
+    Check if rows with the (model, field values) pairs exist with one SELECT of EXISTS columns.
+    Rows already looked up during the request are not queried again
+    """
+    cache = _request_lookups()
+    keys = [_lookup_key(model, kwargs) for model, kwargs in lookups]
+    results = {}
+    pending = {}
+
+    for index, (key, (model, kwargs)) in enumerate(zip(keys, lookups)):
+        if cache is not None and key in cache:
+            results[index] = cache[key] is not None
+        elif cache is not None and ('exists', key) in cache:
+            results[index] = cache[('exists', key)]
+        else:
+            pending.setdefault(key if key is not None else ('unhashable', index), []).append(index)
+
+    if pending:
+        queries = [lookups[indexes[0]] for indexes in pending.values()]
+        row = db.session.query(*[model.query.filter_by(**kwargs).exists() for model, kwargs in queries]).one()
+        for (key, indexes), exists in zip(pending.items(), row):
+            results.update(dict.fromkeys(indexes, bool(exists)))
+            if cache is not None and keys[indexes[0]] is not None:
+                cache[('exists', key)] = bool(exists)
+
+    return [results[index] for index in range(len(lookups))]
+
+
+def clear_request_lookups(*args) -> None:
+    if has_app_context():
+        g.pop(REQUEST_LOOKUPS, None)
+
+
+# Rows may be created, changed or deleted by these, so looked up rows and misses are forgotten
+for _event_name in ('after_flush', 'after_bulk_update', 'after_bulk_delete', 'after_rollback'):
+    event.listen(db.session, _event_name, clear_request_lookups)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_changed_tables(session, flush_context) -> None:
+    changed_tables = session.info.setdefault('changed_tables', set())
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        changed_tables.add(instance.__table__.name)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_changed_tables_counts(session) -> None:
+    invalidate_counts(*session.info.pop('changed_tables', ()))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_changed_tables(session) -> None:
+    session.info.pop('changed_tables', None)
+
+
+class VersionStampModel(BaseModelMixin):
+    """Named version counter bumped on every change of the data it stands for"""
+
+    __tablename__ = 'version_stamps'
+
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @classmethod
+    def bump(cls, *names: str) -> None:
+        """
+        Increment the stamps in the current transaction, so they are committed with the changes they stand for.
+        Stamps are created by the same statement on their first bump, concurrent bumps cannot fail on that
+        """
+        table = cls.__table__
+        db.session.execute(
+            upsert(table, ['name'], lambda excluded: {
+                'version': table.c.version + 1,
+                'updated_at': excluded.updated_at,
+            }),
+            [{'name': name, 'version': 1, 'updated_at': datetime.utcnow()} for name in names],
+        )
+
+    @classmethod
+    def get_stamp(cls, name: str) -> Tuple[int, datetime]:
+        stamp = db.session.query(cls.version, cls.updated_at).filter_by(name=name).first()
+        if stamp is None:
+            return 0, datetime(1970, 1, 1)
+        return stamp.version, stamp.updated_at
+
+
 class PictureHandleMixin:
     def update_image_file(self, new_image_file: str) -> None:
         if self.image_file != new_image_file:
@@ -107,3 +340,20 @@ class PictureHandleMixin:
     def delete(self) -> None:
         self._delete_image_file()
         return super().delete()
+
+    @classmethod
+    def bulk_delete(cls, *criteria) -> int:
+        """Delete the rows, their image files are removed in the background after the commit"""
+        image_files = [
+            image_file for image_file, in db.session.query(cls.image_file).filter(
+                *criteria,
+                cls.image_file != cls.DEFAULT_IMAGE,
+            )
+        ]
+        deleted = super().bulk_delete(*criteria)
+
+        if image_files:
+            static_path = os.path.join(current_app.root_path, 'static')
+            paths = [os.path.join(static_path, image_file) for image_file in image_files]
+            after_commit(partial(file_remover.remove, paths))
+        return deleted
@@ -0,0 +1,156 @@
+"""Module with keyset (seek) pagination for ordered queries"""
+
+import base64
+import binascii
+import json
+from typing import Dict, Hashable, Optional, Sequence
+
+from flask_sqlalchemy import BaseQuery
+from sqlalchemy import tuple_
+from sqlalchemy.exc import SQLAlchemyError
+
+from shop.core.cache import VersionedCache
+from shop.db import db
+
+# Cached row counts of the paginated queries, one cache per table the query selects from
+count_caches: Dict[str, VersionedCache] = {}
+
+
+def encode_cursor(values: Sequence, direction: str) -> str:
+    payload = json.dumps({'k': list(values), 'd': direction}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def _fits_column(value, column) -> bool:
+    """Tell if the cursor value can be compared with the column without a database type error"""
+    if value is None:
+        return getattr(column.expression, 'nullable', True)
+    if isinstance(value, (list, dict)):
+        return False
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return True
+    if python_type is float:
+        python_type = (int, float)
+    return isinstance(value, python_type) and (python_type is bool or not isinstance(value, bool))
+
+
+def decode_cursor(cursor: str, columns: Sequence) -> Optional[tuple]:
+    """
+    Return (values, direction) from an opaque cursor or None if the cursor is malformed
+    or its values do not match the keyset columns
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(cursor + padding).decode('utf-8'))
+        values, direction = payload['k'], payload['d']
+    except (binascii.Error, ValueError, UnicodeDecodeError, TypeError, KeyError):
+        return None
+
+    if direction not in ('next', 'prev') or not isinstance(values, list) or len(values) != len(columns):
+        return None
+    if not all(_fits_column(value, column) for value, column in zip(values, columns)):
+        return None
+    return values, direction
+
+
+def _query_key(query: BaseQuery) -> Hashable:
+    compiled = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'render_postcompile': True})
+    params = tuple(sorted(
+        (name, tuple(value) if isinstance(value, list) else value) for name, value in compiled.params.items()
+    ))
+    return str(compiled), params
+
+
+def cached_count(table_name: str, query: BaseQuery, ttl: Optional[float] = None, maxsize: Optional[int] = None) -> int:
+    """Count query rows once per filter set until the table is changed, keeping up to `maxsize` counts per table"""
+    cache = count_caches.get(table_name)
+    if cache is None:
+        cache = count_caches.setdefault(table_name, VersionedCache(maxsize=maxsize))
+
+    query = query.order_by(None)
+    return cache.get_or_set(_query_key(query), query.count, ttl=ttl)
+
+
+def invalidate_counts(*table_names: str) -> None:
+    for table_name in table_names:
+        if table_name in count_caches:
+            count_caches[table_name].invalidate()
+
+
+def estimate_count(query: BaseQuery) -> Optional[int]:
+    """Return the planner estimate of the query rows on PostgreSQL or None elsewhere"""
+    if db.engine.dialect.name != 'postgresql':
+        return None
+
+    compiled = query.order_by(None).statement.compile(
+        dialect=db.engine.dialect,
+        compile_kwargs={'render_postcompile': True},
+    )
+    # A failed EXPLAIN is rolled back to the savepoint, so it does not abort the request transaction
+    try:
+        with db.session.begin_nested():
+            plan = db.session.connection().exec_driver_sql(
+                'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params,
+            ).scalar()
+    except SQLAlchemyError:
+        return None
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class KeysetPagination:
+    """
+    Pagination which seeks by the last seen sort key instead of using OFFSET,
+    so every page costs the same single indexed range query regardless of depth
+    """
+
+    is_keyset = True
+
+    def __init__(self, query: BaseQuery, columns: Sequence, per_page: int,
+                 values: Optional[Sequence] = None, direction: str = 'next', descending: bool = False):
+        self.columns = columns
+        self.per_page = per_page
+        self.direction = direction
+
+        # Seeking backwards over an ascending order is seeking forward over the descending one
+        seek_descending = descending != (direction == 'prev')
+
+        query = query.order_by(None)
+        if values is not None:
+            key, boundary = tuple_(*columns), tuple_(*values)
+            query = query.filter(key < boundary if seek_descending else key > boundary)
+
+        if seek_descending:
+            query = query.order_by(*[column.desc() for column in columns])
+        else:
+            query = query.order_by(*columns)
+
+        items = query.limit(per_page + 1).all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+
+        if direction == 'next':
+            self.has_prev = values is not None
+            self.has_next = has_more
+        else:
+            items.reverse()
+            self.has_prev = has_more
+            self.has_next = True
+
+        self.items = items
+
+    def _item_key(self, item) -> list:
+        return [getattr(item, column.key) for column in self.columns]
+
+    @property
+    def next_cursor(self) -> Optional[str]:
+        if not self.has_next or not self.items:
+            return None
+        return encode_cursor(self._item_key(self.items[-1]), 'next')
+
+    @property
+    def prev_cursor(self) -> Optional[str]:
+        if not self.has_prev or not self.items:
+            return None
+        return encode_cursor(self._item_key(self.items[0]), 'prev')
@@ -1,12 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
 import os
 from random import randint
 import secrets
+from typing import Iterable
 
 from flask import current_app
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from itsdangerous.exc import BadSignature
 from PIL import Image
 
+logger = logging.getLogger(__name__)
+
 
 def get_random_color():
     return randint(0, 255), randint(0, 255), randint(0, 255)
@@ -25,6 +30,33 @@ def create_random_image(save_path: str, size: tuple):
     image.save(save_path)
 
 
+class FileRemover:
+    """Removes files on one background thread, so bulk deletes do not wait for the file system"""
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='file-remover')
+
+    def remove(self, paths: Iterable[str]) -> None:
+        self._executor.submit(self._remove_all, list(paths))
+
+    def wait(self) -> None:
+        """Block until the files queued so far are removed"""
+        self._executor.submit(lambda: None).result()
+
+    @staticmethod
+    def _remove_all(paths) -> None:
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logger.exception('Could not remove %s', path)
+
+
+file_remover = FileRemover()
+
+
 def save_picture(form_picture, model) -> str:
     save_filename = make_random_filename(form_picture.filename, model.IMAGE_DIR)
     picture_path = os.path.join(current_app.root_path, 'static', save_filename)
@@ -2,56 +2,59 @@
 
 from wtforms.validators import ValidationError
 
+from shop.core.models import exist_all
 from shop.orders.models import OrderModel
 from shop.products.models import BrandModel, CategoryModel, ProductModel
 from shop.users.models import UserModel
 
 
+class ExistenceValidator:
+    """
+    Validator checking if a row with the field value exists or not. The first of these validators
+    run for a form checks the values of all its fields in one query, the others reuse the answers
+    """
+
+    def __init__(self, model, model_name: str, db_field: str, must_exist: bool = True, error_msg: str = None):
+        self.model = model
+        self.model_name = model_name
+        self.db_field = db_field
+        self.must_exist = must_exist
+        self.error_msg = error_msg
+
+    def lookup(self, field) -> tuple:
+        return self.model, {self.db_field: field.data}
+
+    @staticmethod
+    def form_lookups(form) -> list:
+        return [
+            validator.lookup(field)
+            for field in form if field.data is not None
+            for validator in field.validators if isinstance(validator, ExistenceValidator)
+        ]
+
+    def __call__(self, form, field):
+        exists = exist_all([self.lookup(field), *self.form_lookups(form)])[0]
+        if not exists and self.must_exist:
+            raise ValidationError(self.error_msg or f'{self.model_name} with such {self.db_field} not exists.')
+        if exists and not self.must_exist:
+            raise ValidationError(self.error_msg or f'{self.model_name} with such {self.db_field} already exists.')
+
+
 def user_validator(db_field, must_exist=True, error_msg=None):
-    def _user_validator(_, field):
-        product = UserModel.get(**{db_field: field.data})
-        if product is None and must_exist:
-            raise ValidationError(error_msg or f'User with such {db_field} not exists.')
-        if product is not None and not must_exist:
-            raise ValidationError(error_msg or f'User with such {db_field} already exists.')
-    return _user_validator
+    return ExistenceValidator(UserModel, 'User', db_field, must_exist, error_msg)
 
 
 def product_validator(db_field, must_exist=True, error_msg=None):
-    def _product_validator(_, field):
-        product = ProductModel.get(**{db_field: field.data})
-        if product is None and must_exist:
-            raise ValidationError(error_msg or f'Product with such {db_field} not exists.')
-        if product is not None and not must_exist:
-            raise ValidationError(error_msg or f'Product with such {db_field} already exists.')
-    return _product_validator
+    return ExistenceValidator(ProductModel, 'Product', db_field, must_exist, error_msg)
 
 
 def brand_validator(db_field, must_exist=True, error_msg=None):
-    def _brand_validator(_, field):
-        brand = BrandModel.get(**{db_field: field.data})
-        if brand is None and must_exist:
-            raise ValidationError(error_msg or f'Brand with such {db_field} not exists.')
-        if brand is not None and not must_exist:
-            raise ValidationError(error_msg or f'Brand with such {db_field} already exists.')
-    return _brand_validator
+    return ExistenceValidator(BrandModel, 'Brand', db_field, must_exist, error_msg)
 
 
 def category_validator(db_field, must_exist=True, error_msg=None):
-    def _category_validator(_, field):
-        category = CategoryModel.get(**{db_field: field.data})
-        if category is None and must_exist:
-            raise ValidationError(error_msg or f'Category with such {db_field} not exists.')
-        if category is not None and not must_exist:
-            raise ValidationError(error_msg or f'Category with such {db_field} already exists.')
-    return _category_validator
+    return ExistenceValidator(CategoryModel, 'Category', db_field, must_exist, error_msg)
 
 
 def order_validator(db_field, must_exist=True, error_msg=None):
-    def _order_validator(_, field):
-        product = OrderModel.get(**{db_field: field.data})
-        if product is None and must_exist:
-            raise ValidationError(error_msg or f'Order with such {db_field} not exists.')
-        if product is not None and not must_exist:
-            raise ValidationError(error_msg or f'Order with such {db_field} already exists.')
-    return _order_validator
+    return ExistenceValidator(OrderModel, 'Order', db_field, must_exist, error_msg)
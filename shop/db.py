@@ -1,11 +1,122 @@
-"""Module with database entity and initialization function"""
+"""Module with database entity, initialization function and unit of work"""
+
+from contextlib import contextmanager
+import sqlite3
+from typing import Callable, List, Sequence
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
 
 db = SQLAlchemy()
 
+# Session info keys holding the callbacks deferred until the unit of work is committed
+# and the ones deferred until right before it is committed
+UNIT_OF_WORK = 'unit_of_work'
+UNIT_OF_WORK_PRECOMMIT = 'unit_of_work_precommit'
+
+
+@event.listens_for(Engine, 'connect')
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record) -> None:
+    """SQLite ignores foreign keys and their ON DELETE cascades unless they are enabled per connection"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
 
 def init_database(app):
     db.init_app(app)
     db.create_all()
     db.session.commit()
+
+
+def add_missing_columns(model) -> List[str]:
+    """
+    Add the columns of the model missing from its existing table, as create_all only creates
+    missing tables. The columns get their scalar default for the existing rows. Return their names
+    """
+    table = model.__table__
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    preparer = db.engine.dialect.identifier_preparer
+
+    added = []
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        ddl = f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} '
+        ddl += column.type.compile(dialect=db.engine.dialect)
+        if column.default is not None and column.default.is_scalar:
+            ddl += f' DEFAULT {column.default.arg!r}'
+        if not column.nullable:
+            ddl += ' NOT NULL'
+        db.session.execute(text(ddl))
+        added.append(column.name)
+    return added
+
+
+def in_unit_of_work() -> bool:
+    return UNIT_OF_WORK in db.session.info
+
+
+@contextmanager
+def unit_of_work():
+    """
+    Collect the changes of the model helpers called inside into one transaction, committed once on exit
+    and rolled back on error. Nested units join the outermost one
+    """
+    if in_unit_of_work():
+        yield
+        return
+
+    db.session.info[UNIT_OF_WORK] = []
+    db.session.info[UNIT_OF_WORK_PRECOMMIT] = []
+    try:
+        yield
+        for callback in dict.fromkeys(db.session.info[UNIT_OF_WORK_PRECOMMIT]):
+            callback()
+        db.session.commit()
+    except BaseException:
+        db.session.rollback()
+        raise
+    finally:
+        callbacks = db.session.info.pop(UNIT_OF_WORK)
+        db.session.info.pop(UNIT_OF_WORK_PRECOMMIT)
+
+    for callback in dict.fromkeys(callbacks):
+        callback()
+
+
+def commit() -> None:
+    """Commit the session, or only flush it inside a unit of work"""
+    if in_unit_of_work():
+        db.session.flush()
+    else:
+        db.session.commit()
+
+
+def before_commit(callback: Callable[[], None]) -> None:
+    """Call the callback now, or once in the transaction of the unit of work right before it is committed"""
+    if in_unit_of_work():
+        db.session.info[UNIT_OF_WORK_PRECOMMIT].append(callback)
+    else:
+        callback()
+
+
+def after_commit(callback: Callable[[], None]) -> None:
+    """Call the callback now, or once after the unit of work is committed"""
+    if in_unit_of_work():
+        db.session.info[UNIT_OF_WORK].append(callback)
+    else:
+        callback()
+
+
+def upsert(table, keys: Sequence[str], update: Callable):
+    """
+    INSERT statement for the table updating the rows whose keys already exist instead of failing,
+    `update` receives the rejected row as `excluded` and returns the values to set
+    """
+    dialect = postgresql if db.engine.dialect.name == 'postgresql' else sqlite
+    statement = dialect.insert(table)
+    return statement.on_conflict_do_update(index_elements=keys, set_=update(statement.excluded))
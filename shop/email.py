@@ -1,23 +1,156 @@
-"""Module with mail entity and initialization and sending email functions"""
+"""Module with mail entity and initialization, the outbox of emails and its background sender"""
+
+from datetime import datetime, timedelta
+import logging
+import smtplib
+import threading
+from typing import Optional
 
 from flask import current_app, render_template, url_for
 from flask_mail import Mail, Message
 
+from shop.core.models import BaseModelMixin
+from shop.db import after_commit, db
+
+logger = logging.getLogger(__name__)
+
 mail = Mail()
 
 
+class OutboxMessageModel(BaseModelMixin):
+    """Email waiting for delivery, kept after it is sent or given up on"""
+
+    __tablename__ = 'email_outbox'
+
+    id = db.Column(db.Integer, primary_key=True)
+    recipients = db.Column(db.Text, nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # Null once the message is sent or out of attempts
+    next_attempt_at = db.Column(db.DateTime, index=True)
+    sent_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    def to_message(self) -> Message:
+        return Message(
+            self.subject,
+            sender=current_app.config['MAIL_USERNAME'],
+            recipients=self.recipients.split(','),
+            html=self.html,
+        )
+
+
+class OutboxSender:
+    """
+    Background thread delivering the outbox of the application, woken up by every new message
+    and every MAIL_OUTBOX_POLL_INTERVAL seconds for the retries
+    """
+
+    def __init__(self):
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def init_app(self, app) -> None:
+        if not app.config['MAIL_OUTBOX_WORKER'] or self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, args=(app,), name='mail-outbox', daemon=True)
+        self._thread.start()
+
+    def notify(self) -> None:
+        self._wakeup.set()
+
+    def _run(self, app) -> None:
+        batch_size = app.config['MAIL_OUTBOX_BATCH_SIZE']
+        while True:
+            self._wakeup.wait(timeout=app.config['MAIL_OUTBOX_POLL_INTERVAL'])
+            self._wakeup.clear()
+            with app.app_context():
+                try:
+                    while deliver_outbox(batch_size) == batch_size:
+                        pass
+                except Exception:
+                    logger.exception('Outbox delivery failed')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+
+
+outbox_sender = OutboxSender()
+
+
 def init_mail(app):
     mail.init_app(app)
 
 
+def start_outbox_sender(app):
+    outbox_sender.init_app(app)
+
+
 def send_mail(send_to: list, subject: str, html: str):
-    msg = Message(
-        subject,
-        sender=current_app.config['MAIL_USERNAME'],
-        recipients=send_to,
+    """Put the email into the outbox, it is delivered by the outbox sender"""
+    OutboxMessageModel.create(
+        recipients=','.join(send_to),
+        subject=subject,
+        html=html,
+        next_attempt_at=datetime.utcnow(),
     )
-    msg.html = html
-    mail.send(msg)
+    after_commit(outbox_sender.notify)
+
+
+def _retry_delay(attempts: int) -> Optional[timedelta]:
+    """Exponential backoff after the failed attempt or None when the message is given up on"""
+    if attempts >= current_app.config['MAIL_OUTBOX_MAX_ATTEMPTS']:
+        return None
+    return timedelta(seconds=current_app.config['MAIL_OUTBOX_RETRY_DELAY'] * 2 ** (attempts - 1))
+
+
+def _mark_failed(message: OutboxMessageModel, error: Exception, now: datetime) -> None:
+    message.attempts += 1
+    message.last_error = repr(error)
+    delay = _retry_delay(message.attempts)
+    message.next_attempt_at = now + delay if delay is not None else None
+    if delay is None:
+        logger.error('Giving up on email %s to %s: %r', message.id, message.recipients, error)
+
+
+def deliver_outbox(batch_size: int = 50) -> int:
+    """
+    Send one batch of due messages over a single SMTP connection and commit the outcome,
+    return the number of messages taken from the outbox
+    """
+    now = datetime.utcnow()
+    messages = OutboxMessageModel.query.filter(
+        OutboxMessageModel.next_attempt_at <= now,
+    ).order_by(
+        OutboxMessageModel.next_attempt_at,
+    ).limit(batch_size).with_for_update(skip_locked=True).all()
+    if not messages:
+        db.session.commit()
+        return 0
+
+    pending = list(messages)
+    try:
+        with mail.connect() as connection:
+            while pending:
+                message = pending[0]
+                try:
+                    connection.send(message.to_message())
+                except smtplib.SMTPRecipientsRefused as error:
+                    # Only this message is rejected, the connection is still usable
+                    _mark_failed(message, error, now)
+                else:
+                    message.sent_at = datetime.utcnow()
+                    message.next_attempt_at = None
+                pending.pop(0)
+    except (smtplib.SMTPException, OSError) as error:
+        # The connection is lost, messages which were not sent are retried later
+        for message in pending:
+            _mark_failed(message, error, now)
+
+    db.session.commit()
+    return len(messages)
 
 
 def send_token_url_mail(email, subject, token, url, template):
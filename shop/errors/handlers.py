@@ -1,5 +1,7 @@
 from flask import Blueprint, render_template
 
+from shop.bcrypt import HashingPoolBusy
+
 errors_blueprint = Blueprint('errors', __name__)
 
 
@@ -11,3 +13,8 @@ def error_404(error):
 @errors_blueprint.app_errorhandler(403)
 def error_403(error):
     return render_template('errors/403.html'), 403
+
+
+@errors_blueprint.app_errorhandler(HashingPoolBusy)
+def error_hashing_pool_busy(error):
+    return render_template('errors/503.html'), 503
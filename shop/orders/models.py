@@ -1,13 +1,15 @@
 """Models for orders blueprint"""
 
 from datetime import datetime
+from typing import List, Tuple
 
-from sqlalchemy import CheckConstraint
+from sqlalchemy import CheckConstraint, func, select
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import backref
 
 from shop.core.models import BaseModelMixin
 from shop.db import db
-from shop.products.models import ProductModel
+from shop.products.models import discounted_price, discounted_price_expression, ProductModel
 
 
 class OrderProductModel(BaseModelMixin):
@@ -28,6 +30,10 @@ class OrderProductModel(BaseModelMixin):
     )
     amount = db.Column(db.Integer, default=1)
 
+    # Product price and discount at the time of checkout
+    price = db.Column(db.Float, nullable=False, default=0)
+    discount = db.Column(db.Integer, nullable=False, default=0)
+
     product = db.relationship(
         'ProductModel',
         primaryjoin=product_id == ProductModel.id,
@@ -37,6 +43,29 @@ class OrderProductModel(BaseModelMixin):
         CheckConstraint('0 < amount'),
     )
 
+    @hybrid_property
+    def discount_price(self) -> float:
+        return discounted_price(self.price, self.discount)
+
+    @discount_price.expression
+    def discount_price(cls):
+        return discounted_price_expression(cls.price, cls.discount)
+
+    @classmethod
+    def backfill_prices(cls) -> int:
+        """
+        Fill the price and discount of the lines stored before they were kept, from the current
+        product values which are the best estimate left. Return the number of filled lines
+        """
+        product = select(ProductModel.price, ProductModel.discount).where(ProductModel.id == cls.product_id)
+        return cls.query.filter(cls.price == 0).update(
+            {
+                cls.price: product.with_only_columns(ProductModel.price).scalar_subquery(),
+                cls.discount: product.with_only_columns(ProductModel.discount).scalar_subquery(),
+            },
+            synchronize_session=False,
+        )
+
 
 class OrderModel(BaseModelMixin):
     """Entity Order Model"""
@@ -49,8 +78,12 @@ class OrderModel(BaseModelMixin):
     is_completed = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    user = db.relationship('UserModel', backref=backref('orders', cascade='all,delete'))
+    # Denormalized totals of the order lines, maintained as the lines are added
+    total_items = db.Column(db.Integer, nullable=False, default=0)
+    total_sum = db.Column(db.Float, nullable=False, default=0)
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    user = db.relationship('UserModel', backref=backref('orders', cascade='all,delete', passive_deletes=True))
 
     products = db.relationship(
         'OrderProductModel',
@@ -65,23 +98,59 @@ class OrderModel(BaseModelMixin):
     def __repr__(self) -> str:
         return f"<Order: (user={self.user.email}, completed={self.is_completed})>"
 
-    @property
-    def total_items(self):
-        items = sum(order_product.amount for order_product in self.products.all())
-        return items
+    @classmethod
+    def backfill_totals(cls) -> int:
+        """
+        Recompute the stored totals of the orders which have lines but no totals yet
+        with one UPDATE from the aggregated lines. Return the number of updated orders
+        """
+        lines = select(OrderProductModel).where(OrderProductModel.order_id == cls.id)
+        return cls.query.filter(cls.total_items == 0, lines.exists()).update(
+            {
+                cls.total_items: lines.with_only_columns(func.sum(OrderProductModel.amount)).scalar_subquery(),
+                cls.total_sum: lines.with_only_columns(
+                    func.round(func.sum(OrderProductModel.amount * OrderProductModel.discount_price), 2),
+                ).scalar_subquery(),
+            },
+            synchronize_session=False,
+        )
+
+    @classmethod
+    def add_with_products(cls, user, items: List[Tuple[ProductModel, int]]) -> 'OrderModel':
+        """
+        Add the order with its (product, amount) lines to the session with one insert
+        for the order and one bulk insert for the lines, leaving the commit to the caller
+        """
+        lines = [
+            {'product_id': product.id, 'amount': amount, 'price': product.price, 'discount': product.discount}
+            for product, amount in items
+        ]
+        order = cls(
+            user=user,
+            total_items=sum(amount for _, amount in items),
+            total_sum=round(sum(product.discount_price * amount for product, amount in items), 2),
+        )
+        db.session.add(order)
+        db.session.flush()
 
-    @property
-    def total_sum(self):
-        items_sum = sum(ord_pr.amount * ord_pr.product.discount_price for ord_pr in self.products.all())
-        items_sum = round(items_sum, 2)
-        return items_sum
+        for line in lines:
+            line['order_id'] = order.id
+        if lines:
+            db.session.execute(OrderProductModel.__table__.insert(), lines)
+        return order
 
     def add_product(self, product: ProductModel, amount: int = 1) -> OrderProductModel:
-        return OrderProductModel.create(
+        order_product = OrderProductModel(
             order=self,
             product=product,
             amount=amount,
+            price=product.price,
+            discount=product.discount,
         )
+        self.total_items = (self.total_items or 0) + amount
+        self.total_sum = round((self.total_sum or 0) + order_product.discount_price * amount, 2)
+        order_product.save()
+        return order_product
 
     def complete(self):
         for order_product in self.products.all():
@@ -1,6 +1,7 @@
 """Module with orders blueprint and its routes"""
 
 from flask import render_template, request
+from sqlalchemy.orm import joinedload
 
 from shop.orders.forms import MakeCompletedForm
 from shop.orders.models import OrderModel
@@ -22,6 +23,8 @@ def orders_list():
     page = request.args.get('page', 1, type=int)
     filtered_orders = OrderModel.filter(
         is_completed=is_completed,
+    ).options(
+        joinedload(OrderModel.user),
     ).order_by(OrderModel.created_at.desc())
     paginator = OrderModel.get_pagination(page, filtered_orders)
 
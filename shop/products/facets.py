@@ -0,0 +1,154 @@
+"""Module with faceted filtering of the products catalog"""
+
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, case, func, or_
+from werkzeug.datastructures import MultiDict
+
+from shop.db import db
+from shop.products.models import catalog_cache, ProductModel, TaxonomyItem
+
+# Price bands over the discounted price: (label, lower bound inclusive, upper bound exclusive)
+PRICE_BANDS = (
+    ('0-25', 0, 25),
+    ('25-50', 25, 50),
+    ('50-100', 50, 100),
+    ('100+', 100, None),
+)
+
+# Facet name and the request argument it is selected with
+FACETS = (
+    ('brand', 'brand_name'),
+    ('category', 'category_name'),
+    ('price', 'price'),
+    ('discounted', 'discounted'),
+    ('in_stock', 'in_stock'),
+)
+FLAG_VALUE = '1'
+
+
+def _price_band_condition(lower: float, upper: Optional[float]):
+    if upper is None:
+        return ProductModel.discount_price >= lower
+    return and_(ProductModel.discount_price >= lower, ProductModel.discount_price < upper)
+
+
+def price_band_expression():
+    return case(
+        *[(_price_band_condition(lower, upper), label) for label, lower, upper in PRICE_BANDS],
+        else_=None,
+    )
+
+
+def _load_facet_cube() -> List[Tuple[tuple, int]]:
+    """
+    Count products grouped by every facet at once. The result is small (bounded by the number of
+    distinct facet combinations) and holds everything needed to derive all facet counts
+    """
+    band = price_band_expression()
+    discounted = case((ProductModel.discount > 0, 1), else_=0)
+    in_stock = case((ProductModel.available > 0, 1), else_=0)
+
+    rows = db.session.query(
+        ProductModel.brand_id,
+        ProductModel.category_id,
+        band,
+        discounted,
+        in_stock,
+        func.count(ProductModel.id),
+    ).group_by(
+        ProductModel.brand_id,
+        ProductModel.category_id,
+        band,
+        discounted,
+        in_stock,
+    ).all()
+    return [(tuple(row[:-1]), row[-1]) for row in rows]
+
+
+def get_facet_cube() -> List[Tuple[tuple, int]]:
+    return catalog_cache.get_or_set('facet_cube', _load_facet_cube)
+
+
+class FacetSelection:
+    """Facet values selected with the request arguments"""
+
+    def __init__(self, args: MultiDict, brands: List[TaxonomyItem], categories: List[TaxonomyItem]):
+        self._names = {
+            'brand': {item.id: item.name for item in brands},
+            'category': {item.id: item.name for item in categories},
+        }
+        known_values = {
+            'brand': set(self._names['brand'].values()),
+            'category': set(self._names['category'].values()),
+            'price': {label for label, _, _ in PRICE_BANDS},
+            'discounted': {FLAG_VALUE},
+            'in_stock': {FLAG_VALUE},
+        }
+        self.selected: Dict[str, List[str]] = {
+            facet: [value for value in dict.fromkeys(args.getlist(arg)) if value in known_values[facet]]
+            for facet, arg in FACETS
+        }
+
+    def is_selected(self, facet: str, value: str) -> bool:
+        return value in self.selected[facet]
+
+    def apply(self, query):
+        ids = {
+            facet: [item_id for item_id, name in self._names[facet].items() if name in self.selected[facet]]
+            for facet in ('brand', 'category')
+        }
+        if ids['brand']:
+            query = query.filter(ProductModel.brand_id.in_(ids['brand']))
+        if ids['category']:
+            query = query.filter(ProductModel.category_id.in_(ids['category']))
+        if self.selected['price']:
+            query = query.filter(or_(*[
+                _price_band_condition(lower, upper)
+                for label, lower, upper in PRICE_BANDS if label in self.selected['price']
+            ]))
+        if self.selected['discounted']:
+            query = query.filter(ProductModel.discount > 0)
+        if self.selected['in_stock']:
+            query = query.filter(ProductModel.available > 0)
+        return query
+
+    def _row_values(self, row: tuple) -> Dict[str, Optional[str]]:
+        brand_id, category_id, band, discounted, in_stock = row
+        return {
+            'brand': self._names['brand'].get(brand_id),
+            'category': self._names['category'].get(category_id),
+            'price': band,
+            'discounted': FLAG_VALUE if discounted else None,
+            'in_stock': FLAG_VALUE if in_stock else None,
+        }
+
+    def counts(self, cube: List[Tuple[tuple, int]]) -> Dict[str, Counter]:
+        """
+        Count products per facet value. Each facet is counted with the selections
+        of all the other facets applied, so values inside one facet stay multi-selectable
+        """
+        counts = {facet: Counter() for facet, _ in FACETS}
+        active = [facet for facet, _ in FACETS if self.selected[facet]]
+
+        for row, amount in cube:
+            values = self._row_values(row)
+            failed = [facet for facet in active if values[facet] not in self.selected[facet]]
+            if len(failed) > 1:
+                continue
+
+            for facet, _ in FACETS:
+                if (not failed or failed == [facet]) and values[facet] is not None:
+                    counts[facet][values[facet]] += amount
+        return counts
+
+    def url_args(self, facet: Optional[str] = None, value: Optional[str] = None) -> Dict[str, Optional[List[str]]]:
+        """Request arguments of the current selection, with the given facet value toggled"""
+        args = {}
+        for name, arg in FACETS:
+            values = list(self.selected[name])
+            if name == facet:
+                values = [v for v in values if v != value] if value in values else values + [value]
+            args[arg] = values or None
+        return args
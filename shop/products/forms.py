@@ -123,8 +123,8 @@ class ProductCreateForm(FlaskForm):
 
     def __init__(self, *args, **kwargs):
         super(ProductCreateForm, self).__init__(*args, **kwargs)
-        self.category.choices = [ct.name for ct in CategoryModel.get_all()]
-        self.brand.choices = [br.name for br in BrandModel.get_all()]
+        self.category.choices = [ct.name for ct in CategoryModel.get_cached_all()]
+        self.brand.choices = [br.name for br in BrandModel.get_cached_all()]
 
 
 class ProductUpdateForm(ProductCreateForm):
@@ -172,8 +172,8 @@ class ProductUpdateForm(ProductCreateForm):
 
     def __init__(self, *args, **kwargs):
         super(ProductCreateForm, self).__init__(*args, **kwargs)
-        self.category.choices = [ct.name for ct in CategoryModel.get_all()]
-        self.brand.choices = [br.name for br in BrandModel.get_all()]
+        self.category.choices = [ct.name for ct in CategoryModel.get_cached_all()]
+        self.brand.choices = [br.name for br in BrandModel.get_cached_all()]
 
     def validate(self, extra_validators=None):
         if not super(ProductUpdateForm, self).validate(extra_validators):
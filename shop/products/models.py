@@ -1,17 +1,78 @@
 """Models for users blueprint"""
 
+from collections import namedtuple
+from datetime import datetime
 import os
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
+from flask import current_app
 from flask_login import UserMixin
+from sqlalchemy import cast, event, Float, func, inspect, Integer
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import backref
 
-from shop.core.models import BaseModelMixin, PictureHandleMixin
-from shop.db import db
+from shop.core.cache import LRUCache, VersionedCache
+from shop.core.models import BaseModelMixin, PictureHandleMixin, VersionStampModel
+from shop.db import after_commit, commit, db, unit_of_work
+from shop.products.search import FIELD_WEIGHTS, index_product, search_stats_cache, unindex_product
 
+# Version stamps of the rendered catalog pages and of the brands and categories names
+CATALOG_STAMP = 'catalog'
+TAXONOMY_STAMP = 'taxonomy'
 
-class BrandModel(UserMixin, BaseModelMixin):
+TaxonomyItem = namedtuple('TaxonomyItem', ['id', 'name'])
+
+# Discounted prices are computed on whole cents rounded half up, the same way by Python and by the database,
+# so the stored effective price, catalog filters, cart summaries and order totals never differ by a cent
+DISCOUNTED_PRICE_SQL = '(CAST(ROUND(price * 100) AS INTEGER) * (100 - discount) + 50) / 100 / 100.0'
+
+
+def discounted_price(price: float, discount: int) -> float:
+    return (round(price * 100) * (100 - discount) + 50) // 100 / 100
+
+
+def discounted_price_expression(price, discount):
+    """SQL expression of discounted_price over the columns, relying on the integer division of the database"""
+    cents = cast(func.round(price * 100), Integer)
+    return cast((cents * (100 - discount) + 50) / 100 / 100.0, Float)
+
+
+taxonomy_cache = VersionedCache()
+
+# Data derived from the products rows, invalidated on every product change
+catalog_cache = VersionedCache()
+
+# Session info key set when the transaction sold out or restocked some products
+STOCK_CHANGED = 'stock_changed'
+
+# Rendered catalog pages served to anonymous users
+catalog_page_cache = LRUCache()
+
+
+class TaxonomyCacheMixin:
+    """Mixin for models whose name lists are served from the shared taxonomy cache"""
+
+    @classmethod
+    def get_cached_all(cls) -> List[TaxonomyItem]:
+        return taxonomy_cache.get_or_set(
+            cls.__tablename__,
+            lambda: [TaxonomyItem(item.id, item.name) for item in cls.get_all()],
+            ttl=current_app.config['TAXONOMY_CACHE_TTL'],
+        )
+
+    @classmethod
+    def on_write(cls) -> None:
+        VersionStampModel.bump(CATALOG_STAMP, TAXONOMY_STAMP)
+
+    @classmethod
+    def on_change(cls) -> None:
+        taxonomy_cache.invalidate()
+        catalog_page_cache.invalidate()
+        super().on_change()
+
+
+class BrandModel(TaxonomyCacheMixin, UserMixin, BaseModelMixin):
     """Entity Brand Model"""
 
     __tablename__ = 'brands'
@@ -30,16 +91,17 @@ class BrandModel(UserMixin, BaseModelMixin):
         return f"<Brand: ('{self.name}')>"
 
     def delete(self) -> None:
-        for product in self.products:
-            product.delete()
-        return super(BrandModel, self).delete()
+        with unit_of_work():
+            ProductModel.bulk_delete(ProductModel.brand_id == self.id)
+            db.session.expire(self, ['products'])
+            return super(BrandModel, self).delete()
 
     @classmethod
     def get_all(cls) -> List:
         return cls.query.order_by(cls.name).all()
 
 
-class CategoryModel(UserMixin, BaseModelMixin):
+class CategoryModel(TaxonomyCacheMixin, UserMixin, BaseModelMixin):
     """Entity Category Model"""
 
     __tablename__ = 'categories'
@@ -58,9 +120,10 @@ class CategoryModel(UserMixin, BaseModelMixin):
         return f"<Category: ('{self.name}')>"
 
     def delete(self) -> None:
-        for product in self.products:
-            product.delete()
-        return super(CategoryModel, self).delete()
+        with unit_of_work():
+            ProductModel.bulk_delete(ProductModel.category_id == self.id)
+            db.session.expire(self, ['products'])
+            return super(CategoryModel, self).delete()
 
     @classmethod
     def get_all(cls) -> List:
@@ -73,6 +136,15 @@ class ProductModel(UserMixin, PictureHandleMixin, BaseModelMixin):
     __tablename__ = 'products'
 
     PAGINATE_BY = 8
+    KEYSET_BY = ('name', 'id')
+    # Catalog sort options: sort key fields and whether they are ordered descending
+    SORT_ORDERS = {
+        'price_asc': (('effective_price', 'id'), False),
+        'price_desc': (('effective_price', 'id'), True),
+        'discount': (('discount', 'id'), True),
+        'newest': (('id',), True),
+        'stock': (('available_amount', 'id'), True),
+    }
     IMAGE_DIR = __tablename__
     IMAGE_SIZE = (500, 500)
     DEFAULT_IMAGE = os.path.join(
@@ -90,19 +162,36 @@ class ProductModel(UserMixin, PictureHandleMixin, BaseModelMixin):
     reserved = db.Column(db.Integer, default=0)
     discount = db.Column(db.Integer)
 
+    # Stored copies of discount_price and available, so the catalog can be sorted and filtered by index
+    effective_price = db.Column(
+        db.Float,
+        db.Computed(DISCOUNTED_PRICE_SQL, persisted=True),
+    )
+    available_amount = db.Column(db.Integer, db.Computed('amount - reserved', persisted=True))
+
     image_file = db.Column(db.String(64), nullable=False, default=DEFAULT_IMAGE)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-    brand_id = db.Column(db.Integer, db.ForeignKey('brands.id'))
-    brand = db.relationship('BrandModel', backref=backref('products', cascade='all,delete'))
+    brand_id = db.Column(db.Integer, db.ForeignKey('brands.id', ondelete='CASCADE'))
+    brand = db.relationship('BrandModel', backref=backref('products', cascade='all,delete', passive_deletes=True))
 
-    category_id = db.Column(db.Integer, db.ForeignKey('categories.id'))
-    category = db.relationship('CategoryModel', backref=backref('products', cascade='all,delete'))
+    category_id = db.Column(db.Integer, db.ForeignKey('categories.id', ondelete='CASCADE'))
+    category = db.relationship(
+        'CategoryModel',
+        backref=backref('products', cascade='all,delete', passive_deletes=True),
+    )
 
     __table_args__ = (
         db.CheckConstraint('price >= 0.01', name='product_positive_price_constraint'),
         db.CheckConstraint('amount >= 0', name='product_non_negative_amount_constraint'),
         db.CheckConstraint('reserved <= amount', name='product_valid_reserved_amount_constraint'),
         db.CheckConstraint('discount >= 0 AND discount <= 99', name='valid_product_discount_constraint'),
+        db.Index('ix_products_name_id', 'name', 'id'),
+        db.Index('ix_products_brand_name_id', 'brand_id', 'name', 'id'),
+        db.Index('ix_products_category_name_id', 'category_id', 'name', 'id'),
+        db.Index('ix_products_effective_price_id', 'effective_price', 'id'),
+        db.Index('ix_products_discount_id', 'discount', 'id'),
+        db.Index('ix_products_available_amount_id', 'available_amount', 'id'),
     )
 
     def __str__(self) -> str:
@@ -115,10 +204,162 @@ class ProductModel(UserMixin, PictureHandleMixin, BaseModelMixin):
     def get_all(cls) -> List:
         return cls.query.order_by(cls.name).all()
 
+    @classmethod
+    def on_write(cls) -> None:
+        VersionStampModel.bump(CATALOG_STAMP)
+
+    @classmethod
+    def on_change(cls) -> None:
+        catalog_cache.invalidate()
+        catalog_page_cache.invalidate()
+        super(ProductModel, cls).on_change()
+
+    @classmethod
+    def get_catalog_stamp(cls) -> Tuple[str, datetime]:
+        version, updated_at = VersionStampModel.get_stamp(CATALOG_STAMP)
+        return f'catalog-{version}', updated_at
+
+    @classmethod
+    def get_detail_stamp(cls, product_id: int) -> Optional[Tuple[str, datetime]]:
+        product = db.session.query(cls.updated_at).filter_by(id=product_id).first()
+        if product is None:
+            return None
+
+        taxonomy_version, taxonomy_updated_at = VersionStampModel.get_stamp(TAXONOMY_STAMP)
+        etag = f'product-{product_id}-{product.updated_at.isoformat()}-{taxonomy_version}'
+        return etag, max(product.updated_at, taxonomy_updated_at)
+
+    def _search_fields_changed(self) -> bool:
+        state = inspect(self)
+        if not state.persistent:
+            return True
+        return any(state.attrs[field].history.has_changes() for field in FIELD_WEIGHTS)
+
+    def save(self) -> None:
+        # The search postings are committed together with the product row
+        reindex = self._search_fields_changed()
+        with unit_of_work():
+            super(ProductModel, self).save()
+            if reindex:
+                index_product(self)
+
+    def delete(self) -> None:
+        product_id = self.id
+        with unit_of_work():
+            super(ProductModel, self).delete()
+            unindex_product(product_id)
+
+    @classmethod
+    def bulk_delete(cls, *criteria) -> int:
+        # Search postings go with the products by the database cascade
+        deleted = super(ProductModel, cls).bulk_delete(*criteria)
+        after_commit(search_stats_cache.invalidate)
+        return deleted
+
+    @classmethod
+    def update(cls, _id, **kwargs) -> None:
+        with unit_of_work():
+            super(ProductModel, cls).update(_id, **kwargs)
+            if set(FIELD_WEIGHTS).intersection(kwargs):
+                index_product(cls.get(id=_id))
+
+    @classmethod
+    def _update_reserved(cls, product_id: int, amount: int, condition) -> int:
+        return cls.query.filter(cls.id == product_id, condition).update(
+            {cls.reserved: cls.reserved + amount},
+            synchronize_session=False,
+        )
+
+    @classmethod
+    def _change_reserved(cls, product_id: int, amount: int, condition) -> bool:
+        # Reservations leave the catalog alone unless they sell out or restock the product,
+        # the UPDATE moves updated_at of the product and with it the ETag of its page
+        try:
+            changed = cls._update_reserved(product_id, amount, condition)
+            if changed:
+                cls.track_stock({product_id: amount})
+            commit()
+        except IntegrityError as err:
+            db.session.rollback()
+            raise err
+        return bool(changed)
+
+    @classmethod
+    def track_stock(cls, amounts: Dict[int, int]) -> None:
+        """
+        Check the products after their reserved amounts were changed by the amounts in the current transaction.
+        If some of them were sold out or restocked, the catalog stamp is bumped in the transaction and the catalog
+        caches are invalidated after its commit, as the in stock facet and filter depend on it
+        """
+        if db.session.info.get(STOCK_CHANGED):
+            return
+
+        rows = db.session.query(cls.id, cls.available_amount).filter(cls.id.in_(amounts))
+        if any(
+            available == 0 if amounts[product_id] > 0 else 0 < available <= -amounts[product_id]
+            for product_id, available in rows
+        ):
+            cls.on_write()
+            db.session.info[STOCK_CHANGED] = True
+
+    @classmethod
+    def reserve(cls, product_id: int, amount: int) -> bool:
+        """Reserve the amount of the product with one conditional UPDATE, False if not enough is available"""
+        return cls._change_reserved(product_id, amount, cls.amount - cls.reserved >= amount)
+
+    @classmethod
+    def reserve_all(cls, amounts: Dict[int, int]) -> List[int]:
+        """
+        Reserve the amounts of the products in the current transaction, leaving the commit to the caller.
+        Return ids of the products which lack stock, the transaction has to be rolled back then.
+        Rows are locked in the order of ids, so concurrent bulk reservations cannot deadlock
+        """
+        failed = [
+            product_id for product_id, amount in sorted(amounts.items())
+            if not cls._update_reserved(product_id, amount, cls.amount - cls.reserved >= amount)
+        ]
+        if not failed:
+            cls.track_stock(amounts)
+        return failed
+
+    @classmethod
+    def release(cls, product_id: int, amount: int) -> bool:
+        """Release the reserved amount of the product, False if less than the amount is reserved"""
+        return cls._change_reserved(product_id, -amount, cls.reserved >= amount)
+
     @hybrid_property
     def discount_price(self) -> float:
-        return round(self.price * (1 - self.discount / 100), 2)
+        return discounted_price(self.price, self.discount)
+
+    @discount_price.expression
+    def discount_price(cls):
+        return cls.effective_price
 
     @hybrid_property
     def available(self) -> int:
         return self.amount - self.reserved
+
+    @available.expression
+    def available(cls):
+        return cls.available_amount
+
+    @classmethod
+    def get_sort_order(cls, sort: Optional[str]) -> Tuple[Tuple[str, ...], bool]:
+        return cls.SORT_ORDERS.get(sort, (cls.KEYSET_BY, False))
+
+    @classmethod
+    def order_by_sort(cls, query, sort: Optional[str]):
+        fields, descending = cls.get_sort_order(sort)
+        columns = [getattr(cls, field) for field in fields]
+        return query.order_by(*[column.desc() if descending else column for column in columns])
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_catalog_on_stock_change(session) -> None:
+    if session.info.pop(STOCK_CHANGED, False):
+        ProductModel.on_change()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_stock_change(session) -> None:
+    session.info.pop(STOCK_CHANGED, None)
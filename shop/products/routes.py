@@ -10,7 +10,8 @@ from shop.products.views import (
     create_product,
     product_detail,
     product_update,
-    products
+    products,
+    search
 )
 
 products_blueprint = Blueprint('products_blueprint', __name__)
@@ -19,6 +20,8 @@ products_blueprint.add_url_rule('/',
                                 view_func=products, methods=['GET', 'POST'])
 products_blueprint.add_url_rule('/products',
                                 view_func=products, methods=['GET', 'POST'])
+products_blueprint.add_url_rule('/search',
+                                view_func=search, methods=['GET'])
 products_blueprint.add_url_rule('/product_detail/<int:product_id>',
                                 view_func=product_detail, methods=['GET', 'POST'])
 products_blueprint.add_url_rule('/product_update/<int:product_id>',
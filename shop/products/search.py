@@ -0,0 +1,223 @@
+"""Module with an incrementally maintained inverted index for products full-text search"""
+
+from collections import Counter
+import math
+import re
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, case, func, select, union_all
+
+from shop.core.cache import VersionedCache
+from shop.db import after_commit, commit, db
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+STOP_WORDS = frozenset({
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is',
+    'it', 'of', 'on', 'or', 'that', 'the', 'this', 'to', 'was', 'with',
+})
+MAX_TERM_LENGTH = 64
+MIN_PREFIX_LENGTH = 3
+
+# Term frequencies are multiplied by field weight, so a hit in a name outranks one in a description
+FIELD_WEIGHTS = {
+    'name': 3,
+    'short_description': 2,
+    'full_description': 1,
+}
+
+# Okapi BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+PREFIX_MATCH_WEIGHT = 0.5
+# Terms a prefix expands to, so a short prefix does not score most of the index
+MAX_PREFIX_TERMS = 50
+
+search_stats_cache = VersionedCache(ttl=60)
+
+
+class SearchDocumentModel(db.Model):
+    """Indexed product document length"""
+
+    __tablename__ = 'search_documents'
+
+    product_id = db.Column(
+        db.Integer,
+        db.ForeignKey('products.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+    length = db.Column(db.Integer, nullable=False)
+
+
+class SearchTermModel(db.Model):
+    """Inverted index posting: weighted frequency of a term in a product"""
+
+    __tablename__ = 'search_terms'
+
+    term = db.Column(db.String(MAX_TERM_LENGTH), primary_key=True)
+    product_id = db.Column(
+        db.Integer,
+        db.ForeignKey('products.id', ondelete='CASCADE'),
+        primary_key=True,
+        index=True,
+    )
+    frequency = db.Column(db.Integer, nullable=False)
+
+
+def tokenize(text: str) -> List[str]:
+    tokens = TOKEN_PATTERN.findall((text or '').lower())
+    return [token[:MAX_TERM_LENGTH] for token in tokens if len(token) > 1 and token not in STOP_WORDS]
+
+
+def _product_terms(product) -> Counter:
+    terms = Counter()
+    for field, weight in FIELD_WEIGHTS.items():
+        for token in tokenize(getattr(product, field)):
+            terms[token] += weight
+    return terms
+
+
+def _delete_postings(product_id: int) -> None:
+    SearchTermModel.query.filter_by(product_id=product_id).delete(synchronize_session=False)
+    SearchDocumentModel.query.filter_by(product_id=product_id).delete(synchronize_session=False)
+
+
+def index_product(product) -> None:
+    """Replace postings of a single product with the ones built from its current text fields"""
+    terms = _product_terms(product)
+
+    _delete_postings(product.id)
+    db.session.execute(
+        SearchDocumentModel.__table__.insert(),
+        {'product_id': product.id, 'length': sum(terms.values())},
+    )
+    if terms:
+        db.session.execute(
+            SearchTermModel.__table__.insert(),
+            [{'term': term, 'product_id': product.id, 'frequency': freq} for term, freq in terms.items()],
+        )
+    commit()
+    after_commit(search_stats_cache.invalidate)
+
+
+def unindex_product(product_id: int) -> None:
+    _delete_postings(product_id)
+    commit()
+    after_commit(search_stats_cache.invalidate)
+
+
+def _insert_batch(documents: List[dict], postings: List[dict]) -> None:
+    if documents:
+        db.session.execute(SearchDocumentModel.__table__.insert(), documents)
+    if postings:
+        db.session.execute(SearchTermModel.__table__.insert(), postings)
+
+
+def rebuild_index(products, batch_size: int = 1000) -> None:
+    """Index every given product from scratch in one transaction, used for existing catalogs"""
+    SearchTermModel.query.delete(synchronize_session=False)
+    SearchDocumentModel.query.delete(synchronize_session=False)
+
+    documents, postings = [], []
+    for product in products:
+        terms = _product_terms(product)
+        documents.append({'product_id': product.id, 'length': sum(terms.values())})
+        postings.extend({'term': term, 'product_id': product.id, 'frequency': freq} for term, freq in terms.items())
+
+        if len(documents) >= batch_size:
+            _insert_batch(documents, postings)
+            documents, postings = [], []
+
+    _insert_batch(documents, postings)
+    db.session.commit()
+    search_stats_cache.invalidate()
+
+
+def _collection_stats() -> Tuple[int, float]:
+    def load():
+        count, avg_length = db.session.query(
+            func.count(SearchDocumentModel.product_id),
+            func.avg(SearchDocumentModel.length),
+        ).one()
+        return count, float(avg_length or 0)
+    return search_stats_cache.get_or_set('stats', load)
+
+
+def _term_filter(token: str):
+    if len(token) < MIN_PREFIX_LENGTH:
+        return SearchTermModel.term == token
+    # Index range scan over all terms starting with the token
+    return and_(SearchTermModel.term >= token, SearchTermModel.term < token + '\uffff')
+
+
+def _expand_token(token: str, documents_count: int) -> Dict[str, float]:
+    """
+    Return BM25 weights of the index terms matched by the token with their document frequencies.
+    A prefix expands to at most MAX_PREFIX_TERMS terms, taken in index order
+    """
+    rows = db.session.query(
+        SearchTermModel.term,
+        func.count(SearchTermModel.product_id),
+    ).filter(
+        _term_filter(token),
+    ).group_by(
+        SearchTermModel.term,
+    ).order_by(
+        SearchTermModel.term,
+    ).limit(MAX_PREFIX_TERMS).all()
+
+    weights = {}
+    for term, df in rows:
+        idf = math.log(1 + (documents_count - df + 0.5) / (df + 0.5))
+        weights[term] = idf * (1 if term == token else PREFIX_MATCH_WEIGHT)
+    return weights
+
+
+def search_products(text: str, limit: Optional[int] = None, offset: int = 0) -> Tuple[List[int], int]:
+    """
+    Return ids of the products matching the query, best BM25 score first, sliced by the limit
+    and offset, and the number of all matching products. Scores are summed up by the database
+    """
+    tokens = list(dict.fromkeys(tokenize(text)))
+    if not tokens:
+        return [], 0
+
+    documents_count, avg_length = _collection_stats()
+    if not documents_count:
+        return [], 0
+
+    frequency = SearchTermModel.frequency
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * SearchDocumentModel.length / (avg_length or 1))
+
+    # Best score of every product among the terms matched by each token
+    token_scores = []
+    for token in tokens:
+        weights = _expand_token(token, documents_count)
+        if not weights:
+            continue
+        weight = case(weights, value=SearchTermModel.term)
+        token_scores.append(select(
+            SearchTermModel.product_id,
+            func.max(weight * frequency * (BM25_K1 + 1) / (frequency + norm)).label('score'),
+        ).join(
+            SearchDocumentModel, SearchDocumentModel.product_id == SearchTermModel.product_id,
+        ).where(
+            SearchTermModel.term.in_(weights),
+        ).group_by(
+            SearchTermModel.product_id,
+        ))
+    if not token_scores:
+        return [], 0
+
+    matches = union_all(*token_scores).subquery()
+    score = func.sum(matches.c.score)
+    query = select(
+        matches.c.product_id,
+        func.count().over(),
+    ).group_by(
+        matches.c.product_id,
+    ).order_by(
+        score.desc(), matches.c.product_id,
+    ).limit(limit).offset(offset)
+
+    rows = db.session.execute(query).all()
+    return [product_id for product_id, _ in rows], rows[0][1] if rows else 0
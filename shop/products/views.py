@@ -1,19 +1,26 @@
 """Module with users blueprint and its routes"""
 
-from flask import abort, flash, redirect, render_template, request, url_for
+from flask import abort, current_app, flash, redirect, render_template, request, url_for
 from flask_login import current_user
+from flask_sqlalchemy import Pagination
 
 from shop.carts import forms as cart_forms
 from shop.carts.session_handler import SessionCart
+from shop.core.conditional import conditional_get
 from shop.core.utils import save_picture
+from shop.db import unit_of_work
 from shop.products import forms as product_forms
-from shop.products.models import BrandModel, CategoryModel, ProductModel
+from shop.products.facets import FacetSelection, get_facet_cube, PRICE_BANDS
+from shop.products.models import BrandModel, catalog_page_cache, CategoryModel, ProductModel
+from shop.products.search import search_products
 from shop.users.helpers import admin_required
 
 
+@conditional_get(ProductModel.get_catalog_stamp, page_cache=catalog_page_cache)
 def products():
-    brand_name = request.args.get('brand_name')
-    category_name = request.args.get('category_name')
+    brands = BrandModel.get_cached_all()
+    categories = CategoryModel.get_cached_all()
+    selection = FacetSelection(request.args, brands, categories)
 
     delete_product_form = product_forms.DeleteProductForm(prefix='delete_product')
     delete_category_form = product_forms.DeleteCategoryForm(prefix='delete_category')
@@ -57,34 +64,68 @@ def products():
             return abort(403)
 
     page = request.args.get('page', 1, type=int)
-    filtered_products = ProductModel.filter(
-        category=CategoryModel.get(name=category_name),
-        brand=BrandModel.get(name=brand_name),
-    ).order_by(ProductModel.name)
-    paginator = ProductModel.get_pagination(page, filtered_products)
-
-    if page < 1 or page > (paginator.pages or 1):
-        return abort(404)
+    cursor = request.args.get('cursor')
+    sort = request.args.get('sort')
+    if sort not in ProductModel.SORT_ORDERS:
+        sort = None
+    filtered_products = ProductModel.order_by_sort(selection.apply(ProductModel.query), sort)
+
+    if cursor is not None or current_app.config['CATALOG_KEYSET_PAGINATION']:
+        sort_fields, descending = ProductModel.get_sort_order(sort)
+        paginator = ProductModel.get_keyset_pagination(
+            cursor, filtered_products, fields=sort_fields, descending=descending,
+        )
+        if paginator is None:
+            return abort(404)
+    else:
+        paginator = ProductModel.get_pagination(page, filtered_products)
+        if page < 1 or page > (paginator.pages or 1):
+            return abort(404)
 
     context = {
         'products': paginator.items,
         'pagination': paginator,
         'page': page,
-        'categories': CategoryModel.get_all(),
-        'brands': BrandModel.get_all(),
+        'categories': categories,
+        'brands': brands,
+        'price_bands': PRICE_BANDS,
+        'selection': selection,
+        'facet_counts': selection.counts(get_facet_cube()),
+        'sort': sort,
         'delete_product_form': delete_product_form,
         'delete_category_form': delete_category_form,
         'delete_brand_form': delete_brand_form,
         'add_to_cart_form': add_to_cart_form,
     }
 
-    kwargs = {
-        'brand_name': request.args.get('brand_name'),
-        'category_name': request.args.get('category_name'),
+    return render_template('products/products_list.html', **context, kwargs=dict(selection.url_args(), sort=sort))
+
+
+def search():
+    query_text = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    per_page = ProductModel.PAGINATE_BY
+
+    page_ids, total = search_products(query_text, limit=per_page, offset=(max(page, 1) - 1) * per_page)
+    products_by_id = {pr.id: pr for pr in ProductModel.query.filter(ProductModel.id.in_(page_ids))}
+    paginator = Pagination(
+        None, page, per_page, total,
+        [products_by_id[pr_id] for pr_id in page_ids if pr_id in products_by_id],
+    )
+
+    if page < 1 or page > (paginator.pages or 1):
+        return abort(404)
+
+    context = {
+        'products': paginator.items,
+        'pagination': paginator,
+        'page': page,
+        'query': query_text,
     }
-    return render_template('products/products_list.html', **context, kwargs=kwargs)
+    return render_template('products/search.html', **context, kwargs={'q': query_text})
 
 
+@conditional_get(ProductModel.get_detail_stamp, page_cache=catalog_page_cache)
 def product_detail(product_id: int):
     product = ProductModel.get(id=product_id)
     add_to_cart_form = cart_forms.AddToCardForm(prefix='add_to_card')
@@ -145,22 +186,23 @@ def create_product():
     form = product_forms.ProductCreateForm()
 
     if form.validate_on_submit():
-        product = ProductModel.create(
-            name=form.name.data,
-            short_description=form.short_description.data,
-            full_description=form.full_description.data,
-            price=form.price.data,
-            amount=form.amount.data,
-            discount=form.discount.data,
-        )
-        product.brand = BrandModel.get(name=form.brand.data)
-        product.category = CategoryModel.get(name=form.category.data)
-
-        if form.picture.data:
-            filename = save_picture(form.picture.data, model=ProductModel)
-            product.image_file = filename
-
-        product.save()
+        with unit_of_work():
+            product = ProductModel.create(
+                name=form.name.data,
+                short_description=form.short_description.data,
+                full_description=form.full_description.data,
+                price=form.price.data,
+                amount=form.amount.data,
+                discount=form.discount.data,
+            )
+            product.brand = BrandModel.get(name=form.brand.data)
+            product.category = CategoryModel.get(name=form.category.data)
+
+            if form.picture.data:
+                filename = save_picture(form.picture.data, model=ProductModel)
+                product.image_file = filename
+
+            product.save()
         return redirect(url_for('products_blueprint.product_detail', product_id=product.id))
 
     return render_template('products/create_product.html', form=form)
@@ -175,20 +217,21 @@ def product_update(product_id: int):
         return abort(404)
 
     if form.validate_on_submit():
-        ProductModel.update(
-            _id=product.id,
-            name=form.name.data,
-            short_description=form.short_description.data,
-            full_description=form.full_description.data,
-            price=form.price.data,
-            amount=form.amount.data,
-            discount=form.discount.data,
-            category_id=CategoryModel.get(name=form.category.data).id,
-            brand_id=BrandModel.get(name=form.brand.data).id,
-        )
-        if form.picture.data:
-            filename = save_picture(form.picture.data, model=ProductModel)
-            product.update_image_file(filename)
+        with unit_of_work():
+            ProductModel.update(
+                _id=product.id,
+                name=form.name.data,
+                short_description=form.short_description.data,
+                full_description=form.full_description.data,
+                price=form.price.data,
+                amount=form.amount.data,
+                discount=form.discount.data,
+                category_id=CategoryModel.get(name=form.category.data).id,
+                brand_id=BrandModel.get(name=form.brand.data).id,
+            )
+            if form.picture.data:
+                filename = save_picture(form.picture.data, model=ProductModel)
+                product.update_image_file(filename)
 
         return redirect(url_for('products_blueprint.product_detail', product_id=product_id))
 
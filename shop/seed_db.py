@@ -6,9 +6,9 @@ import secrets
 
 from faker import Faker
 from flask import current_app
-from sqlalchemy.sql.expression import func
 
 from shop.core.utils import create_random_image
+from shop.db import unit_of_work
 from shop.orders.models import OrderModel
 from shop.products.models import BrandModel, CategoryModel, ProductModel
 from shop.users.models import UserModel
@@ -75,24 +75,27 @@ def get_random_user_data(is_confirmed: bool = False, create_image: bool = False)
 
 
 def seed_categories(n_categories: int = 10):
-    for _ in range(n_categories):
-        CategoryModel.create(
-            **get_random_category_data(),
-        )
+    with unit_of_work():
+        for _ in range(n_categories):
+            CategoryModel.create(
+                **get_random_category_data(),
+            )
 
 
 def seed_brands(n_brands: int = 10):
-    for _ in range(n_brands):
-        BrandModel.create(
-            **get_random_brand_data(),
-        )
+    with unit_of_work():
+        for _ in range(n_brands):
+            BrandModel.create(
+                **get_random_brand_data(),
+            )
 
 
 def seed_products(n_products: int = 10, with_images: bool = True):
-    for _ in range(n_products):
-        ProductModel.create(
-            **get_random_product_data(create_image=with_images),
-        )
+    with unit_of_work():
+        for _ in range(n_products):
+            ProductModel.create(
+                **get_random_product_data(create_image=with_images),
+            )
 
 
 def seed_admin():
@@ -106,30 +109,33 @@ def seed_admin():
 
 
 def seed_users(n_users: int = 10):
-    for _ in range(n_users):
-        UserModel(
-            **get_random_user_data(is_confirmed=True),
-        )
+    with unit_of_work():
+        for _ in range(n_users):
+            UserModel(
+                **get_random_user_data(is_confirmed=True),
+            )
 
 
 def seed_orders(n_orders: int = 25, max_products: int = 10, max_product_amount: int = 5) -> None:
-    for _ in range(n_orders):
-        order = OrderModel.create(user=UserModel.get_random())
+    with unit_of_work():
+        for _ in range(n_orders):
+            order = OrderModel.create(user=UserModel.get_random())
 
-        available_products = ProductModel.query.filter(ProductModel.available > 0)
-        for product in available_products.order_by(func.random()).limit(randint(1, max_products)).all():
-            amount_to_add = randint(1, min(max_product_amount, product.available))
-            product.reserved += amount_to_add
-            product.save()
-            order.add_product(product, amount=amount_to_add)
+            available_products = ProductModel.query.filter(ProductModel.available > 0)
+            for product in ProductModel.sample(randint(1, max_products), query=available_products):
+                amount_to_add = randint(1, min(max_product_amount, product.available))
+                product.reserved += amount_to_add
+                product.save()
+                order.add_product(product, amount=amount_to_add)
 
-        if randint(1, 10) > 6:
-            order.complete()
+            if randint(1, 10) > 6:
+                order.complete()
 
 
 def clear_all():
-    OrderModel.delete_all()
-    ProductModel.delete_all()
-    UserModel.delete_all()
-    BrandModel.delete_all()
-    CategoryModel.delete_all()
+    with unit_of_work():
+        OrderModel.delete_all()
+        ProductModel.delete_all()
+        UserModel.delete_all()
+        BrandModel.delete_all()
+        CategoryModel.delete_all()
@@ -66,11 +66,11 @@ class UpdateProfileForm(FlaskForm):
     submit = SubmitField('Update')
 
     def validate_username(self, username):
-        if username.data != current_user.username and UserModel.get(username=username.data):
+        if username.data != current_user.username and UserModel.exists(username=username.data):
             raise ValidationError('That username is taken. Please choose a different one.')
 
     def validate_email(self, email):
-        if email.data != current_user.email and UserModel.get(email=email.data):
+        if email.data != current_user.email and UserModel.exists(email=email.data):
             raise ValidationError('That email is taken. Please choose a different one.')
 
 
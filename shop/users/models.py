@@ -1,15 +1,24 @@
 """Models for users blueprint"""
 
+from functools import partial
 import os
+from typing import Optional
 
 from flask_login import UserMixin
+from sqlalchemy import inspect
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
 
-from shop.bcrypt import bcrypt
+from shop.bcrypt import check_password_hash, generate_password_hash, needs_rehash
+from shop.core.cache import LRUCache
 from shop.core.models import BaseModelMixin, PictureHandleMixin
 from shop.core.utils import generate_token
-from shop.db import db
+from shop.db import after_commit, db
 from shop.email import send_token_url_mail
 
+# Column values of recently loaded users by id, so authenticated requests skip the user query
+user_cache = LRUCache()
+
 
 class UserModel(UserMixin, PictureHandleMixin, BaseModelMixin):
     __tablename__ = 'users'
@@ -51,16 +60,60 @@ class UserModel(UserMixin, PictureHandleMixin, BaseModelMixin):
             self.image_file = image_file
         self.save()
 
+    @classmethod
+    def get_cached(cls, user_id: int) -> Optional['UserModel']:
+        """Return the user built from the cached column values and merged into the session without a query"""
+        values = user_cache.get(user_id)
+        if values is None:
+            user = cls.query.get(user_id)
+            if user is not None:
+                user_cache.set(user_id, {attr.key: getattr(user, attr.key) for attr in inspect(cls).column_attrs})
+            return user
+
+        user = cls.__mapper__.class_manager.new_instance()
+        for key, value in values.items():
+            set_committed_value(user, key, value)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def save(self) -> None:
+        super(UserModel, self).save()
+        # Identity holds the primary key, reading it does not refresh the attributes expired by the commit
+        after_commit(partial(user_cache.delete, inspect(self).identity[0]))
+
+    def delete(self) -> None:
+        user_id = self.id
+        super(UserModel, self).delete()
+        after_commit(partial(user_cache.delete, user_id))
+
+    @classmethod
+    def bulk_delete(cls, *criteria) -> int:
+        deleted = super(UserModel, cls).bulk_delete(*criteria)
+        after_commit(user_cache.invalidate)
+        return deleted
+
+    @classmethod
+    def update(cls, _id, **kwargs) -> None:
+        super(UserModel, cls).update(_id, **kwargs)
+        after_commit(partial(user_cache.delete, _id))
+
     @property
     def password(self) -> str:
         return self._password_hash
 
     @password.setter
     def password(self, password: str) -> None:
-        self._password_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+        self._password_hash = generate_password_hash(password)
 
     def check_password(self, password: str) -> bool:
-        return bcrypt.check_password_hash(self._password_hash, password)
+        """Check the password and rehash it if the hash cost differs from the configured one"""
+        if not check_password_hash(self._password_hash, password):
+            return False
+
+        if needs_rehash(self._password_hash):
+            self.password = password
+            self.save()
+        return True
 
     def generate_email_confirmation_token(self, email: str):
         token = generate_token(user_id=self.id, email=email)
@@ -5,6 +5,7 @@ from flask_login import current_user, login_required, login_user, logout_user
 
 from shop.carts.session_handler import SessionCart
 from shop.core.utils import save_picture, verify_token
+from shop.db import unit_of_work
 from shop.orders.models import OrderModel
 from shop.users.forms import (
     LoginForm,
@@ -100,15 +101,16 @@ def profile():
     form = UpdateProfileForm()
 
     if form.validate_on_submit():
-        current_user.username = form.username.data
-        current_user.save()
+        with unit_of_work():
+            current_user.username = form.username.data
+            current_user.save()
 
-        if current_user.email != form.email.data:
-            current_user.send_email_confirmation_mail(form.email.data)
+            if current_user.email != form.email.data:
+                current_user.send_email_confirmation_mail(form.email.data)
 
-        if form.picture.data:
-            filename = save_picture(form.picture.data, model=UserModel)
-            current_user.update_image_file(filename)
+            if form.picture.data:
+                filename = save_picture(form.picture.data, model=UserModel)
+                current_user.update_image_file(filename)
 
     elif request.method == 'GET':
         form = UpdateProfileForm(
@@ -157,7 +159,7 @@ def reset_password_request():
 
 @login_required
 def logout():
+    SessionCart.close_cart()
     logout_user()
-    SessionCart.clear_cart()
     flash('You are logged out', 'warning')
     return redirect(url_for('products_blueprint.products'))
@@ -4,6 +4,7 @@ import unittest
 from tests.utils import login, logout
 
 from shop import create_app
+from shop.core.cache import clear_caches
 from shop.db import db
 from shop.seed_db import fake
 from shop.users.models import UserModel
@@ -15,6 +16,7 @@ class BaseTestMixin(unittest.TestCase):
         cls.app = create_app('testing')
         cls.app.app_context().push()
         db.create_all()
+        clear_caches()
 
     @classmethod
     def tearDownClass(cls):
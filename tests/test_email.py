@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+import unittest
+
+from tests.mixins import BaseTestMixin
+from tests.utils import LocalSMTPServer
+
+from shop.email import deliver_outbox, mail, OutboxMessageModel, send_mail
+
+
+class OutboxTests(BaseTestMixin):
+    def setUp(self):
+        self.state = self.app.extensions['mail']
+        self.saved_state = vars(self.state).copy()
+        self.state.suppress = False
+        self.state.use_ssl = False
+        self.state.use_tls = False
+        self.state.server = '127.0.0.1'
+        # The local server takes no login and the sender does not depend on the environment
+        self.state.username = None
+        self.state.password = None
+        self.state.default_sender = 'shop@example.com'
+        self.mail_username = self.app.config['MAIL_USERNAME']
+        self.app.config['MAIL_USERNAME'] = None
+
+    def tearDown(self):
+        vars(self.state).update(self.saved_state)
+        self.app.config['MAIL_USERNAME'] = self.mail_username
+        OutboxMessageModel.delete_all()
+
+    def test_send_mail_only_puts_message_into_outbox(self):
+        with mail.record_messages() as outbox:
+            send_mail(['first@example.com'], 'Subject', '<p>Body</p>')
+
+        self.assertEqual(0, len(outbox))
+        message = OutboxMessageModel.query.one()
+        self.assertEqual('first@example.com', message.recipients)
+        self.assertEqual(0, message.attempts)
+        self.assertIsNone(message.sent_at)
+
+    def test_deliver_batch_over_one_connection(self):
+        for i in range(3):
+            send_mail([f'user{i}@example.com'], f'Subject {i}', '<p>Body</p>')
+
+        with LocalSMTPServer() as server:
+            self.state.port = server.port
+            self.assertEqual(2, deliver_outbox(batch_size=2))
+            self.assertEqual(1, deliver_outbox(batch_size=2))
+            self.assertEqual(0, deliver_outbox(batch_size=2))
+
+        self.assertEqual(2, server.connections)
+        self.assertListEqual(
+            [['user0@example.com'], ['user1@example.com'], ['user2@example.com']],
+            [recipients for recipients, data in server.messages],
+        )
+        self.assertIn('Subject: Subject 0', server.messages[0][1])
+        self.assertIn('From: shop@example.com', server.messages[0][1])
+        for message in OutboxMessageModel.query.all():
+            self.assertIsNotNone(message.sent_at)
+            self.assertIsNone(message.next_attempt_at)
+
+    def test_unavailable_server_schedules_retry_with_backoff(self):
+        send_mail(['first@example.com'], 'Subject', '<p>Body</p>')
+        with LocalSMTPServer() as server:
+            self.state.port = server.port
+
+        delay = self.app.config['MAIL_OUTBOX_RETRY_DELAY']
+        for attempt in (1, 2):
+            started_at = datetime.utcnow()
+            self.assertEqual(1, deliver_outbox())
+
+            message = OutboxMessageModel.query.one()
+            self.assertEqual(attempt, message.attempts)
+            self.assertIsNone(message.sent_at)
+            self.assertIsNotNone(message.last_error)
+            self.assertGreaterEqual(message.next_attempt_at, started_at + timedelta(seconds=delay * 2 ** (attempt - 1)))
+
+            # Not due until the delay passes
+            self.assertEqual(0, deliver_outbox())
+            message.next_attempt_at = datetime.utcnow()
+            message.save()
+
+        with LocalSMTPServer() as server:
+            self.state.port = server.port
+            self.assertEqual(1, deliver_outbox())
+
+        self.assertEqual(1, len(server.messages))
+        self.assertIsNotNone(OutboxMessageModel.query.one().sent_at)
+
+    def test_rejected_recipient_does_not_stop_batch(self):
+        send_mail(['rejected@example.com'], 'Subject', '<p>Body</p>')
+        send_mail(['accepted@example.com'], 'Subject', '<p>Body</p>')
+
+        with LocalSMTPServer(rejected_recipients=['rejected@example.com']) as server:
+            self.state.port = server.port
+            self.assertEqual(2, deliver_outbox())
+
+        self.assertListEqual([['accepted@example.com']], [recipients for recipients, data in server.messages])
+        rejected = OutboxMessageModel.query.filter_by(recipients='rejected@example.com').one()
+        self.assertEqual(1, rejected.attempts)
+        self.assertIsNone(rejected.sent_at)
+
+    def test_message_is_given_up_after_max_attempts(self):
+        send_mail(['first@example.com'], 'Subject', '<p>Body</p>')
+        message = OutboxMessageModel.query.one()
+        message.attempts = self.app.config['MAIL_OUTBOX_MAX_ATTEMPTS'] - 1
+        message.save()
+        with LocalSMTPServer() as server:
+            self.state.port = server.port
+
+        deliver_outbox()
+
+        message = OutboxMessageModel.query.one()
+        self.assertEqual(self.app.config['MAIL_OUTBOX_MAX_ATTEMPTS'], message.attempts)
+        self.assertIsNone(message.next_attempt_at)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,28 @@
+from decimal import Decimal, ROUND_HALF_UP
 import os
 from random import randint
+import threading
+import time
 import unittest
+from unittest import mock
 
+from sqlalchemy import case, text
 from sqlalchemy.exc import IntegrityError
 from tests.mixins import BaseTestMixin
-
-from shop.orders.models import OrderModel
-from shop.products.models import ProductModel
+from tests.utils import captured_commits, captured_queries
+
+from shop.bcrypt import hashing_pool, HashingPoolBusy, needs_rehash
+from shop.core.models import exist_all
+from shop.core.pagination import count_caches
+from shop.core.utils import file_remover
+from shop.db import add_missing_columns, db, unit_of_work
+from shop.orders.models import OrderModel, OrderProductModel
+from shop.products.models import BrandModel, catalog_cache, CategoryModel, ProductModel, taxonomy_cache
+from shop.products.search import SearchTermModel
 from shop.seed_db import (
     fake,
+    get_random_brand_data,
+    get_random_category_data,
     get_random_product_data,
     get_random_user_data,
     seed_brands,
@@ -38,8 +52,25 @@ class ProductModelTests(BaseTestMixin):
     def test_discount_price_calculation(self):
         random_product = ProductModel.get_random()
 
-        expected_price = round(random_product.price * (1 - random_product.discount / 100), 2)
-        self.assertTrue(abs(expected_price - random_product.discount_price) <= 1e-3)
+        # Half a cent is rounded up
+        expected_price = (Decimal(str(random_product.price)) * (100 - random_product.discount) / 100).quantize(
+            Decimal('0.01'), rounding=ROUND_HALF_UP,
+        )
+        self.assertTrue(abs(float(expected_price) - random_product.discount_price) <= 1e-3)
+
+    def test_discount_price_matches_stored_price(self):
+        product = ProductModel.get_random()
+        ProductModel.update(product.id, price=589.38, discount=25)
+        db.session.refresh(product)
+
+        self.assertEqual(442.04, product.discount_price)
+        for product in ProductModel.get_all():
+            db.session.refresh(product)
+            self.assertEqual(product.discount_price, product.effective_price)
+            self.assertEqual(
+                product.discount_price,
+                db.session.query(ProductModel.discount_price).filter_by(id=product.id).scalar(),
+            )
 
     def test_available_amount_calculation(self):
         random_product = ProductModel.get_random()
@@ -98,6 +129,38 @@ class ProductModelTests(BaseTestMixin):
         product.delete()
         self.assertFalse(os.path.isfile(full_path))
 
+    def test_delete_all_issues_one_delete(self):
+        order = OrderModel.create(user=UserModel(**get_random_user_data()))
+        order.add_product(ProductModel.get_random(), amount=1)
+
+        with captured_queries(db.engine) as queries:
+            deleted = ProductModel.delete_all()
+
+        self.assertEqual(self.N_PRODUCTS, deleted)
+        self.assertEqual(1, len([query for query in queries if query.startswith('DELETE')]))
+        self.assertEqual(0, ProductModel.query.count())
+        self.assertEqual(0, SearchTermModel.query.count())
+        self.assertEqual(0, order.products.count())
+
+        OrderModel.delete_all()
+        UserModel.delete_all()
+
+    def test_brand_delete_removes_products_and_queues_images(self):
+        brand = BrandModel.create(**get_random_brand_data())
+        products = [ProductModel.create(**dict(get_random_product_data(create_image=True), brand=brand))
+                    for _ in range(3)]
+        paths = [os.path.join(self.app.root_path, 'static', product.image_file) for product in products]
+
+        with captured_queries(db.engine) as queries:
+            brand.delete()
+        file_remover.wait()
+
+        self.assertEqual(1, len([query for query in queries if query.startswith('DELETE FROM products')]))
+        self.assertIsNone(BrandModel.get(id=brand.id))
+        self.assertEqual(self.N_PRODUCTS, ProductModel.query.count())
+        for path in paths:
+            self.assertFalse(os.path.isfile(path))
+
     def test_is_product_image_deleted_after_updating(self):
         product_data = get_random_product_data(create_image=True)
         product = ProductModel.create(**product_data)
@@ -110,6 +173,119 @@ class ProductModelTests(BaseTestMixin):
         self.assertFalse(os.path.isfile(full_path))
 
 
+class ProductReservationTests(BaseTestMixin):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        seed_brands(n_brands=2)
+        seed_categories(n_categories=2)
+
+    def setUp(self):
+        self.product = ProductModel.create(**get_random_product_data())
+
+    def tearDown(self):
+        for pr in ProductModel.get_all():
+            pr.delete()
+
+    def test_reserve(self):
+        amount_to_reserve = randint(1, self.product.amount)
+
+        self.assertTrue(ProductModel.reserve(self.product.id, amount_to_reserve))
+        self.assertEqual(amount_to_reserve, self.product.reserved)
+
+    def test_reserve_more_than_available(self):
+        self.assertFalse(ProductModel.reserve(self.product.id, self.product.amount + 1))
+        self.assertEqual(0, self.product.reserved)
+
+    def test_reserve_missing_product(self):
+        self.assertFalse(ProductModel.reserve(self.product.id + 1, 1))
+
+    def test_release(self):
+        ProductModel.reserve(self.product.id, self.product.amount)
+
+        self.assertTrue(ProductModel.release(self.product.id, 1))
+        self.assertEqual(self.product.amount - 1, self.product.reserved)
+
+    def test_release_more_than_reserved(self):
+        self.assertFalse(ProductModel.release(self.product.id, 1))
+        self.assertEqual(0, self.product.reserved)
+
+    def test_reserve_keeps_catalog_stamp(self):
+        ProductModel.update(self.product.id, amount=2)
+        stamp = ProductModel.get_catalog_stamp()
+        detail_stamp = ProductModel.get_detail_stamp(self.product.id)
+
+        ProductModel.reserve(self.product.id, 1)
+
+        self.assertEqual(stamp, ProductModel.get_catalog_stamp())
+        self.assertNotEqual(detail_stamp, ProductModel.get_detail_stamp(self.product.id))
+
+    def test_sold_out_and_restock_change_catalog(self):
+        in_stock = case((ProductModel.available > 0, 1), else_=0)
+        stamp = ProductModel.get_catalog_stamp()
+        self.assertEqual(1, catalog_cache.get_or_set('in_stock', lambda: db.session.query(in_stock).scalar()))
+
+        ProductModel.reserve(self.product.id, self.product.amount)
+
+        self.assertNotEqual(stamp, ProductModel.get_catalog_stamp())
+        self.assertEqual(0, catalog_cache.get_or_set('in_stock', lambda: db.session.query(in_stock).scalar()))
+
+        stamp = ProductModel.get_catalog_stamp()
+        ProductModel.release(self.product.id, 1)
+
+        self.assertNotEqual(stamp, ProductModel.get_catalog_stamp())
+        self.assertEqual(1, catalog_cache.get_or_set('in_stock', lambda: db.session.query(in_stock).scalar()))
+
+    def test_failed_reservation_keeps_catalog(self):
+        stamp = ProductModel.get_catalog_stamp()
+        self.assertEqual(['cached'], catalog_cache.get_or_set('in_stock', lambda: ['cached']))
+
+        self.assertEqual([self.product.id], ProductModel.reserve_all({self.product.id: self.product.amount + 1}))
+        db.session.rollback()
+
+        self.assertEqual(stamp, ProductModel.get_catalog_stamp())
+        self.assertEqual(['cached'], catalog_cache.get_or_set('in_stock', lambda: None))
+
+    def test_reserve_joins_unit_of_work(self):
+        with self.assertRaises(RuntimeError):
+            with unit_of_work():
+                ProductModel.reserve(self.product.id, 1)
+                raise RuntimeError
+
+        db.session.refresh(self.product)
+        self.assertEqual(0, self.product.reserved)
+
+    def test_reserve_all_locks_products_in_id_order(self):
+        with mock.patch.object(ProductModel, '_update_reserved', return_value=1) as update_reserved:
+            self.assertEqual([], ProductModel.reserve_all({3: 1, 1: 2, 2: 1}))
+
+        self.assertEqual([1, 2, 3], [call.args[0] for call in update_reserved.call_args_list])
+
+    def test_concurrent_reservations_of_one_product(self):
+        n_threads, attempts = 8, 10
+        product_id, amount = self.product.id, self.product.amount
+        barrier = threading.Barrier(n_threads)
+        results = []
+
+        def reserve_units():
+            with self.app.app_context():
+                barrier.wait()
+                for _ in range(attempts):
+                    results.append(ProductModel.reserve(product_id, 1))
+                db.session.remove()
+
+        threads = [threading.Thread(target=reserve_units) for _ in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(n_threads * attempts, len(results))
+        self.assertEqual(amount, results.count(True))
+        db.session.refresh(self.product)
+        self.assertEqual(amount, self.product.reserved)
+
+
 class UserModelTests(BaseTestMixin):
     @classmethod
     def setUpClass(cls):
@@ -136,6 +312,83 @@ class UserModelTests(BaseTestMixin):
         self.assertNotEqual(user.password, plaintext_password)
         self.assertTrue(user.check_password(plaintext_password))
 
+    def test_password_hashing_cost(self):
+        user = UserModel.create(**get_random_user_data())
+        self.assertFalse(needs_rehash(user.password))
+        self.assertEqual(self.app.config['BCRYPT_LOG_ROUNDS'], int(user.password.split('$')[2]))
+
+    def test_password_rehashed_on_check_when_cost_changed(self):
+        plaintext_password = fake.word()
+        user = UserModel.create(**dict(get_random_user_data(), password=plaintext_password))
+        old_hash = user.password
+
+        self.app.config['BCRYPT_LOG_ROUNDS'] += 1
+        try:
+            self.assertFalse(user.check_password(plaintext_password + 'x'))
+            self.assertEqual(old_hash, user.password)
+
+            self.assertTrue(user.check_password(plaintext_password))
+            self.assertNotEqual(old_hash, user.password)
+            self.assertFalse(needs_rehash(UserModel.get(id=user.id).password))
+        finally:
+            self.app.config['BCRYPT_LOG_ROUNDS'] -= 1
+
+    def test_hashing_pool_rejects_jobs_over_queue_limit(self):
+        release = threading.Event()
+        limit = self.app.config['BCRYPT_WORKERS'] + self.app.config['BCRYPT_MAX_QUEUE']
+        jobs = [threading.Thread(target=hashing_pool.run, args=(release.wait,)) for _ in range(limit)]
+        for job in jobs:
+            job.start()
+        time.sleep(0.1)
+
+        try:
+            with self.assertRaises(HashingPoolBusy):
+                hashing_pool.run(release.wait)
+        finally:
+            release.set()
+            for job in jobs:
+                job.join()
+        self.assertTrue(hashing_pool.run(lambda: True))
+
+    def test_get_cached_user_without_query(self):
+        user = UserModel.create(**get_random_user_data())
+        expected_values = (user.id, user.email, user.password)
+        UserModel.get_cached(user.id)
+        db.session.remove()
+
+        with captured_queries(db.engine) as queries:
+            cached_user = UserModel.get_cached(expected_values[0])
+            actual_values = (cached_user.id, cached_user.email, cached_user.password)
+        self.assertEqual([], queries)
+        self.assertEqual(expected_values, actual_values)
+        self.assertIn(cached_user, db.session)
+        self.assertEqual([], cached_user.orders)
+
+    def test_get_cached_missing_user(self):
+        self.assertIsNone(UserModel.get_cached(0))
+
+    def test_save_invalidates_cached_user(self):
+        user = UserModel.create(**get_random_user_data())
+        UserModel.get_cached(user.id)
+
+        new_username = fake.first_name() + 'x'
+        user.username = new_username
+        user.save()
+        user_id = user.id
+        db.session.remove()
+
+        self.assertEqual(new_username, UserModel.get_cached(user_id).username)
+
+    def test_update_invalidates_cached_user(self):
+        user = UserModel.create(**get_random_user_data())
+        user_id, confirmed = user.id, user.confirmed
+        UserModel.get_cached(user_id)
+
+        UserModel.update(user_id, confirmed=not confirmed)
+        db.session.remove()
+
+        self.assertEqual(not confirmed, UserModel.get_cached(user_id).confirmed)
+
     def test_is_product_image_deleted_with_user(self):
         user_data = get_random_user_data(create_image=True)
         user = UserModel.create(**user_data)
@@ -189,10 +442,67 @@ class OrderModelTests(BaseTestMixin):
     def test_total_sum_calculation(self):
         random_order = OrderModel.get_random()
 
-        expected_sum = sum(item.amount * item.product.discount_price for item in random_order.products)
+        expected_sum = sum(item.amount * item.discount_price for item in random_order.products)
         expected_sum = round(expected_sum, 2)
         self.assertTrue(abs(expected_sum - random_order.total_sum) <= 1e-3)
 
+    def test_line_discount_price_matches_checkout(self):
+        order = OrderModel.create(user=UserModel.get_random())
+        order_product = order.add_product(ProductModel.get_random(), 1)
+        OrderProductModel.query.filter_by(order_id=order.id).update({'price': 589.38, 'discount': 25})
+        db.session.refresh(order_product)
+
+        self.assertEqual(442.04, order_product.discount_price)
+        self.assertEqual(
+            order_product.discount_price,
+            db.session.query(OrderProductModel.discount_price).filter_by(order_id=order.id).scalar(),
+        )
+
+    def test_backfill_of_orders_stored_without_totals(self):
+        order = OrderModel.get_random()
+        expected = (order.total_items, order.total_sum)
+        OrderProductModel.query.update({'price': 0, 'discount': 0})
+        OrderModel.query.update({'total_items': 0, 'total_sum': 0})
+        db.session.commit()
+
+        self.assertEqual(order.products.count(), OrderProductModel.backfill_prices())
+        self.assertEqual(1, OrderModel.backfill_totals())
+        db.session.commit()
+
+        db.session.refresh(order)
+        self.assertEqual(expected[0], order.total_items)
+        self.assertTrue(abs(expected[1] - order.total_sum) <= 1e-3)
+        self.assertEqual(0, OrderModel.backfill_totals())
+
+    def test_add_missing_columns(self):
+        db.session.execute(text('ALTER TABLE orders DROP COLUMN total_sum'))
+        db.session.commit()
+
+        self.assertEqual(['total_sum'], add_missing_columns(OrderModel))
+        self.assertEqual([], add_missing_columns(OrderModel))
+        db.session.commit()
+        self.assertEqual(0, OrderModel.query.filter(OrderModel.total_sum != 0).count())
+
+    def test_order_product_stores_checkout_price(self):
+        order = OrderModel.create(user=UserModel.get_random())
+        product = ProductModel.get_random()
+
+        order_product = order.add_product(product, 1)
+        self.assertEqual(product.price, order_product.price)
+        self.assertEqual(product.discount, order_product.discount)
+        self.assertEqual(product.discount_price, order_product.discount_price)
+
+    def test_price_change_does_not_change_order(self):
+        order = OrderModel.create(user=UserModel.get_random())
+        product = ProductModel.get_random()
+        order.add_product(product, 2)
+        expected_sum = order.total_sum
+
+        product.price = product.price * 2
+        product.save()
+
+        self.assertTrue(abs(expected_sum - OrderModel.get(id=order.id).total_sum) <= 1e-3)
+
     def test_add_product(self):
         order = OrderModel.create(user=UserModel.get_random())
 
@@ -228,5 +538,315 @@ class OrderModelTests(BaseTestMixin):
         self.assertEqual(random_product.reserved, 0)
 
 
+class TaxonomyCacheTests(BaseTestMixin):
+    def tearDown(self):
+        BrandModel.delete_all()
+        CategoryModel.delete_all()
+
+    def test_cached_lists_match_database(self):
+        seed_brands(n_brands=5)
+        seed_categories(n_categories=5)
+
+        expected_brands = [(br.id, br.name) for br in BrandModel.get_all()]
+        expected_categories = [(ct.id, ct.name) for ct in CategoryModel.get_all()]
+        self.assertListEqual(expected_brands, BrandModel.get_cached_all())
+        self.assertListEqual(expected_categories, CategoryModel.get_cached_all())
+
+    def test_cached_lists_served_without_queries(self):
+        seed_brands(n_brands=3)
+        BrandModel.get_cached_all()
+
+        with captured_queries(db.engine) as queries:
+            BrandModel.get_cached_all()
+        self.assertEqual(0, len(queries))
+
+    def test_create_invalidates_cache(self):
+        BrandModel.get_cached_all()
+        version = taxonomy_cache.version
+
+        brand = BrandModel.create(**get_random_brand_data())
+        self.assertGreater(taxonomy_cache.version, version)
+        self.assertListEqual([(brand.id, brand.name)], BrandModel.get_cached_all())
+
+    def test_update_invalidates_cache(self):
+        category = CategoryModel.create(**get_random_category_data())
+        CategoryModel.get_cached_all()
+
+        CategoryModel.update(_id=category.id, name='New ' + category.name)
+        self.assertListEqual([(category.id, category.name)], CategoryModel.get_cached_all())
+        self.assertTrue(category.name.startswith('New '))
+
+    def test_delete_invalidates_cache(self):
+        brand = BrandModel.create(**get_random_brand_data())
+        self.assertEqual(1, len(BrandModel.get_cached_all()))
+
+        brand.delete()
+        self.assertListEqual([], BrandModel.get_cached_all())
+
+
+class PaginationCountTests(BaseTestMixin):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        seed_brands(n_brands=2)
+        seed_categories(n_categories=2)
+
+    def setUp(self):
+        seed_products(n_products=3 * ProductModel.PAGINATE_BY)
+
+    def tearDown(self):
+        ProductModel.delete_all()
+
+    @staticmethod
+    def count_queries(queries):
+        return len([query for query in queries if 'count(' in query.lower()])
+
+    def test_cached_count_matches_exact(self):
+        query = ProductModel.query.order_by(ProductModel.name)
+        exact = ProductModel.get_pagination(2, query, count_mode='exact')
+        cached = ProductModel.get_pagination(2, query, count_mode='cached')
+
+        self.assertEqual(exact.total, cached.total)
+        self.assertEqual(exact.pages, cached.pages)
+        self.assertListEqual(exact.items, cached.items)
+
+    def test_cached_count_is_reused(self):
+        query = ProductModel.filter(discount=0)
+        ProductModel.get_pagination(1, query, count_mode='cached')
+
+        with captured_queries(db.engine) as queries:
+            pagination = ProductModel.get_pagination(2, query, count_mode='cached')
+
+        self.assertEqual(self.count_queries(queries), 0)
+        self.assertEqual(pagination.total, query.count())
+
+    def test_cached_count_is_keyed_by_filters(self):
+        brand = BrandModel.get_random()
+        all_pages = ProductModel.get_pagination(1, ProductModel.query, count_mode='cached')
+        brand_pages = ProductModel.get_pagination(1, ProductModel.filter(brand=brand), count_mode='cached')
+
+        self.assertEqual(all_pages.total, 3 * ProductModel.PAGINATE_BY)
+        self.assertEqual(brand_pages.total, len(brand.products))
+
+    def test_write_invalidates_cached_count(self):
+        ProductModel.get_pagination(1, ProductModel.query, count_mode='cached')
+        ProductModel.create(**get_random_product_data())
+
+        pagination = ProductModel.get_pagination(1, ProductModel.query, count_mode='cached')
+        self.assertEqual(pagination.total, 3 * ProductModel.PAGINATE_BY + 1)
+
+    def test_flushed_change_invalidates_cached_count(self):
+        query = ProductModel.filter(discount=0)
+        total = ProductModel.get_pagination(1, query, count_mode='cached').total
+
+        product = ProductModel.get(discount=0)
+        product.discount = 10
+        db.session.commit()
+
+        self.assertEqual(ProductModel.get_pagination(1, query, count_mode='cached').total, total - 1)
+
+    def test_cached_counts_are_bounded_per_table(self):
+        with mock.patch.dict(self.app.config, {'PAGINATION_COUNT_CACHE_SIZE': 2}):
+            count_caches.pop(ProductModel.__tablename__, None)
+            for discount in range(5):
+                ProductModel.get_pagination(1, ProductModel.filter(discount=discount), count_mode='cached')
+
+            self.assertEqual(2, len(count_caches[ProductModel.__tablename__]._entries))
+            count_caches.pop(ProductModel.__tablename__)
+
+    def test_approximate_count_falls_back_to_cached(self):
+        pagination = ProductModel.get_pagination(1, ProductModel.query, count_mode='approximate')
+        self.assertEqual(pagination.total, 3 * ProductModel.PAGINATE_BY)
+
+
+class SampleTests(BaseTestMixin):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        seed_brands(n_brands=2)
+        seed_categories(n_categories=2)
+        seed_products(n_products=30, with_images=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        ProductModel.delete_all()
+        super().tearDownClass()
+
+    def test_sample_returns_distinct_rows(self):
+        rows = ProductModel.sample(10)
+
+        self.assertEqual(10, len(rows))
+        self.assertEqual(10, len({row.id for row in rows}))
+
+    def test_sample_is_limited_by_table_size(self):
+        self.assertEqual(30, len(ProductModel.sample(50)))
+        self.assertListEqual([], ProductModel.sample(0))
+
+    def test_sample_of_empty_query(self):
+        self.assertListEqual([], ProductModel.sample(3, query=ProductModel.filter(name='')))
+        self.assertIsNone(OrderModel.get_random())
+
+    def test_sample_respects_query_filter(self):
+        brand = BrandModel.get_random()
+        query = ProductModel.filter(brand=brand)
+
+        rows = ProductModel.sample(5, query=query)
+
+        self.assertEqual(min(5, query.count()), len(rows))
+        self.assertTrue(all(row.brand_id == brand.id for row in rows))
+
+    def test_sample_picks_every_row(self):
+        picked = {ProductModel.get_random().id for _ in range(600)}
+        self.assertEqual(30, len(picked))
+
+    def test_sample_probes_ids_instead_of_sorting(self):
+        with captured_queries(db.engine) as queries:
+            ProductModel.sample(3)
+
+        self.assertFalse(any('random()' in query.lower() for query in queries))
+
+    def test_sparse_ids_fall_back_to_random_order(self):
+        ids = [product_id for product_id, in db.session.query(ProductModel.id).order_by(ProductModel.id)]
+        query = ProductModel.query.filter(ProductModel.id.in_([ids[0], ids[-1]]))
+
+        rows = ProductModel.sample(2, query=query)
+
+        self.assertSetEqual({ids[0], ids[-1]}, {row.id for row in rows})
+
+
+class RequestLookupTests(BaseTestMixin):
+    def tearDown(self):
+        BrandModel.delete_all()
+
+    def test_repeated_get_is_queried_once_per_request(self):
+        brand_data = get_random_brand_data()
+        brand = BrandModel.create(**brand_data)
+
+        with self.app.test_request_context():
+            with captured_queries(db.engine) as queries:
+                self.assertEqual(brand, BrandModel.get(**brand_data))
+                self.assertEqual(brand, BrandModel.get(**brand_data))
+            self.assertEqual(1, len(queries))
+
+        with self.app.test_request_context(), captured_queries(db.engine) as queries:
+            BrandModel.get(**brand_data)
+        self.assertEqual(1, len(queries))
+
+    def test_missing_row_is_looked_up_again_after_changes(self):
+        brand_data = get_random_brand_data()
+
+        with self.app.test_request_context():
+            self.assertIsNone(BrandModel.get(**brand_data))
+            brand = BrandModel.create(**brand_data)
+            self.assertEqual(brand, BrandModel.get(**brand_data))
+
+            BrandModel.delete_all()
+            self.assertIsNone(BrandModel.get(**brand_data))
+
+    def test_exists_does_not_load_row(self):
+        brand_data = get_random_brand_data()
+        BrandModel.create(**brand_data)
+
+        with captured_queries(db.engine) as queries:
+            self.assertTrue(BrandModel.exists(**brand_data))
+            self.assertFalse(BrandModel.exists(name='Missing brand'))
+
+        self.assertEqual(2, len(queries))
+        self.assertTrue(all(query.startswith('SELECT EXISTS') for query in queries))
+
+    def test_exist_all_checks_lookups_in_one_query(self):
+        brand_data, category_data = get_random_brand_data(), get_random_category_data()
+        BrandModel.create(**brand_data)
+        CategoryModel.create(**category_data)
+
+        with self.app.test_request_context(), captured_queries(db.engine) as queries:
+            lookups = [(BrandModel, brand_data), (CategoryModel, category_data), (BrandModel, {'name': 'Missing'})]
+            self.assertListEqual([True, True, False], exist_all(lookups))
+            self.assertListEqual([True, True, False], exist_all(lookups))
+            self.assertTrue(BrandModel.exists(**brand_data))
+
+        self.assertEqual(1, len(queries))
+        CategoryModel.delete_all()
+
+    def test_exists_reuses_looked_up_row(self):
+        brand_data = get_random_brand_data()
+        BrandModel.create(**brand_data)
+
+        with self.app.test_request_context():
+            BrandModel.get(**brand_data)
+            with captured_queries(db.engine) as queries:
+                self.assertTrue(BrandModel.exists(**brand_data))
+
+        self.assertEqual(0, len(queries))
+
+
+class UnitOfWorkTests(BaseTestMixin):
+    def tearDown(self):
+        ProductModel.delete_all()
+        BrandModel.delete_all()
+        CategoryModel.delete_all()
+
+    def test_changes_are_committed_once(self):
+        with captured_commits(db.session) as commits:
+            with unit_of_work():
+                brand = BrandModel.create(**get_random_brand_data())
+                category = CategoryModel.create(**get_random_category_data())
+                product = ProductModel.create(**get_random_product_data())
+                product.brand = brand
+                product.category = category
+                product.save()
+                ProductModel.update(product.id, discount=5)
+                self.assertEqual(0, len(commits))
+                product_id, brand_id = product.id, brand.id
+
+        # Version stamps are bumped in the transaction of the unit
+        self.assertEqual(1, len(commits))
+
+        db.session.remove()
+        product = ProductModel.get(id=product_id)
+        self.assertEqual(brand_id, product.brand_id)
+        self.assertEqual(5, product.discount)
+
+    def test_failed_stamp_bump_rolls_back_unit(self):
+        with mock.patch.object(BrandModel, 'on_write', side_effect=IntegrityError('', {}, None)):
+            with self.assertRaises(IntegrityError):
+                with unit_of_work():
+                    BrandModel.create(**get_random_brand_data())
+
+        self.assertEqual(0, BrandModel.query.count())
+
+    def test_change_hooks_run_once_after_commit(self):
+        with mock.patch.object(BrandModel, 'on_change') as on_change:
+            with unit_of_work():
+                for _ in range(3):
+                    BrandModel.create(**get_random_brand_data())
+                on_change.assert_not_called()
+
+        on_change.assert_called_once_with()
+
+    def test_error_rolls_back_whole_unit(self):
+        existing = BrandModel.create(**get_random_brand_data())
+        with mock.patch.object(BrandModel, 'on_change') as on_change:
+            with self.assertRaises(IntegrityError):
+                with unit_of_work():
+                    BrandModel.create(**get_random_brand_data())
+                    BrandModel.create(name=existing.name)
+
+        self.assertListEqual([existing], BrandModel.query.all())
+        on_change.assert_not_called()
+
+    def test_nested_unit_joins_outer(self):
+        with captured_commits(db.session) as commits:
+            with unit_of_work():
+                with unit_of_work():
+                    BrandModel.create(**get_random_brand_data())
+                self.assertEqual(0, len(commits))
+                CategoryModel.create(**get_random_category_data())
+                self.assertEqual(0, len(commits))
+
+        self.assertEqual(1, BrandModel.query.count())
+        self.assertEqual(1, CategoryModel.query.count())
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+from unittest import mock
+
+from tests.mixins import BaseTestMixin
+from tests.utils import captured_commits
+
+from shop.db import db
+from shop.products.models import ProductModel
+from shop.products.search import (
+    rebuild_index,
+    search_products,
+    SearchDocumentModel,
+    SearchTermModel,
+    tokenize
+)
+from shop.seed_db import get_random_product_data, seed_brands, seed_categories
+
+
+class ProductSearchTests(BaseTestMixin):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        seed_brands(n_brands=2)
+        seed_categories(n_categories=2)
+
+    def tearDown(self):
+        ProductModel.delete_all()
+
+    @staticmethod
+    def search(text):
+        return search_products(text)[0]
+
+    def create_product(self, **fields):
+        product_data = get_random_product_data()
+        product_data.update(fields)
+        return ProductModel.create(**product_data)
+
+    def test_tokenize(self):
+        self.assertListEqual(['red', 'wooden', 'chair', 'kids'], tokenize('The red wooden chair, for KIDS!'))
+        self.assertListEqual([], tokenize(None))
+
+    def test_created_product_is_indexed(self):
+        product = self.create_product(name='Quantum toaster')
+
+        self.assertIsNotNone(SearchDocumentModel.query.get(product.id))
+        self.assertIsNotNone(SearchTermModel.query.get(('quantum', product.id)))
+        self.assertListEqual([product.id], self.search('quantum'))
+
+    def test_prefix_matching(self):
+        product = self.create_product(name='Quantum toaster')
+
+        self.assertListEqual([product.id], self.search('quant'))
+        self.assertListEqual([], self.search('qu'))
+
+    def test_name_match_ranks_above_description_match(self):
+        in_description = self.create_product(short_description='Works great with any zeppelin model at home')
+        in_name = self.create_product(name='Zeppelin lamp')
+
+        self.assertListEqual([in_name.id, in_description.id], self.search('zeppelin'))
+
+    def test_all_query_terms_add_up(self):
+        both = self.create_product(name='Velvet armchair')
+        one = self.create_product(name='Velvet curtain')
+
+        self.assertListEqual([both.id, one.id], self.search('velvet armchair'))
+
+    def test_page_of_results_with_total(self):
+        products = [self.create_product(name=f'Velvet chair {i}') for i in range(5)]
+        ids = self.search('velvet')
+
+        self.assertCountEqual([pr.id for pr in products], ids)
+        self.assertEqual((ids[2:4], 5), search_products('velvet', limit=2, offset=2))
+        self.assertEqual(([], 0), search_products('velvet', limit=2, offset=6))
+
+    def test_prefix_expansion_is_capped(self):
+        with mock.patch('shop.products.search.MAX_PREFIX_TERMS', 2):
+            first = self.create_product(name='Quantaa')
+            second = self.create_product(name='Quantab')
+            self.create_product(name='Quantac')
+
+            self.assertCountEqual([first.id, second.id], self.search('quanta'))
+
+    def test_product_is_indexed_in_its_transaction(self):
+        with captured_commits(db.session) as commits:
+            product = self.create_product(name='Quantum toaster')
+            ProductModel.update(_id=product.id, name='Plasma kettle')
+        # Catalog version stamps are bumped in the transaction of each change
+        self.assertEqual(2, len(commits))
+
+    def test_updated_product_is_reindexed(self):
+        product = self.create_product(name='Quantum toaster')
+
+        ProductModel.update(_id=product.id, name='Plasma kettle')
+        self.assertListEqual([], self.search('quantum'))
+        self.assertListEqual([product.id], self.search('plasma'))
+
+        product.name = 'Laser oven'
+        product.save()
+        self.assertListEqual([], self.search('plasma'))
+        self.assertListEqual([product.id], self.search('laser'))
+
+    def test_deleted_product_is_unindexed(self):
+        product = self.create_product(name='Quantum toaster')
+        product_id = product.id
+        product.delete()
+
+        self.assertListEqual([], self.search('quantum'))
+        self.assertEqual(0, SearchTermModel.query.filter_by(product_id=product_id).count())
+        self.assertIsNone(SearchDocumentModel.query.get(product_id))
+
+    def test_rebuild_index(self):
+        product = self.create_product(name='Quantum toaster')
+        SearchTermModel.query.delete()
+
+        rebuild_index(ProductModel.get_all())
+        self.assertListEqual([product.id], self.search('quantum'))
+
+
+if __name__ == "__main__":
+    unittest.main()
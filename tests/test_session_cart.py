@@ -1,12 +1,18 @@
+from datetime import datetime, timedelta
 from random import randint
 import unittest
+from unittest import mock
 
 from flask import session
 from flask_login import current_user, login_user, logout_user
+from sqlalchemy.exc import IntegrityError, OperationalError
 from tests.mixins import ClientRequestsMixin, UserMixin
+from tests.utils import captured_commits, captured_queries
 
+from shop.carts.models import CartItemModel, CartReservationModel, get_reservation_metrics, reservation_metrics
 from shop.carts.session_handler import SessionCart
-from shop.orders.models import OrderModel
+from shop.db import db
+from shop.orders.models import OrderModel, OrderProductModel
 from shop.products.models import ProductModel
 from shop.seed_db import (
     get_random_product_data,
@@ -236,6 +242,18 @@ class SessionCartTests(UserMixin, ClientRequestsMixin):
             self.assertEqual(pr.reserved, 0)
         self.assertEqual(session[SessionCart.CART_NAME], {})
 
+    def test_clear_cart_updates_products_at_once(self):
+        seed_products(n_products=5)
+        for pr in ProductModel.get_all():
+            SessionCart.add_product(pr.id, 1)
+
+        with captured_queries(db.engine) as queries:
+            SessionCart.clear_cart()
+
+        self.assertEqual(1, len([query for query in queries if query.startswith('UPDATE products')]))
+        for pr in ProductModel.get_all():
+            self.assertEqual(pr.reserved, 0)
+
     def test_make_order_from_empty_cart(self):
         with self.assertRaises(Exception) as context:
             SessionCart.make_order()
@@ -256,6 +274,8 @@ class SessionCartTests(UserMixin, ClientRequestsMixin):
         self.assertEqual(order.user, current_user)
         self.assertEqual(order.products.first().amount, amount_to_add)
         self.assertEqual(order.products.first().product, product)
+        self.assertEqual(order.total_items, amount_to_add)
+        self.assertTrue(abs(order.total_sum - round(product.discount_price * amount_to_add, 2)) <= 1e-3)
 
     def test_make_order_with_several_products(self):
         n_products = randint(2, 10)
@@ -280,6 +300,324 @@ class SessionCartTests(UserMixin, ClientRequestsMixin):
         actual_amounts = set((item.product.id, item.amount) for item in order.products.all())
         self.assertEqual(expected_amounts, actual_amounts)
 
+    def test_summary_is_read_without_queries(self):
+        seed_products(n_products=3)
+        for pr in ProductModel.get_all():
+            SessionCart.add_product(pr.id, 1)
+        SessionCart.remove_product(ProductModel.get_random().id, 1)
+
+        with captured_queries(db.engine) as queries:
+            items_count = SessionCart.get_items_count()
+            total_sum = SessionCart.get_total_sum()
+        self.assertEqual([], queries)
+
+        expected_sum = round(sum(pr.discount_price * amount for pr, amount in SessionCart.get_items()), 2)
+        self.assertEqual(2, items_count)
+        self.assertTrue(abs(expected_sum - total_sum) <= 1e-3)
+
+    def test_summary_follows_prices_on_cart_change(self):
+        product = ProductModel.create(**get_random_product_data())
+        SessionCart.add_product(product.id, 2)
+
+        product.price = product.price * 3
+        product.save()
+        SessionCart.remove_product(product.id, 1)
+        self.assertTrue(abs(product.discount_price - SessionCart.get_total_sum()) <= 1e-3)
+
+        SessionCart.remove_product(product.id, 1)
+        self.assertEqual(0, SessionCart.get_items_count())
+        self.assertEqual(0, SessionCart.get_total_sum())
+
+    def test_summary_follows_cart_changed_elsewhere(self):
+        product = ProductModel.create(**get_random_product_data())
+        SessionCart.add_product(product.id, 1)
+        # Another device of the user adds to the same stored cart
+        SessionCart.get_cart()[str(product.id)] = 3
+
+        self.assertEqual(3, SessionCart.get_items_count())
+        self.assertTrue(abs(product.discount_price * 3 - SessionCart.get_total_sum()) <= 1e-3)
+
+    def test_summary_size_does_not_grow_with_cart(self):
+        seed_products(n_products=20)
+        for pr in ProductModel.get_all():
+            SessionCart.add_product(pr.id, 1)
+
+        self.assertEqual({'items', 'total', 'digest'}, set(session[SessionCart.SUMMARY_NAME]))
+
+    def test_summary_is_computed_when_missing(self):
+        product = ProductModel.create(**get_random_product_data())
+        SessionCart.add_product(product.id, 1)
+        session.pop(SessionCart.SUMMARY_NAME)
+
+        self.assertEqual(1, SessionCart.get_items_count())
+        self.assertTrue(abs(product.discount_price - SessionCart.get_total_sum()) <= 1e-3)
+
+    def test_make_order_inserts_in_bulk(self):
+        seed_products(n_products=5)
+        for pr in ProductModel.get_all():
+            SessionCart.add_product(pr.id, 1)
+
+        with captured_queries(db.engine) as queries:
+            order = SessionCart.make_order()
+
+        self.assertEqual(1, len([query for query in queries if query.startswith('INSERT INTO orders')]))
+        self.assertEqual(1, len([query for query in queries if query.startswith('INSERT INTO order_product')]))
+        self.assertEqual(5, order.total_items)
+        self.assertEqual(5, order.products.count())
+
+    def test_make_order_failure_leaves_no_order(self):
+        product = ProductModel.create(**get_random_product_data())
+        SessionCart.add_product(product.id, 1)
+        add_with_products = OrderModel.add_with_products
+
+        def add_and_fail(*args):
+            add_with_products(*args)
+            raise IntegrityError('', {}, None)
+
+        with mock.patch.object(OrderModel, 'add_with_products', side_effect=add_and_fail):
+            with self.assertRaises(IntegrityError):
+                SessionCart.make_order()
+
+        self.assertEqual(0, OrderModel.query.count())
+        self.assertEqual(0, OrderProductModel.query.count())
+        self.assertEqual({str(product.id): 1}, session[SessionCart.CART_NAME])
+
+
+class CartReservationTests(UserMixin, ClientRequestsMixin):
+    def setUp(self):
+        login_user(self.user)
+        SessionCart.init_cart()
+        self.product = ProductModel.create(**dict(get_random_product_data(), amount=10))
+        self.cart_id = SessionCart.get_cart_id()
+
+    def tearDown(self):
+        SessionCart.clear_cart()
+        logout_user()
+        for pr in ProductModel.get_all():
+            pr.delete()
+        for order in OrderModel.get_all():
+            order.delete()
+
+    def expire_holds(self):
+        CartReservationModel.query.update({'expires_at': datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+
+    def test_add_product_holds_amount(self):
+        SessionCart.add_product(self.product.id, 1)
+        SessionCart.add_product(self.product.id, 1)
+
+        self.assertEqual({self.product.id: 2}, CartReservationModel.get_held(self.cart_id))
+
+    def test_hold_of_missing_product_fails_once(self):
+        with self.assertRaises(IntegrityError):
+            CartReservationModel.hold(self.cart_id, self.product.id + 1, 1, 60)
+        self.assertEqual(0, CartReservationModel.query.count())
+
+    def test_add_product_rolls_back_reservation_when_hold_fails(self):
+        with mock.patch.object(CartReservationModel, 'hold_all', side_effect=IntegrityError('', {}, None)):
+            with self.assertRaises(IntegrityError):
+                SessionCart.add_product(self.product.id, 1)
+
+        db.session.refresh(self.product)
+        self.assertEqual(0, self.product.reserved)
+        self.assertEqual({}, session[SessionCart.CART_NAME])
+
+    def test_add_products_rolls_back_on_database_error(self):
+        with mock.patch.object(CartReservationModel, 'hold_all', side_effect=OperationalError('', {}, None)):
+            with self.assertRaises(OperationalError):
+                SessionCart.add_products({self.product.id: 1})
+
+        db.session.refresh(self.product)
+        self.assertEqual(0, self.product.reserved)
+
+    def test_remove_product_drops_hold(self):
+        SessionCart.add_product(self.product.id, self.product.amount)
+        SessionCart.remove_product(self.product.id, 1)
+
+        self.assertEqual({self.product.id: self.product.amount - 1}, CartReservationModel.get_held(self.cart_id))
+        self.assertEqual(self.product.amount - 1, self.product.reserved)
+
+    def test_remove_product_keeps_hold_when_release_fails(self):
+        SessionCart.add_product(self.product.id, 2)
+        with mock.patch.object(ProductModel, 'release', side_effect=OperationalError('', {}, None)):
+            with self.assertRaises(OperationalError):
+                SessionCart.remove_product(self.product.id, 1)
+
+        db.session.refresh(self.product)
+        self.assertEqual({self.product.id: 2}, CartReservationModel.get_held(self.cart_id))
+        self.assertEqual(2, self.product.reserved)
+        self.assertEqual({str(self.product.id): 2}, session[SessionCart.CART_NAME])
+
+    def test_remove_product_commits_once(self):
+        SessionCart.add_product(self.product.id, 2)
+        with captured_commits(db.session) as commits:
+            SessionCart.remove_product(self.product.id, 1)
+        self.assertEqual(1, len(commits))
+
+    def test_release_expired_returns_stock(self):
+        SessionCart.add_product(self.product.id, self.product.amount)
+        self.expire_holds()
+        reclaimed_before = reservation_metrics['reclaimed_units']
+
+        released = CartReservationModel.release_expired(batch_size=1)
+
+        self.assertEqual(self.product.amount, released)
+        self.assertEqual(0, self.product.reserved)
+        self.assertEqual(0, CartReservationModel.query.count())
+        self.assertEqual(reclaimed_before + released, get_reservation_metrics()['reclaimed_units'])
+
+    def test_remove_product_after_release_does_not_release_twice(self):
+        SessionCart.add_product(self.product.id, 1)
+        self.expire_holds()
+        CartReservationModel.release_expired()
+        ProductModel.reserve(self.product.id, 1)
+
+        SessionCart.remove_product(self.product.id, 1)
+        self.assertEqual(1, self.product.reserved)
+        ProductModel.release(self.product.id, 1)
+
+    def test_revalidate_holds_expired_products_again(self):
+        SessionCart.add_product(self.product.id, 1)
+        self.expire_holds()
+        CartReservationModel.release_expired()
+
+        self.assertEqual([], SessionCart.revalidate())
+        self.assertEqual({str(self.product.id): 1}, session[SessionCart.CART_NAME])
+        self.assertEqual({self.product.id: 1}, CartReservationModel.get_held(self.cart_id))
+        self.assertEqual(1, self.product.reserved)
+
+    def test_revalidate_drops_sold_out_products(self):
+        SessionCart.add_product(self.product.id, 1)
+        self.expire_holds()
+        CartReservationModel.release_expired()
+        ProductModel.reserve(self.product.id, self.product.amount)
+
+        self.assertEqual([self.product.id], SessionCart.revalidate())
+        self.assertEqual({}, session[SessionCart.CART_NAME])
+        ProductModel.release(self.product.id, self.product.amount)
+
+    def test_make_order_moves_holds_to_order(self):
+        SessionCart.add_product(self.product.id, 1)
+        SessionCart.make_order()
+
+        self.assertEqual(0, CartReservationModel.query.count())
+        self.assertEqual(1, self.product.reserved)
+
+    def test_make_order_commits_once(self):
+        SessionCart.add_product(self.product.id, 2)
+        self.expire_holds()
+
+        with captured_commits(db.session) as commits:
+            SessionCart.make_order()
+
+        self.assertEqual(1, len(commits))
+        self.assertEqual(0, CartReservationModel.query.count())
+        self.assertEqual(2, self.product.reserved)
+
+    def test_metrics(self):
+        SessionCart.add_product(self.product.id, 2)
+        ProductModel.reserve(self.product.id, 1)
+
+        metrics = get_reservation_metrics()
+        self.assertEqual(2, metrics['held_units'])
+        self.assertEqual(0, metrics['expired_units'])
+        self.assertEqual(1, metrics['leaked_units'])
+        ProductModel.release(self.product.id, 1)
+
+
+class DatabaseCartStoreTests(UserMixin, ClientRequestsMixin):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.app.config['CART_STORE'] = 'database'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.app.config['CART_STORE'] = 'cookie'
+        super().tearDownClass()
+
+    def setUp(self):
+        login_user(self.user)
+        SessionCart.init_cart()
+        self.products = [ProductModel.create(**dict(get_random_product_data(), amount=10)) for _ in range(3)]
+
+    def tearDown(self):
+        SessionCart.clear_cart()
+        SessionCart.flush()
+        logout_user()
+        for pr in ProductModel.get_all():
+            pr.delete()
+        for order in OrderModel.get_all():
+            order.delete()
+
+    def test_cart_is_not_kept_in_cookie(self):
+        SessionCart.add_product(self.products[0].id, 1)
+
+        self.assertFalse(SessionCart.CART_NAME in session)
+        self.assertEqual({str(self.products[0].id): 1}, SessionCart.get_cart())
+
+    def test_flush_persists_cart(self):
+        for pr in self.products:
+            SessionCart.add_product(pr.id, 1)
+        SessionCart.flush()
+
+        self.assertEqual({str(pr.id): 1 for pr in self.products}, CartItemModel.get_items(self.user.id))
+        self.assertEqual(len(self.products), SessionCart.get_items_count())
+
+    def test_flush_writes_changes_in_batches(self):
+        for pr in self.products:
+            SessionCart.add_product(pr.id, 1)
+
+        with captured_queries(db.engine) as queries:
+            SessionCart.flush()
+        self.assertEqual(1, len([query for query in queries if query.startswith('INSERT')]))
+
+        SessionCart.remove_product(self.products[0].id, 1)
+        for pr in self.products[1:]:
+            SessionCart.add_product(pr.id, 1)
+
+        with captured_queries(db.engine) as queries:
+            SessionCart.flush()
+        self.assertEqual(1, len([query for query in queries if query.startswith('DELETE')]))
+        self.assertEqual(1, len([query for query in queries if query.startswith('UPDATE')]))
+
+        expected_items = {str(pr.id): 2 for pr in self.products[1:]}
+        self.assertEqual(expected_items, CartItemModel.get_items(self.user.id))
+
+    def test_flush_skips_products_deleted_meanwhile(self):
+        for pr in self.products:
+            SessionCart.add_product(pr.id, 1)
+        deleted_id = self.products[0].id
+        ProductModel.bulk_delete(ProductModel.id == deleted_id)
+
+        SessionCart.flush()
+
+        self.assertEqual({str(pr.id): 1 for pr in self.products[1:]}, CartItemModel.get_items(self.user.id))
+
+    def test_flush_over_concurrently_added_items(self):
+        SessionCart.add_product(self.products[0].id, 2)
+        CartItemModel.create(user_id=self.user.id, product_id=self.products[0].id, amount=1)
+
+        SessionCart.flush()
+
+        self.assertEqual({str(self.products[0].id): 2}, CartItemModel.get_items(self.user.id))
+
+    def test_cart_is_kept_after_logout(self):
+        SessionCart.add_product(self.products[0].id, 1)
+        SessionCart.flush()
+
+        SessionCart.close_cart()
+        SessionCart.flush()
+        self.assertEqual({str(self.products[0].id): 1}, CartItemModel.get_items(self.user.id))
+
+    def test_make_order(self):
+        SessionCart.add_product(self.products[0].id, 1)
+        SessionCart.make_order()
+        SessionCart.flush()
+
+        self.assertEqual({}, CartItemModel.get_items(self.user.id))
+        self.assertEqual(1, OrderModel.get_random().total_items)
+
 
 if __name__ == "__main__":
     unittest.main()
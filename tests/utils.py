@@ -1,6 +1,9 @@
 from contextlib import contextmanager
+import socketserver
+import threading
 
 from flask import template_rendered, url_for
+from sqlalchemy import event
 
 
 @contextmanager
@@ -17,6 +20,34 @@ def captured_templates(app):
         template_rendered.disconnect(record, app)
 
 
+@contextmanager
+def captured_queries(engine):
+    recorded = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        recorded.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield recorded
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+@contextmanager
+def captured_commits(session):
+    recorded = []
+
+    def record(session):
+        recorded.append(session)
+
+    event.listen(session, 'after_commit', record)
+    try:
+        yield recorded
+    finally:
+        event.remove(session, 'after_commit', record)
+
+
 def login(client, email, password):
     return client.post(url_for('users_blueprint.login'), data=dict(
         email=email,
@@ -26,3 +57,61 @@ def login(client, email, password):
 
 def logout(client):
     return client.get(url_for('users_blueprint.logout'), follow_redirects=True)
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """Minimal SMTP server on localhost, keeps received messages and counts connections"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, rejected_recipients=()):
+        super().__init__(('127.0.0.1', 0), _SMTPHandler)
+        self.rejected_recipients = set(rejected_recipients)
+        self.messages = []
+        self.connections = 0
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost ready')
+        recipients = []
+        for raw_line in self.rfile:
+            command = raw_line.decode('utf-8').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb == 'RCPT':
+                recipient = command.split(':', 1)[1].strip('<> ')
+                if recipient in self.server.rejected_recipients:
+                    self.reply('550 mailbox unavailable')
+                    continue
+                recipients.append(recipient)
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 end data with <CR><LF>.<CR><LF>')
+                data = b''.join(iter(self.rfile.readline, b'.\r\n'))
+                self.server.messages.append((recipients, data.decode('utf-8')))
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                break
+            else:
+                if verb in ('MAIL', 'RSET'):
+                    recipients = []
+                self.reply('250 OK')
@@ -8,6 +8,7 @@ from tests.utils import captured_templates
 from shop.orders.models import OrderModel
 from shop.products.models import ProductModel
 from shop.seed_db import (
+    get_random_product_data,
     seed_brands,
     seed_categories,
     seed_products,
@@ -244,5 +245,86 @@ class CartPageUserTests(UserMixin, CartPageAnonymousUserTests):
             self.assertEqual(0, len(context['items']))
 
 
+class AddCartItemsAnonymousUserTests(ClientRequestsMixin):
+    def test_post_items(self):
+        response = self.client.post(url_for('carts_blueprint.add_items'), json={'items': []})
+        self.assertEqual(302, response.status_code)
+
+
+class AddCartItemsSuperuserTests(SuperuserMixin, AddCartItemsAnonymousUserTests):
+    def test_post_items(self):
+        response = self.client.post(url_for('carts_blueprint.add_items'), json={'items': []})
+        self.assertEqual(403, response.status_code)
+
+
+class AddCartItemsUserTests(UserMixin, AddCartItemsAnonymousUserTests):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        seed_brands(n_brands=2)
+        seed_categories(n_categories=2)
+
+    def setUp(self):
+        super().setUp()
+        self.products = [ProductModel.create(**dict(get_random_product_data(), amount=5)) for _ in range(3)]
+
+    def tearDown(self):
+        self.client.post(url_for('carts_blueprint.cart'), data={'clear_cart-submit': True})
+        super().tearDown()
+        ProductModel.delete_all()
+
+    def test_post_items(self):
+        items = [{'product_id': pr.id, 'amount': 2} for pr in self.products]
+        response = self.client.post(url_for('carts_blueprint.add_items'), json={'items': items})
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(6, response.json['items'])
+        expected_total = round(sum(pr.discount_price * 2 for pr in self.products), 2)
+        self.assertTrue(abs(expected_total - response.json['total']) <= 1e-3)
+        for pr in self.products:
+            self.assertEqual(2, pr.reserved)
+
+    def test_post_duplicate_items(self):
+        product = self.products[0]
+        items = [{'product_id': product.id, 'amount': 1}, {'product_id': product.id, 'amount': 2}]
+        response = self.client.post(url_for('carts_blueprint.add_items'), json={'items': items})
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, response.json['items'])
+        self.assertEqual(3, product.reserved)
+
+    def test_post_too_much_product_amount(self):
+        items = [
+            {'product_id': self.products[0].id, 'amount': 1},
+            {'product_id': self.products[1].id, 'amount': 6},
+        ]
+        response = self.client.post(url_for('carts_blueprint.add_items'), json={'items': items})
+
+        self.assertEqual(409, response.status_code)
+        self.assertEqual([self.products[1].id], response.json['product_ids'])
+        for pr in self.products:
+            self.assertEqual(0, pr.reserved)
+
+    def test_post_non_existent_product(self):
+        items = [{'product_id': max(pr.id for pr in self.products) + 1, 'amount': 1}]
+        response = self.client.post(url_for('carts_blueprint.add_items'), json={'items': items})
+        self.assertEqual(409, response.status_code)
+
+    def test_post_invalid_items(self):
+        invalid_payloads = (
+            {},
+            {'items': []},
+            {'items': [{'product_id': '1'}]},
+            {'items': [{'product_id': 1, 'amount': 0}]},
+        )
+        for payload in invalid_payloads:
+            response = self.client.post(url_for('carts_blueprint.add_items'), json=payload)
+            self.assertEqual(400, response.status_code)
+
+    def test_post_form_data(self):
+        response = self.client.post(url_for('carts_blueprint.add_items'), data={'product_id': self.products[0].id})
+        self.assertEqual(415, response.status_code)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -2,8 +2,9 @@ import unittest
 
 from flask import url_for
 from tests.mixins import ClientRequestsMixin, SuperuserMixin, UserMixin
-from tests.utils import captured_templates
+from tests.utils import captured_queries, captured_templates
 
+from shop.db import db
 from shop.orders.models import OrderModel
 from shop.seed_db import (
     seed_brands,
@@ -93,6 +94,13 @@ class UpdateProductPageSuperuserTests(SuperuserMixin, OrdersListAnonymousUserPag
             self.assertFalse(any(order.is_completed for order in context['orders']))
             self.assertEqual('False', context['kwargs']['completed'])
 
+    def test_get_page_queries_do_not_grow_with_orders(self):
+        with captured_queries(db.engine) as queries:
+            response = self.client.get(url_for('orders_blueprint.orders_list'))
+
+        self.assertEqual(200, response.status_code)
+        self.assertLess(len(queries), OrderModel.PAGINATE_BY)
+
     def test_post_complete_order(self):
         order = OrderModel.get_random()
 
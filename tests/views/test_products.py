@@ -1,11 +1,14 @@
 from random import randint
 import unittest
 
-from flask import url_for
+from flask import g, url_for
+from sqlalchemy import text
 from tests.mixins import ClientRequestsMixin, SuperuserMixin, UserMixin
-from tests.utils import captured_templates
+from tests.utils import captured_commits, captured_queries, captured_templates
 
-from shop.products.models import BrandModel, CategoryModel, ProductModel
+from shop.core.pagination import encode_cursor
+from shop.db import db
+from shop.products.models import BrandModel, catalog_page_cache, CategoryModel, ProductModel
 from shop.seed_db import (
     fake,
     get_random_brand_data,
@@ -56,8 +59,8 @@ class ProductsPageTests(ClientRequestsMixin):
             template, context = templates[0]
             self.assertEqual(template.name, 'products/products_list.html')
             self.assertEqual(context['page'], 1)
-            self.assertListEqual(context['brands'], BrandModel.get_all())
-            self.assertListEqual(context['categories'], CategoryModel.get_all())
+            self.assertListEqual(context['brands'], [(br.id, br.name) for br in BrandModel.get_all()])
+            self.assertListEqual(context['categories'], [(ct.id, ct.name) for ct in CategoryModel.get_all()])
             self.assertListEqual(context['products'], ProductModel.get_all())
 
             self.assertEqual(context['kwargs']['brand_name'], None)
@@ -76,14 +79,14 @@ class ProductsPageTests(ClientRequestsMixin):
             template, context = templates[0]
 
             self.assertEqual(context['page'], 1)
-            self.assertListEqual(context['brands'], BrandModel.get_all())
-            self.assertListEqual(context['categories'], CategoryModel.get_all())
+            self.assertListEqual(context['brands'], [(br.id, br.name) for br in BrandModel.get_all()])
+            self.assertListEqual(context['categories'], [(ct.id, ct.name) for ct in CategoryModel.get_all()])
 
             expected_products = ProductModel.query.filter_by(brand=brand).all()
             actual_products = context['products']
             self.assertSetEqual(set(expected_products), set(actual_products))
 
-            self.assertEqual(context['kwargs']['brand_name'], brand.name)
+            self.assertEqual(context['kwargs']['brand_name'], [brand.name])
             self.assertEqual(context['kwargs']['category_name'], None)
 
     def test_page_get_products_for_category(self):
@@ -99,15 +102,15 @@ class ProductsPageTests(ClientRequestsMixin):
             template, context = templates[0]
 
             self.assertEqual(context['page'], 1)
-            self.assertListEqual(context['brands'], BrandModel.get_all())
-            self.assertListEqual(context['categories'], CategoryModel.get_all())
+            self.assertListEqual(context['brands'], [(br.id, br.name) for br in BrandModel.get_all()])
+            self.assertListEqual(context['categories'], [(ct.id, ct.name) for ct in CategoryModel.get_all()])
 
             expected_products = ProductModel.query.filter_by(category=category).all()
             actual_products = context['products']
             self.assertSetEqual(set(expected_products), set(actual_products))
 
             self.assertEqual(context['kwargs']['brand_name'], None)
-            self.assertEqual(context['kwargs']['category_name'], category.name)
+            self.assertEqual(context['kwargs']['category_name'], [category.name])
 
     def test_get_valid_random_page(self):
         seed_brands(n_brands=5)
@@ -145,7 +148,7 @@ class ProductsPageTests(ClientRequestsMixin):
             self.assertNotEqual(context['pagination'].pages, 10)
             self.assertTrue(all(pr.brand == brand for pr in context['products']))
 
-            self.assertEqual(context['kwargs']['brand_name'], brand.name)
+            self.assertEqual(context['kwargs']['brand_name'], [brand.name])
             self.assertEqual(context['kwargs']['category_name'], None)
 
     def test_get_next_page_with_category_filter(self):
@@ -166,7 +169,7 @@ class ProductsPageTests(ClientRequestsMixin):
             self.assertTrue(all(pr.category == category for pr in context['products']))
 
             self.assertEqual(context['kwargs']['brand_name'], None)
-            self.assertEqual(context['kwargs']['category_name'], category.name)
+            self.assertEqual(context['kwargs']['category_name'], [category.name])
 
     def test_get_too_big_page_with_no_products(self):
         with captured_templates(self.app) as templates:
@@ -217,6 +220,504 @@ class ProductsPageTests(ClientRequestsMixin):
             self.assertEqual(template.name, 'errors/404.html')
 
 
+class ProductsPageKeysetPaginationTests(ClientRequestsMixin):
+    def tearDown(self):
+        ProductModel.delete_all()
+        BrandModel.delete_all()
+        CategoryModel.delete_all()
+
+    def test_get_first_page(self):
+        seed_brands(n_brands=5)
+        seed_categories(n_categories=5)
+        seed_products(n_products=2 * ProductModel.PAGINATE_BY)
+
+        with captured_templates(self.app) as templates:
+            response = self.client.get(url_for('products_blueprint.products', cursor=''))
+
+            self.assertEqual(response.status_code, 200)
+            template, context = templates[0]
+
+            expected_products = ProductModel.get_all()[:ProductModel.PAGINATE_BY]
+            self.assertListEqual(context['products'], expected_products)
+            self.assertFalse(context['pagination'].has_prev)
+            self.assertTrue(context['pagination'].has_next)
+
+    def test_walk_all_pages_forward_and_back(self):
+        seed_brands(n_brands=5)
+        seed_categories(n_categories=5)
+        seed_products(n_products=3 * ProductModel.PAGINATE_BY + 1)
+
+        seen_products, cursor, pages = [], '', []
+        while cursor is not None:
+            with captured_templates(self.app) as templates:
+                response = self.client.get(url_for('products_blueprint.products', cursor=cursor))
+                self.assertEqual(response.status_code, 200)
+
+                _, context = templates[0]
+                seen_products.extend(context['products'])
+                pages.append(context['pagination'])
+                cursor = context['pagination'].next_cursor
+
+        self.assertEqual(len(pages), 4)
+        self.assertListEqual(seen_products, ProductModel.get_all())
+
+        with captured_templates(self.app) as templates:
+            self.client.get(url_for('products_blueprint.products', cursor=pages[-1].prev_cursor))
+
+            _, context = templates[0]
+            self.assertListEqual(context['products'], pages[-2].items)
+
+    def test_get_next_page_with_brand_filter(self):
+        seed_categories(n_categories=5)
+        seed_brands(n_brands=2)
+        brand = BrandModel.get_random()
+        seed_products(n_products=6 * ProductModel.PAGINATE_BY)
+
+        expected_products = ProductModel.query.filter_by(brand=brand).order_by(ProductModel.name).all()
+        first_page = ProductModel.get_keyset_pagination('', ProductModel.filter(brand=brand))
+
+        with captured_templates(self.app) as templates:
+            response = self.client.get(url_for(
+                'products_blueprint.products', cursor=first_page.next_cursor, brand_name=brand.name,
+            ))
+
+            self.assertEqual(response.status_code, 200)
+            _, context = templates[0]
+
+            expected_page = expected_products[ProductModel.PAGINATE_BY:2 * ProductModel.PAGINATE_BY]
+            self.assertListEqual(context['products'], expected_page)
+            self.assertEqual(context['kwargs']['brand_name'], [brand.name])
+
+    def test_get_page_with_mistyped_cursor(self):
+        for values in (['a', 'x'], ['a'], [['a'], 1], ['a', True], [1, 1]):
+            with self.subTest(values=values):
+                cursor = encode_cursor(values, 'next')
+                response = self.client.get(url_for('products_blueprint.products', cursor=cursor))
+                self.assertEqual(response.status_code, 404)
+
+    def test_get_page_with_invalid_cursor(self):
+        with captured_templates(self.app) as templates:
+            response = self.client.get(url_for('products_blueprint.products', cursor=fake.word()))
+
+            self.assertEqual(response.status_code, 404)
+            template, _ = templates[0]
+            self.assertEqual(template.name, 'errors/404.html')
+
+
+class ProductsPageFacetsTests(ClientRequestsMixin):
+    def setUp(self):
+        seed_brands(n_brands=3)
+        seed_categories(n_categories=3)
+        seed_products(n_products=4 * ProductModel.PAGINATE_BY)
+
+    def tearDown(self):
+        ProductModel.delete_all()
+        BrandModel.delete_all()
+        CategoryModel.delete_all()
+
+    def test_filter_by_several_brands(self):
+        brands = BrandModel.get_all()[:2]
+        brand_names = [br.name for br in brands]
+
+        with captured_templates(self.app) as templates:
+            response = self.client.get(url_for('products_blueprint.products', brand_name=brand_names))
+
+            self.assertEqual(response.status_code, 200)
+            template, context = templates[0]
+
+            expected_total = ProductModel.query.filter(ProductModel.brand_id.in_([br.id for br in brands])).count()
+            self.assertEqual(context['pagination'].total, expected_total)
+            self.assertTrue(all(pr.brand in brands for pr in context['products']))
+            self.assertEqual(context['kwargs']['brand_name'], brand_names)
+
+    def test_filter_by_price_band_discount_and_stock(self):
+        with captured_templates(self.app) as templates:
+            response = self.client.get(url_for(
+                'products_blueprint.products', price=['0-25', '25-50'], discounted='1', in_stock='1',
+            ))
+
+            self.assertEqual(response.status_code, 200)
+            template, context = templates[0]
+
+            expected_products = [
+                pr for pr in ProductModel.get_all()
+                if pr.discount_price < 50 and pr.discount > 0 and pr.available > 0
+            ]
+            self.assertEqual(context['pagination'].total, len(expected_products))
+            self.assertTrue(all(pr in expected_products for pr in context['products']))
+
+    def test_facet_counts_without_selection(self):
+        with captured_templates(self.app) as templates:
+            self.client.get(url_for('products_blueprint.products'))
+            template, context = templates[0]
+
+            counts = context['facet_counts']
+            for brand in BrandModel.get_all():
+                self.assertEqual(counts['brand'][brand.name], len(brand.products))
+            for category in CategoryModel.get_all():
+                self.assertEqual(counts['category'][category.name], len(category.products))
+
+            all_products = ProductModel.get_all()
+            self.assertEqual(counts['discounted']['1'], len([pr for pr in all_products if pr.discount > 0]))
+            self.assertEqual(counts['in_stock']['1'], len([pr for pr in all_products if pr.available > 0]))
+            self.assertEqual(sum(counts['price'].values()), len(all_products))
+
+    def test_facet_counts_apply_other_facets_selection(self):
+        brand = BrandModel.get_random()
+
+        with captured_templates(self.app) as templates:
+            self.client.get(url_for('products_blueprint.products', brand_name=brand.name))
+            template, context = templates[0]
+
+            counts = context['facet_counts']
+            for category in CategoryModel.get_all():
+                expected = len([pr for pr in category.products if pr.brand == brand])
+                self.assertEqual(counts['category'][category.name], expected)
+            for other_brand in BrandModel.get_all():
+                self.assertEqual(counts['brand'][other_brand.name], len(other_brand.products))
+
+    def test_facet_toggle_links(self):
+        brand, other_brand = BrandModel.get_all()[:2]
+
+        with captured_templates(self.app) as templates:
+            self.client.get(url_for('products_blueprint.products', brand_name=brand.name))
+            template, context = templates[0]
+
+            selection = context['selection']
+            self.assertEqual(selection.url_args('brand', brand.name)['brand_name'], None)
+            expected_names = [brand.name, other_brand.name]
+            self.assertEqual(selection.url_args('brand', other_brand.name)['brand_name'], expected_names)
+
+
+class ProductsPageSortingTests(ClientRequestsMixin):
+    def setUp(self):
+        seed_brands(n_brands=2)
+        seed_categories(n_categories=2)
+        seed_products(n_products=3 * ProductModel.PAGINATE_BY)
+
+    def tearDown(self):
+        ProductModel.delete_all()
+        BrandModel.delete_all()
+        CategoryModel.delete_all()
+
+    def get_products(self, **args):
+        with captured_templates(self.app) as templates:
+            response = self.client.get(url_for('products_blueprint.products', **args))
+            self.assertEqual(response.status_code, 200)
+            template, context = templates[0]
+            return context
+
+    def test_sort_by_price(self):
+        products = self.get_products(sort='price_asc')['products']
+        prices = [pr.discount_price for pr in products]
+        self.assertListEqual(prices, sorted(prices))
+        self.assertEqual(prices[0], min(pr.discount_price for pr in ProductModel.get_all()))
+
+        products = self.get_products(sort='price_desc')['products']
+        prices = [pr.discount_price for pr in products]
+        self.assertListEqual(prices, sorted(prices, reverse=True))
+
+    def test_sort_by_discount_and_stock(self):
+        discounts = [pr.discount for pr in self.get_products(sort='discount')['products']]
+        self.assertListEqual(discounts, sorted(discounts, reverse=True))
+
+        available = [pr.available for pr in self.get_products(sort='stock')['products']]
+        self.assertListEqual(available, sorted(available, reverse=True))
+
+    def test_sort_newest(self):
+        products = self.get_products(sort='newest')['products']
+        expected = ProductModel.query.order_by(ProductModel.id.desc()).limit(ProductModel.PAGINATE_BY).all()
+        self.assertListEqual(products, expected)
+
+    def test_unknown_sort_falls_back_to_name(self):
+        context = self.get_products(sort=fake.word())
+        self.assertListEqual(context['products'], ProductModel.get_all()[:ProductModel.PAGINATE_BY])
+        self.assertIsNone(context['kwargs']['sort'])
+
+    def test_keyset_pages_with_descending_sort(self):
+        seen_products, cursor = [], ''
+        while cursor is not None:
+            context = self.get_products(sort='price_desc', cursor=cursor)
+            seen_products.extend(context['products'])
+            cursor = context['pagination'].next_cursor
+
+        expected = ProductModel.query.order_by(ProductModel.effective_price.desc(), ProductModel.id.desc()).all()
+        self.assertListEqual(seen_products, expected)
+
+    def test_stored_columns_follow_product_changes(self):
+        product = ProductModel.get_random()
+        ProductModel.update(_id=product.id, price=100, discount=25)
+        product.reserved = product.amount
+        product.save()
+
+        product = ProductModel.get(id=product.id)
+        self.assertEqual(product.effective_price, 75)
+        self.assertEqual(product.available_amount, 0)
+
+    def test_price_sort_uses_index(self):
+        query = ProductModel.order_by_sort(ProductModel.query, 'price_asc').limit(ProductModel.PAGINATE_BY)
+        statement = str(query.statement.compile(compile_kwargs={'literal_binds': True}))
+        plan = ' '.join(str(row) for row in db.session.execute(text('EXPLAIN QUERY PLAN ' + statement)))
+
+        self.assertIn('ix_products_effective_price_id', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class ConditionalGetTests(ClientRequestsMixin):
+    def setUp(self):
+        seed_brands(n_brands=2)
+        seed_categories(n_categories=2)
+        seed_products(n_products=2)
+
+    def tearDown(self):
+        ProductModel.delete_all()
+        BrandModel.delete_all()
+        CategoryModel.delete_all()
+
+    def test_catalog_not_modified(self):
+        response = self.client.get(url_for('products_blueprint.products'))
+        etag, _ = response.get_etag()
+        self.assertIsNotNone(etag)
+        self.assertIsNotNone(response.last_modified)
+
+        with captured_templates(self.app) as templates:
+            response = self.client.get(url_for('products_blueprint.products'), headers={'If-None-Match': f'"{etag}"'})
+
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(len(templates), 0)
+
+    def test_catalog_modified_after_product_change(self):
+        response = self.client.get(url_for('products_blueprint.products'))
+        etag, _ = response.get_etag()
+
+        ProductModel.create(**get_random_product_data())
+        response = self.client.get(url_for('products_blueprint.products'), headers={'If-None-Match': f'"{etag}"'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.get_etag()[0], etag)
+
+    def test_catalog_modified_after_brand_change(self):
+        response = self.client.get(url_for('products_blueprint.products'))
+        etag, _ = response.get_etag()
+
+        brand = BrandModel.get_random()
+        BrandModel.update(_id=brand.id, name='New ' + brand.name)
+        response = self.client.get(url_for('products_blueprint.products'), headers={'If-None-Match': f'"{etag}"'})
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_product_detail_not_modified(self):
+        product = ProductModel.get_random()
+        response = self.client.get(url_for('products_blueprint.product_detail', product_id=product.id))
+        etag, _ = response.get_etag()
+
+        response = self.client.get(
+            url_for('products_blueprint.product_detail', product_id=product.id),
+            headers={'If-None-Match': f'"{etag}"'},
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_product_detail_modified_after_update(self):
+        product = ProductModel.get_random()
+        response = self.client.get(url_for('products_blueprint.product_detail', product_id=product.id))
+        etag, _ = response.get_etag()
+
+        ProductModel.update(_id=product.id, price=product.price + 1)
+        response = self.client.get(
+            url_for('products_blueprint.product_detail', product_id=product.id),
+            headers={'If-None-Match': f'"{etag}"'},
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_product_detail_not_modified_since(self):
+        product = ProductModel.get_random()
+        response = self.client.get(url_for('products_blueprint.product_detail', product_id=product.id))
+
+        response = self.client.get(
+            url_for('products_blueprint.product_detail', product_id=product.id),
+            headers={'If-Modified-Since': response.headers['Last-Modified']},
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_non_existent_product_detail(self):
+        response = self.client.get(url_for('products_blueprint.product_detail', product_id=randint(1000, 2000)))
+
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(response.get_etag()[0])
+
+
+class ConditionalGetUserTests(UserMixin, ClientRequestsMixin):
+    def test_authenticated_user_gets_full_page(self):
+        response = self.client.get(url_for('products_blueprint.products'))
+        self.assertIsNone(response.get_etag()[0])
+
+        response = self.client.get(url_for('products_blueprint.products'), headers={'If-None-Match': '*'})
+        self.assertEqual(response.status_code, 200)
+
+
+class CatalogPageCacheTests(ClientRequestsMixin):
+    def setUp(self):
+        self.app.config['PAGE_CACHE_ENABLED'] = True
+        catalog_page_cache.invalidate()
+        seed_brands(n_brands=2)
+        seed_categories(n_categories=2)
+        seed_products(n_products=2)
+
+    def tearDown(self):
+        self.app.config['PAGE_CACHE_ENABLED'] = False
+        ProductModel.delete_all()
+        BrandModel.delete_all()
+        CategoryModel.delete_all()
+
+    def test_second_request_served_from_cache(self):
+        hits = catalog_page_cache.hits
+        first_response = self.client.get(url_for('products_blueprint.products'))
+        self.assertEqual(first_response.headers['X-Page-Cache'], 'MISS')
+
+        with captured_templates(self.app) as templates:
+            response = self.client.get(url_for('products_blueprint.products'))
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['X-Page-Cache'], 'HIT')
+            self.assertEqual(len(templates), 0)
+            self.assertEqual(response.get_data(), first_response.get_data())
+            self.assertEqual(catalog_page_cache.hits, hits + 1)
+
+    def test_normalized_query_args_share_entry(self):
+        brand, other_brand = BrandModel.get_all()
+        self.client.get(url_for('products_blueprint.products', brand_name=[brand.name, other_brand.name]))
+
+        response = self.client.get(url_for('products_blueprint.products', brand_name=[other_brand.name, brand.name]))
+        self.assertEqual(response.headers['X-Page-Cache'], 'HIT')
+
+    def test_product_change_invalidates_cache(self):
+        self.client.get(url_for('products_blueprint.products'))
+        ProductModel.create(**get_random_product_data())
+
+        response = self.client.get(url_for('products_blueprint.products'))
+        self.assertEqual(response.headers['X-Page-Cache'], 'MISS')
+
+    def test_brand_change_invalidates_cache(self):
+        product = ProductModel.get_random()
+        self.client.get(url_for('products_blueprint.product_detail', product_id=product.id))
+        BrandModel.update(_id=product.brand.id, name='New ' + product.brand.name)
+
+        response = self.client.get(url_for('products_blueprint.product_detail', product_id=product.id))
+        self.assertEqual(response.headers['X-Page-Cache'], 'MISS')
+        self.assertIn(product.brand.name, response.get_data(as_text=True))
+
+    def test_cached_page_has_no_csrf_tokens(self):
+        self.app.config['WTF_CSRF_ENABLED'] = True
+        try:
+            self.client.get(url_for('products_blueprint.products'))
+            response = self.client.get(url_for('products_blueprint.products'))
+        finally:
+            self.app.config['WTF_CSRF_ENABLED'] = False
+            g.pop('csrf_token', None)
+
+        self.assertEqual(response.headers['X-Page-Cache'], 'HIT')
+        self.assertNotIn('csrf_token', response.get_data(as_text=True))
+
+    def test_cache_stats_are_logged(self):
+        self.app.config['PAGE_CACHE_STATS_INTERVAL'] = 1
+        try:
+            with self.assertLogs('shop.core.conditional', level='INFO') as logs:
+                self.client.get(url_for('products_blueprint.products'))
+                self.client.get(url_for('products_blueprint.products'))
+        finally:
+            self.app.config['PAGE_CACHE_STATS_INTERVAL'] = 1000
+
+        self.assertEqual(2, len(logs.records))
+        self.assertIn('hits=', logs.output[-1])
+
+    def test_cache_size_is_bounded(self):
+        maxsize = catalog_page_cache.maxsize
+        catalog_page_cache.configure(maxsize=1, ttl=None)
+        try:
+            self.client.get(url_for('products_blueprint.products', page=1))
+            self.client.get(url_for('products_blueprint.products', brand_name=BrandModel.get_random().name))
+
+            self.assertEqual(catalog_page_cache.stats()['size'], 1)
+            response = self.client.get(url_for('products_blueprint.products', page=1))
+            self.assertEqual(response.headers['X-Page-Cache'], 'MISS')
+        finally:
+            catalog_page_cache.configure(maxsize=maxsize, ttl=self.app.config['PAGE_CACHE_TTL'])
+
+
+class CatalogPageCacheUserTests(UserMixin, ClientRequestsMixin):
+    def setUp(self):
+        super().setUp()
+        self.app.config['PAGE_CACHE_ENABLED'] = True
+
+    def tearDown(self):
+        self.app.config['PAGE_CACHE_ENABLED'] = False
+        super().tearDown()
+
+    def test_authenticated_user_bypasses_cache(self):
+        self.client.get(url_for('products_blueprint.products'))
+        response = self.client.get(url_for('products_blueprint.products'))
+
+        self.assertNotIn('X-Page-Cache', response.headers)
+
+
+class SearchPageTests(ClientRequestsMixin):
+    def tearDown(self):
+        ProductModel.delete_all()
+        BrandModel.delete_all()
+        CategoryModel.delete_all()
+
+    def test_search_with_empty_query(self):
+        with captured_templates(self.app) as templates:
+            response = self.client.get(url_for('products_blueprint.search'))
+
+            self.assertEqual(response.status_code, 200)
+            template, context = templates[0]
+            self.assertEqual(template.name, 'products/search.html')
+            self.assertListEqual(context['products'], [])
+            self.assertEqual(context['query'], '')
+
+    def test_search_finds_product(self):
+        seed_brands(n_brands=2)
+        seed_categories(n_categories=2)
+        seed_products(n_products=5)
+        product_data = get_random_product_data()
+        product_data['name'] = 'Unobtainium wrench'
+        product = ProductModel.create(**product_data)
+
+        with captured_templates(self.app) as templates:
+            response = self.client.get(url_for('products_blueprint.search', q='unobtainium'))
+
+            self.assertEqual(response.status_code, 200)
+            template, context = templates[0]
+            self.assertListEqual(context['products'], [product])
+            self.assertEqual(context['pagination'].total, 1)
+            self.assertEqual(context['kwargs']['q'], 'unobtainium')
+
+    def test_search_second_page(self):
+        seed_brands(n_brands=2)
+        seed_categories(n_categories=2)
+        for i in range(ProductModel.PAGINATE_BY + 1):
+            product_data = get_random_product_data()
+            product_data['name'] = f'Unobtainium wrench {i}'
+            ProductModel.create(**product_data)
+
+        with captured_templates(self.app) as templates:
+            response = self.client.get(url_for('products_blueprint.search', q='wrench', page=2))
+
+            self.assertEqual(response.status_code, 200)
+            template, context = templates[0]
+            self.assertEqual(len(context['products']), 1)
+            self.assertEqual(context['pagination'].pages, 2)
+
+    def test_search_too_big_page(self):
+        with captured_templates(self.app) as templates:
+            response = self.client.get(url_for('products_blueprint.search', q='wrench', page=randint(2, 10)))
+
+            self.assertEqual(response.status_code, 404)
+            template, context = templates[0]
+            self.assertEqual(template.name, 'errors/404.html')
+
+
 class ProductsPageAnonymousUserTests(ClientRequestsMixin):
     def tearDown(self):
         ProductModel.delete_all()
@@ -574,6 +1075,20 @@ class ProductDetailPageUserTests(UserMixin, ProductDetailPageAnonymousUserTests)
             self.assertEqual('products/product_detail.html', template.name)
             self.assertEqual(product, context['product'])
 
+    def test_post_add_product_to_cart_loads_product_once(self):
+        product = ProductModel.create(**dict(get_random_product_data(), amount=10))
+        post_data = {
+            'add_to_card-product_id': product.id,
+            'add_to_card-amount_to_add': 1,
+            'add_to_card-submit': True,
+        }
+
+        with captured_queries(db.engine) as queries:
+            self.client.post(url_for('products_blueprint.product_detail', product_id=product.id), data=post_data)
+
+        product_loads = [query for query in queries if query.startswith('SELECT products.id') and 'LIMIT' in query]
+        self.assertEqual(1, len(product_loads))
+
     def test_post_add_product_to_cart_with_too_big_amount(self):
         product = ProductModel.create(**get_random_product_data())
         amount_to_add = product.amount + randint(1, 10)
@@ -695,7 +1210,8 @@ class CreateBrandPageSuperuserTests(SuperuserMixin, CreateBrandPageAnonymousUser
             self.assertEqual(1, len(templates))
             template, context = templates[0]
             self.assertEqual('products/products_list.html', template.name)
-            self.assertSetEqual({BrandModel.get(name=random_name)}, set(context['brands']))
+            brand = BrandModel.get(name=random_name)
+            self.assertSetEqual({(brand.id, brand.name)}, set(context['brands']))
 
     def test_post_create_brand_with_existing_title(self):
         brand = BrandModel.create(**get_random_brand_data())
@@ -791,7 +1307,8 @@ class CreateCategoryPageSuperuserTests(SuperuserMixin, CreateCategoryPageAnonymo
             self.assertEqual(1, len(templates))
             template, context = templates[0]
             self.assertEqual('products/products_list.html', template.name)
-            self.assertSetEqual({CategoryModel.get(name=random_name)}, set(context['categories']))
+            category = CategoryModel.get(name=random_name)
+            self.assertSetEqual({(category.id, category.name)}, set(context['categories']))
 
     def test_post_create_category_with_existing_title(self):
         category = CategoryModel.create(**get_random_category_data())
@@ -900,6 +1417,15 @@ class CreateProductPageSuperuserTests(SuperuserMixin, CreateProductPageAnonymous
             self.assertEqual('products/product_detail.html', template.name)
             self.assertEqual(product, context['product'])
 
+    def test_post_create_product_commits_once(self):
+        post_data = CreateProductPageAnonymousUserTests.random_post_data()
+        with captured_commits(db.session) as commits:
+            self.client.post(url_for('products_blueprint.create_product'), data=post_data)
+
+        # The product with its search postings and the catalog version stamp
+        self.assertEqual(1, len(commits))
+        self.assertIsNotNone(ProductModel.get(name=post_data['name']))
+
     def test_post_create_product_with_existing_title(self):
         product = ProductModel.create(**get_random_product_data())
 
@@ -1094,7 +1620,7 @@ class UpdateBrandPageSuperuserTests(SuperuserMixin, UpdateBrandPageAnonymousUser
             self.assertEqual(1, len(templates))
             template, context = templates[0]
             self.assertEqual('products/products_list.html', template.name)
-            self.assertListEqual([brand], context['brands'])
+            self.assertListEqual([(brand.id, brand.name)], context['brands'])
 
 
 class UpdateCategoryPageAnonymousUserTests(ClientRequestsMixin):
@@ -1212,7 +1738,7 @@ class UpdateCategoryPageSuperuserTests(SuperuserMixin, UpdateCategoryPageAnonymo
             self.assertEqual(1, len(templates))
             template, context = templates[0]
             self.assertEqual('products/products_list.html', template.name)
-            self.assertListEqual([category], context['categories'])
+            self.assertListEqual([(category.id, category.name)], context['categories'])
 
 
 class UpdateProductPageAnonymousUserTests(ClientRequestsMixin):
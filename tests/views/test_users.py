@@ -1,11 +1,14 @@
 import secrets
 import unittest
+from unittest import mock
 
 from flask import url_for
 from tests.mixins import ClientRequestsMixin, UserMixin
-from tests.utils import captured_templates, logout
+from tests.utils import captured_queries, captured_templates, logout
 
-from shop.email import mail
+from shop.bcrypt import hashing_pool, HashingPoolBusy
+from shop.db import db
+from shop.email import deliver_outbox, mail
 from shop.orders.models import OrderModel
 from shop.seed_db import (
     fake,
@@ -65,6 +68,9 @@ class SignupPageTests(ClientRequestsMixin):
             expected_url = url_for('users_blueprint.confirm_email', token=expected_token, _external=True)
             self.assertEqual(expected_url, context['token_url'])
 
+            # The view only puts the email into the outbox
+            self.assertEqual(0, len(outbox))
+            deliver_outbox()
             self.assertEqual(1, len(outbox))
             sent_mail = outbox[0]
             self.assertEqual('Confirm your email', sent_mail.subject)
@@ -142,6 +148,27 @@ class SignupPageTests(ClientRequestsMixin):
 
             self.assertEqual(0, len(outbox))
 
+    def test_post_registration_checks_taken_fields_in_one_query(self):
+        user = UserModel(
+            email=fake.email(),
+            username=fake.first_name(),
+            password=secrets.token_hex(16),
+        )
+        password = secrets.token_hex(16)
+        post_data = {
+            'email': user.email,
+            'username': user.username,
+            'password': password,
+            'confirm_password': password,
+        }
+
+        with captured_templates(self.app) as templates, captured_queries(db.engine) as queries:
+            self.client.post(url_for('users_blueprint.signup'), data=post_data)
+
+        template, context = templates[0]
+        self.assertSetEqual({'username', 'email'}, set(context['form'].errors))
+        self.assertEqual(1, len([query for query in queries if 'FROM users' in query]))
+
 
 class ConfirmEmailPageTests(ClientRequestsMixin):
     def tearDown(self) -> None:
@@ -219,6 +246,30 @@ class LoginPageTests(ClientRequestsMixin):
         expected_redirect_url = url_for('products_blueprint.products', _external=True)
         self.assertEqual(expected_redirect_url, response.location)
 
+    def test_post_login_with_busy_hashing_pool(self):
+        password = secrets.token_hex(16)
+        user = UserModel(
+            email=fake.email(),
+            username=fake.first_name(),
+            password=password,
+            confirmed=True,
+        )
+
+        post_data = {
+            'email': user.email,
+            'password': password,
+        }
+        with mock.patch.object(hashing_pool, 'run', side_effect=HashingPoolBusy()), \
+                captured_templates(self.app) as templates:
+            response = self.client.post(
+                url_for('users_blueprint.login'),
+                data=post_data,
+            )
+
+        self.assertEqual(503, response.status_code)
+        template, context = templates[0]
+        self.assertEqual('errors/503.html', template.name)
+
     def test_post_login_invalid_email(self):
         password = secrets.token_hex(16)
         user = UserModel(
@@ -362,6 +413,7 @@ class ProfilePageTests(UserMixin, ClientRequestsMixin):
             expected_url = url_for('users_blueprint.confirm_email', token=expected_token, _external=True)
             self.assertEqual(expected_url, context['token_url'])
 
+            deliver_outbox()
             self.assertEqual(1, len(outbox))
             sent_mail = outbox[0]
             self.assertEqual('Confirm your email', sent_mail.subject)
@@ -459,6 +511,7 @@ class ResetPasswordRequestPageTests(UserMixin, ClientRequestsMixin):
             expected_url = url_for('users_blueprint.reset_password', token=expected_token, _external=True)
             self.assertEqual(expected_url, context['token_url'])
 
+            deliver_outbox()
             self.assertEqual(1, len(outbox))
             sent_mail = outbox[0]
             self.assertEqual('Reset password', sent_mail.subject)